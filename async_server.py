@@ -0,0 +1,285 @@
+import asyncio
+import compression
+import concurrent.futures
+import tempfile
+import threading
+import protocol
+
+# Payloads bigger than this are spooled to a temporary file before the
+# request is handed to the executor
+SPOOL_MEMORY_LIMIT = protocol.SPOOL_MEMORY_LIMIT
+
+DEFAULT_WORKERS = 64
+
+
+class AsyncFramedChannel:
+    # first_bytes holds whatever was read while telling the channel types
+    # apart. The parts of batch responses are produced on executor
+    def __init__(self, reader, writer, first_bytes, executor):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = first_bytes
+        self.executor = executor
+        self.loop = asyncio.get_event_loop()
+        # invalidations must not be written in the middle of a response
+        self.send_lock = asyncio.Lock()
+        # compression codec picked by the client's hello, None until then
+        self.codec = None
+
+    async def read_some(self, size):
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        data = await self.reader.read(size)
+        if not data:
+            raise protocol.ConnectionClosed()
+        return data
+
+    async def read_exact(self, size):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        if len(data) < size:
+            data = data + await protocol.read_exact_async(self.reader, size - len(data))
+        return data
+
+    async def next_request(self, server):
+        while True:
+            opcode, flags, arg_length, request_id, length = \
+                protocol.parse_header(await self.read_exact(protocol.HEADER.size))
+            args = protocol.decode_args(await self.read_exact(arg_length))
+            payload = await self.read_payload(server, length)
+            protocol.traffic.received(protocol.HEADER.size + arg_length + length)
+            frame = protocol.Frame(opcode, flags, request_id, args, payload)
+            if opcode == protocol.OP_HELLO:
+                await self.answer_hello(frame)
+                continue
+            if flags & protocol.FLAG_COMPRESSED:
+                await self.decompress(frame)
+            return frame
+
+    async def answer_hello(self, frame):
+        codec, args = protocol.answer_hello(frame)
+        async with self.send_lock:
+            await protocol.send_frame_async(
+                self.writer, protocol.OP_HELLO, frame.request_id, args, b'',
+                protocol.FLAG_RESPONSE)
+            self.codec = codec
+
+    # Decompresses the payload of a request on the executor
+    async def decompress(self, frame):
+        spool = getattr(frame.payload, 'spool', None)
+        try:
+            await self.loop.run_in_executor(
+                self.executor, protocol.decompress_frame, self.codec, frame)
+        finally:
+            if spool is not None:
+                spool.close()
+
+    async def read_payload(self, server, length):
+        if length <= SPOOL_MEMORY_LIMIT:
+            return protocol.payload_from_bytes(await self.read_exact(length))
+        loop = asyncio.get_event_loop()
+        spool = tempfile.TemporaryFile()
+        try:
+            remaining = length
+            while remaining > 0:
+                chunk = await self.read_some(min(protocol.CHUNK_SIZE, remaining))
+                await loop.run_in_executor(server.executor, spool.write, chunk)
+                remaining = remaining - len(chunk)
+            spool.seek(0)
+        except BaseException:
+            spool.close()
+            raise
+        payload = protocol.PayloadReader(spool, length)
+        payload.spool = spool
+        return payload
+
+    async def send_response(self, request, response):
+        parts = iter(response.parts)
+        while True:
+            part = await self.loop.run_in_executor(self.executor, next, parts, None)
+            if part is None:
+                break
+            try:
+                await self.send_frame(request, part, protocol.FLAG_MORE)
+            finally:
+                part.close()
+        await self.send_frame(request, response)
+
+    # Payloads worth compressing are compressed on the executor
+    async def send_frame(self, request, response, flags=0):
+        payload = response.payload
+        compressed = 0
+        if isinstance(payload, protocol.FileRegion):
+            size = payload.count
+        else:
+            size = len(payload)
+        if compression.worth_trying(self.codec, size):
+            payload, compressed = await self.loop.run_in_executor(
+                self.executor, protocol.compress_payload, self.codec, payload)
+        args = response.args()
+        try:
+            async with self.send_lock:
+                await protocol.send_frame_async(
+                    self.writer, request.opcode, request.request_id, args,
+                    payload, protocol.FLAG_RESPONSE | response.flags | flags | compressed)
+        finally:
+            protocol.close_compressed(payload, compressed)
+        protocol.traffic.sent(protocol.frame_size(args, protocol.payload_size(payload)))
+
+    async def send_invalidation_async(self, path):
+        async with self.send_lock:
+            await protocol.send_frame_async(
+                self.writer, protocol.OP_INVALIDATE, 0, (path,), b'',
+                protocol.FLAG_RESPONSE)
+
+    # Tells the client that a file it cached has changed. Called from other
+    # threads, the frame is written by the event loop
+    def send_invalidation(self, path):
+        asyncio.run_coroutine_threadsafe(self.send_invalidation_async(path), self.loop)
+
+
+class AsyncLegacyChannel:
+    # asyncio version of protocol.LegacyChannel
+    def __init__(self, reader, writer, first_bytes, executor):
+        self.reader = reader
+        self.writer = writer
+        self.first_bytes = first_bytes
+        self.executor = executor
+
+    async def next_request(self, server):
+        data, self.first_bytes = self.first_bytes, b''
+        if not data:
+            data = await self.reader.read(protocol.LEGACY_RECV_SIZE)
+            if not data:
+                raise protocol.ConnectionClosed()
+        return protocol.parse_legacy_request(data.decode(errors='replace'))
+
+    async def send_response(self, request, response):
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(
+            self.executor, protocol.render_legacy_response, request, response)
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+# Serves the command set of ser.py with asyncio streams. Connections cost a
+# coroutine rather than a thread, filesystem work runs on a bounded executor
+class AsyncServer:
+    def __init__(self, file_manager, handle_request, max_workers=DEFAULT_WORKERS):
+        self.file_manager = file_manager
+        self.handle_request = handle_request
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        # requests handed to the executor that no thread has taken yet
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    async def open_channel(self, reader, writer):
+        first_bytes = await reader.read(protocol.LEGACY_RECV_SIZE)
+        if not first_bytes:
+            raise protocol.ConnectionClosed()
+        if len(first_bytes) < len(protocol.MAGIC) and \
+                protocol.MAGIC.startswith(first_bytes):
+            first_bytes = first_bytes + await protocol.read_exact_async(
+                reader, len(protocol.MAGIC) - len(first_bytes))
+        if first_bytes.startswith(protocol.MAGIC):
+            return AsyncFramedChannel(reader, writer, first_bytes, self.executor)
+        return AsyncLegacyChannel(reader, writer, first_bytes, self.executor)
+
+    async def handle_client(self, reader, writer):
+        client_id = None
+        # requests of this connection running concurrently
+        running = set()
+        depth = asyncio.Semaphore(protocol.PIPELINE_DEPTH)
+        try:
+            channel = await self.open_channel(reader, writer)
+            client_id = self.file_manager.add_client(
+                writer.get_extra_info('socket'),
+                getattr(channel, 'send_invalidation', None))
+            # legacy responses carry no request id, so they must stay in order
+            pipelined = isinstance(channel, AsyncFramedChannel)
+            while True:
+                request = await channel.next_request(self)
+                if request.opcode == protocol.OP_EXIT:
+                    break
+                if pipelined and request.runs_concurrently():
+                    await depth.acquire()
+                    task = asyncio.ensure_future(
+                        self.run_request(channel, request, client_id))
+                    running.add(task)
+                    task.add_done_callback(
+                        lambda task: self.request_done(task, running, depth))
+                else:
+                    if running:
+                        await asyncio.wait(running)
+                    await self.run_request(channel, request, client_id)
+        except (protocol.ConnectionClosed, protocol.ProtocolError, OSError):
+            pass
+        finally:
+            # let running requests answer before the connection is closed
+            if running:
+                await asyncio.wait(running)
+            if client_id is not None:
+                self.file_manager.remove_client(
+                    self.file_manager.get_active_client(client_id))
+            writer.close()
+
+    # Runs a request on the executor and sends its response
+    async def run_request(self, channel, request, client_id):
+        loop = asyncio.get_event_loop()
+        started = []
+
+        def run():
+            self.request_started(started)
+            return self.handle_request(request, client_id)
+
+        with self.lock:
+            self.waiting = self.waiting + 1
+        try:
+            try:
+                response = await loop.run_in_executor(self.executor, run)
+            finally:
+                # cancelled before a thread took it
+                self.request_started(started)
+            try:
+                await channel.send_response(request, response)
+            finally:
+                response.close()
+        finally:
+            # batches keep reading their payload while the response is sent
+            spool = getattr(request.payload, 'spool', None)
+            if spool is not None:
+                spool.close()
+
+    # Counts a request as taken by a thread, once. started is the list
+    # run_request keeps for the request
+    def request_started(self, started):
+        with self.lock:
+            if not started:
+                started.append(True)
+                self.waiting = self.waiting - 1
+
+    # Returns the requests waiting for a thread of the executor
+    def queue_depth(self):
+        with self.lock:
+            return self.waiting
+
+    # Done callback of the tasks of concurrent requests. Their only failures
+    # are sends on a closed connection, which the connection's coroutine
+    # finds out about itself
+    def request_done(self, task, running, depth):
+        running.discard(task)
+        depth.release()
+        if not task.cancelled():
+            task.exception()
+
+    # on_listening is called once the server accepts connections
+    async def serve(self, host, port, backlog, on_listening=None):
+        server = await asyncio.start_server(
+            self.handle_client, host, port, backlog=backlog)
+        if on_listening is not None:
+            await asyncio.get_event_loop().run_in_executor(self.executor, on_listening)
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host, port, backlog, on_listening=None):
+        asyncio.run(self.serve(host, port, backlog, on_listening))
@@ -0,0 +1,357 @@
+import argparse
+import dfs_client
+import json
+import os
+import platform
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Load generator for the file server. It starts ser.py on a local port, or
+# uses a server already running, writes a set of files and has a number of
+# clients run a mix of operations on them for a while, each with its own
+# dfs_client.Client. It reports the operations per second and the latency
+# percentiles of each kind of operation and can write them to a JSON file,
+# which a later run compares itself with:
+#   python benchmark.py --mix read=70,write=20,ls=5,lock=5 --output base.json
+#   python benchmark.py --server-args "--engine asyncio" --compare base.json
+
+# Operations a mix can hold. lock takes an exclusive lock on a file and
+# releases it, a lock held by another client counts as an error
+OPERATIONS = ("read", "write", "append", "stat", "ls", "lock")
+
+DEFAULT_MIX = "read=70,write=20,ls=5,lock=5"
+
+# Percentiles reported for every operation
+PERCENTILES = (50, 99, 99.9)
+
+# Directory of the files the clients work on
+BENCH_DIR = "bench"
+
+# Change in throughput or latency from the compared run that is reported as
+# a regression by default
+REGRESSION = 0.10
+
+
+# Parses a mix such as read=70,write=30 into {operation: weight}
+# Raises ValueError if it names an unknown operation or has no weight
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError("unknown operation %s" % name)
+        mix[name] = float(weight) if weight else 1.0
+    if sum(mix.values()) <= 0:
+        raise ValueError("the mix has no weight")
+    return mix
+
+
+# Parses comma separated sizes, with an optional k or m suffix
+def parse_sizes(text):
+    sizes = []
+    for item in text.split(","):
+        item = item.strip().lower()
+        scale = 1
+        if item.endswith("k"):
+            scale, item = 1024, item[:-1]
+        elif item.endswith("m"):
+            scale, item = 1024 * 1024, item[:-1]
+        sizes.append(int(float(item) * scale))
+    return sizes
+
+
+# Returns the pth percentile of sorted values, by nearest rank
+def percentile(values, p):
+    if not values:
+        return 0.0
+    rank = int(len(values) * p / 100.0 + 0.5)
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+class Recorder:
+    # Latencies of the operations of one client, and the errors they met
+    def __init__(self):
+        # operation -> latencies in seconds
+        self.latencies = dict((name, []) for name in OPERATIONS)
+        self.errors = dict((name, 0) for name in OPERATIONS)
+
+    def add(self, operation, seconds, failed=False):
+        self.latencies[operation].append(seconds)
+        if failed:
+            self.errors[operation] += 1
+
+
+class Workload:
+    # The files of a run and the operations of its mix. Files are named by
+    # index, file i has the size sizes[i % len(sizes)]
+    def __init__(self, mix, sizes, files, seed):
+        self.mix = mix
+        self.sizes = sizes
+        self.files = files
+        self.seed = seed
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        generator = random.Random(seed)
+        # contents written are slices of this, so the server can't skip work
+        # on compressible data
+        size = max(sizes) + 4096
+        self.data = generator.getrandbits(8 * size).to_bytes(size, 'big')
+
+    def path(self, index):
+        return "%s/f%d" % (BENCH_DIR, index)
+
+    def contents(self, index, offset=0):
+        size = self.sizes[index % len(self.sizes)]
+        offset = offset % 4096
+        return self.data[offset:offset + size]
+
+    # Writes the files, replacing those of an earlier run
+    def prepare(self, client):
+        try:
+            client.mkdir(BENCH_DIR)
+        except dfs_client.DFSError:
+            pass
+        for index in range(self.files):
+            client.write(self.path(index), self.contents(index))
+
+    # Runs one operation drawn from the mix
+    # Returns (operation, failed)
+    def run_one(self, client, generator):
+        operation = generator.choices(self.names, self.weights)[0]
+        index = generator.randrange(self.files)
+        path = self.path(index)
+        try:
+            if operation == "read":
+                client.read(path)
+            elif operation == "write":
+                client.write(path, self.contents(index, generator.randrange(4096)))
+            elif operation == "append":
+                client.append(path, self.contents(index)[:128])
+            elif operation == "stat":
+                client.stat(path)
+            elif operation == "ls":
+                client.ls(BENCH_DIR)
+            elif operation == "lock":
+                client.lock(path, "exclusive")
+                client.release(path)
+        except dfs_client.DFSError:
+            return (operation, True)
+        return (operation, False)
+
+
+# Runs a client until deadline, recording from start on
+def run_client(address, workload, pool_size, seed, start, deadline, recorder, errors):
+    generator = random.Random(seed)
+    try:
+        with dfs_client.Client(address, pool_size) as client:
+            while True:
+                began = time.monotonic()
+                if began >= deadline:
+                    return
+                operation, failed = workload.run_one(client, generator)
+                if began >= start:
+                    recorder.add(operation, time.monotonic() - began, failed)
+    except Exception as e:
+        errors.append("%s: %s" % (type(e).__name__, e))
+
+
+# Returns the results of a run as a dict of operation -> figures, with the
+# figures of all operations together under "all"
+def summarize(recorders, duration):
+    results = {}
+    for name in OPERATIONS + ("all",):
+        if name == "all":
+            latencies = sorted(seconds for recorder in recorders
+                               for values in recorder.latencies.values() for seconds in values)
+            errors = sum(sum(recorder.errors.values()) for recorder in recorders)
+        else:
+            latencies = sorted(seconds for recorder in recorders
+                               for seconds in recorder.latencies[name])
+            errors = sum(recorder.errors[name] for recorder in recorders)
+        if not latencies:
+            continue
+        figures = {"count": len(latencies), "errors": errors,
+                   "ops_per_second": len(latencies) / duration,
+                   "mean_ms": sum(latencies) / len(latencies) * 1000,
+                   "max_ms": latencies[-1] * 1000}
+        for p in PERCENTILES:
+            figures["p%s_ms" % ("%g" % p).replace(".", "")] = percentile(latencies, p) * 1000
+        results[name] = figures
+    return results
+
+
+def print_results(results):
+    print("%-8s %8s %7s %10s %9s %9s %9s %9s" % (
+        "op", "count", "errors", "ops/s", "mean ms", "p50 ms", "p99 ms", "p999 ms"))
+    for name, figures in results.items():
+        print("%-8s %8d %7d %10.0f %9.2f %9.2f %9.2f %9.2f" % (
+            name, figures["count"], figures["errors"], figures["ops_per_second"],
+            figures["mean_ms"], figures["p50_ms"], figures["p99_ms"], figures["p999_ms"]))
+
+
+# Compares results with those of an earlier run and prints the changes
+# Returns the number of regressions, throughput or p99 latency worse by
+# more than threshold
+def compare(results, earlier, threshold=REGRESSION):
+    regressions = 0
+    for name, figures in results.items():
+        before = earlier.get(name)
+        if before is None:
+            continue
+        changes = []
+        for key, higher_better in (("ops_per_second", True), ("p50_ms", False),
+                                   ("p99_ms", False)):
+            if not before.get(key):
+                continue
+            change = figures[key] / before[key] - 1
+            worse = -change if higher_better else change
+            mark = ""
+            if worse > threshold and key != "p50_ms":
+                mark = " REGRESSION"
+                regressions = regressions + 1
+            changes.append("%s %+.1f%%%s" % (key, change * 100, mark))
+        print("%-8s %s" % (name, ", ".join(changes)))
+    return regressions
+
+
+# Returns the commit of the tree being measured, or None outside git
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Starts ser.py on port, serving an empty directory files in top. It runs
+# in top because the server checks some paths relative to its working
+# directory
+# Returns the process
+def start_server(port, top, server_args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.makedirs(os.path.join(top, "files"))
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(here, "ser.py"), "--quiet", "--port", str(port),
+         "--root", "files"] + shlex.split(server_args), stdout=subprocess.DEVNULL, cwd=top)
+    for _ in range(200):
+        if process.poll() is not None:
+            raise RuntimeError("the server exited with status %d" % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("the server didn't start listening on port %d" % port)
+
+
+# Runs a benchmark against the server at address
+# Returns (results, errors of clients that stopped)
+def run(address, workload, clients, pool_size, duration, warmup, seed):
+    with dfs_client.Client(address) as client:
+        workload.prepare(client)
+    recorders = [Recorder() for _ in range(clients)]
+    errors = []
+    start = time.monotonic() + warmup
+    deadline = start + duration
+    threads = [threading.Thread(target=run_client, args=(
+        address, workload, pool_size, seed + 1 + index, start, deadline,
+        recorders[index], errors)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(recorders, duration), errors
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the file server")
+    parser.add_argument('--address', default=None,
+                        help="host:port of a server already running, by default ser.py is "
+                             "started with a fresh root")
+    parser.add_argument('--port', type=int, default=9800,
+                        help="port of the server started")
+    parser.add_argument('--server-args', default="",
+                        help="more arguments of the server started, such as "
+                             "\"--engine asyncio --wal /tmp/wal\"")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="operations and their weights, of %s" % ", ".join(OPERATIONS))
+    parser.add_argument('--sizes', default="4k",
+                        help="comma separated sizes of the files, such as 1k,64k,1m")
+    parser.add_argument('--files', type=int, default=100,
+                        help="files the clients work on")
+    parser.add_argument('--clients', type=int, default=16,
+                        help="clients running at once, each a thread with its own connections")
+    parser.add_argument('--pool-size', type=int, default=1,
+                        help="connections of each client")
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help="seconds measured")
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help="seconds run before measuring")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="seed of the operations drawn and the contents written")
+    parser.add_argument('--output', default=None,
+                        help="write the configuration and results to this JSON file")
+    parser.add_argument('--compare', default=None,
+                        help="JSON file of an earlier run to compare the results with, the "
+                             "exit status is 1 if they regressed")
+    parser.add_argument('--threshold', type=float, default=REGRESSION,
+                        help="fraction throughput or p99 latency may get worse by before it "
+                             "counts as a regression")
+    arguments = parser.parse_args(argv)
+    try:
+        arguments.mix = parse_mix(arguments.mix)
+        arguments.sizes = parse_sizes(arguments.sizes)
+    except ValueError as e:
+        parser.error(str(e))
+    return arguments
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    workload = Workload(arguments.mix, arguments.sizes, arguments.files, arguments.seed)
+    server = None
+    top = None
+    if arguments.address is None:
+        top = tempfile.TemporaryDirectory()
+        server = start_server(arguments.port, top.name, arguments.server_args)
+        address = ('127.0.0.1', arguments.port)
+    else:
+        host, port = arguments.address.rsplit(":", 1)
+        address = (host, int(port))
+    try:
+        results, errors = run(address, workload, arguments.clients, arguments.pool_size,
+                              arguments.duration, arguments.warmup, arguments.seed)
+    finally:
+        if server is not None:
+            server.kill()
+            server.wait()
+            top.cleanup()
+    for error in sorted(set(errors)):
+        print("a client stopped: %s" % error)
+    print_results(results)
+    configuration = {"mix": arguments.mix, "sizes": arguments.sizes, "files": arguments.files,
+                     "clients": arguments.clients, "pool_size": arguments.pool_size,
+                     "duration": arguments.duration, "warmup": arguments.warmup,
+                     "seed": arguments.seed, "server_args": arguments.server_args,
+                     "address": arguments.address}
+    report = {"commit": git_commit(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(), "cpus": os.cpu_count(),
+              "config": configuration, "results": results}
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    if arguments.compare is not None:
+        with open(arguments.compare) as file:
+            earlier = json.load(file)
+        print("compared with %s (%s):" % (arguments.compare, earlier.get("commit")))
+        if compare(results, earlier["results"], arguments.threshold) > 0:
+            sys.exit(1)
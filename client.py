@@ -1,124 +1,183 @@
-import socket
-import threadpool
-import time
+import argparse
+import dfs_client
 import os
-client_thread = threadpool.ThreadPool(5)
-ip_addr = socket.gethostbyname(socket.gethostname())
+import posixpath
+import protocol
+import time
 port = 8019
+# Seconds a cached file is used without asking the server whether it changed
 cache_time = 2
-cache_queue = []
-response_var = ""
-def connect():
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock_addr = ('127.0.0.1', port)
-    print("connecting to %s on port %s\n" % sock_addr)
-    sock.connect(sock_addr)
-    client_thread.add_task(
-        server_res,
-        sock
-    )
-    client_thread.add_task(
-        cache_auto_update
-    )
+client = None
+# Directories the client moved into, paths typed are relative to them. The
+# working directory is kept here, the server only sees paths from its root
+working_dir = []
+# Commands whose first argument is a path, find takes one second
+PATH_COMMANDS = dfs_client.FILE_COMMANDS | frozenset(("ls", "tree", "du", "mkdir", "rmdir"))
 
+def connect():
     while True:
-        user_input = input()
-        Input_mes = generate_message(user_input)
-        cache_response = cache_interaction(sock, Input_mes)
-        # if there is no cached response
-        if cache_response == None:
-            sock.send(Input_mes.encode())
-            if Input_mes == "exit":
-                os._exit(0)
+        try:
+            user_input = input()
+        except EOFError:
+            break
+        try:
+            run_command(user_input.split())
+        except dfs_client.DFSError as e:
+            print(e.message)
+        except (protocol.ConnectionClosed, OSError) as e:
+            print("no server can be reached: %s" % e)
+    client.close()
+
+# Runs a command typed by the user and prints its result
+def run_command(words):
+    if not words:
+        return
+    command, args = words[0], words[1:]
+    if command == "cache":
+        cache_log()
+    elif command == "exit":
+        client.close()
+        os._exit(0)
+    elif command in ("cd", "up", "pwd"):
+        change_dir(command, args)
+    elif command == "nodes":
+        for node in client.nodes():
+            print(node)
+    elif command == "locate" and len(args) == 1:
+        print(client.locate(resolve(args[0])))
+    elif command == "read" and len(args) == 1:
+        print(client.read(resolve(args[0])).decode(errors='replace'))
+    elif command == "read" and len(args) == 3 and args[1].isdecimal() and args[2].isdecimal():
+        print(client.read(resolve(args[0]), args[1], args[2]).decode(errors='replace'))
+    elif command in ("write", "append"):
+        upload(command, args)
+    elif command in ("copy", "move") and len(args) == 2:
+        if command == "copy":
+            print(client.copy(resolve(args[0]), resolve(args[1])))
         else:
-            print(cache_response)
-
-    sock.close()
-
-def server_res(socket):
-    global res_var
-    while True:
-        data = socket.recv(1024).decode()
-        res_var = data
-        if (data != None):
-            # if reading cache item
-            if(len(data.split("////")) == 2):
-                data_seperate = data.split("//"
-                                           "//")
-                add_to_cache(data_seperate[0], data_seperate[1])
-                print(data_seperate[1])
-            else:
-                print(data)
-
-def generate_message(input):
-    seperate_input = input.split(" ")
-    if seperate_input[0] == "write":
-        if len(seperate_input) != 2:
-            print("command not found")
-            return ""
+            print(client.move(resolve(args[0]), resolve(args[1])))
+    else:
+        show(command, client.request(command, resolve_args(command, args)))
+
+# Prints the responses to a command, with the node of each one for commands
+# every node of a cluster answers
+def show(command, results):
+    for node, frame in results:
+        if node is not None and command in dfs_client.GATHERED_COMMANDS:
+            print("[%s]" % node)
+        elif node is not None and frame is not results[0][1]:
+            # another node of the cluster refused a mirrored command
+            print("[%s] %s" % (node, frame.message))
+            continue
+        # frames of a streamed response before its last one
+        for part in frame.parts:
+            print(part.payload.read().decode(errors='replace'))
+        contents = frame.payload.read()
+        if contents:
+            print(contents.decode(errors='replace'))
+        else:
+            print(frame.message)
+
+# write <file> uploads a local file, write <file> <offset> writes its contents
+# at offset in the remote file and append <file> appends them
+def upload(command, args):
+    max_args = 2 if command == "write" else 1
+    if len(args) < 1 or len(args) > max_args:
+        print("command not found")
+        return
+    try:
+        file = open(args[0], 'rb')
+    except IOError:
+        print("no such file found")
+        return
+    with file:
+        if client.delta_mode:
+            # deltas are made from the contents in memory
+            data = file.read()
+        else:
+            data = protocol.FileRegion(file)
+        if command == "append":
+            print(client.append(resolve(args[0]), data))
+        elif len(args) == 2:
+            print(client.write(resolve(args[0]), data, args[1]))
+        else:
+            print(client.write(resolve(args[0]), data))
+
+# Returns a path typed by the user as a path from the root
+def resolve(path):
+    return posixpath.normpath("".join(directory + "/" for directory in working_dir) + path)
+
+# Returns the arguments of a command with its paths resolved. Directory
+# commands without one work on the working directory
+def resolve_args(command, args):
+    args = list(args)
+    if command in ("ls", "tree", "du") and not args and working_dir:
+        return [resolve(".")]
+    if command == "find" and len(args) == 1 and working_dir:
+        return args + [resolve(".")]
+    if command == "find" and len(args) > 1:
+        args[1] = resolve(args[1])
+    elif command in PATH_COMMANDS and args:
+        args[0] = resolve(args[0])
+    return args
+
+# cd <dir> moves into a directory, up moves back out and pwd prints where
+# the client is
+def change_dir(command, args):
+    if command == "pwd" and not args:
+        print("".join(directory + "/" for directory in working_dir))
+    elif command == "up" and not args:
+        if working_dir:
+            working_dir.pop()
+            print("moved up a directory")
+        else:
+            print("already at the top directory")
+    elif command == "cd" and len(args) == 1:
         try:
-            file = open(seperate_input[1])
-            file_contents = file.read()
-            return "%s////%s////%s" % (seperate_input[0], seperate_input[1], file_contents)
-        except IOError:
-            print("no such file found")
-            return ""
+            found = client.stat(resolve(args[0])).type == "d"
+        except dfs_client.DFSError:
+            found = False
+        if not found:
+            print("directory %s doesn't exist" % args[0])
+            return
+        working_dir.append(args[0])
+        print("changed directory to %s" % args[0])
     else:
-        return '////'.join(seperate_input)
-
-
-
-# searches the cache for an item
-def cache_search(path):
-    for item in cache_queue:
-        if item[0] == path:
-            return item[1]
-    return None
-
-# adds an item to the cache
-def add_to_cache(path, contents):
-    cache_queue.insert(0, (path, contents, 0))
-    if len(cache_queue) > 5:
-        cache_queue.pop()
+        print("command not found")
 
 # logs the contents of the cache
 def cache_log():
-    for item in cache_queue:
-        print("%s\t%s\t%d" % (item))
-
-def cache_interaction(connection, message):
-        global res_var
-        seperate_message = message.split("////")
-        if len(seperate_message) == 2 and seperate_message[0] == "read":
-            connection.send("pwd".encode())
-            time.sleep(1)
-            res_msg = res_var
-            search_term = "%s%s" % (res_msg, seperate_message[1])
-            ret_msg = cache_search(search_term)
-            cache_log()
-            print(search_term)
-            return ret_msg
-        return None
-
-# function removes old items from cache
-def cache_auto_update():
-    global cache_queue
-    while True:
-        time.sleep(10)
-        cache_queue_update = []
-        for item in cache_queue:
-            if item[2] < cache_time:
-                new_cache_record = (item[0], item[1], item[2] + 1)
-                cache_queue_update.append(new_cache_record)
-        cache_queue = cache_queue_update
+    for path, entry in client.cache.items():
+        if entry.callback:
+            age = "callback"
+        elif entry.fetched == float('-inf'):
+            age = "changed"
+        else:
+            age = "%.1fs old" % (time.monotonic() - entry.fetched)
+        print("%s\t%d bytes\t%s\t%s" % (path, len(entry.contents), entry.tag, age))
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=port)
+    parser.add_argument('--pool-size', type=int, default=dfs_client.DEFAULT_POOL_SIZE,
+                        help="connections opened to each server at most")
+    parser.add_argument('--cache-entries', type=int, default=256,
+                        help="most files kept in the cache")
+    parser.add_argument('--cache-size', type=int, default=16,
+                        help="megabytes of file contents kept in the cache")
+    parser.add_argument('--cache-time', type=float, default=cache_time,
+                        help="seconds a cached file is used before it is revalidated")
+    parser.add_argument('--delta', action='store_true',
+                        help="send only the changed blocks of big files written or read again")
+    parser.add_argument('--directory', default=None,
+                        help="host:port of the directory server of a cluster, files are "
+                             "read and written on the storage node that owns them")
+    parser.add_argument('--no-compression', action='store_true',
+                        help="don't compress payloads, even if the server can")
+    arguments = parser.parse_args()
+    cache = dfs_client.ClientCache(arguments.cache_entries, arguments.cache_size * 1024 * 1024)
     # Main line for program
-    # Create 20 tasks that send messages to the server
+    client = dfs_client.Client(('127.0.0.1', arguments.port), arguments.pool_size,
+                               arguments.directory, cache, arguments.cache_time,
+                               arguments.delta, not arguments.no_compression)
     connect()
-    # wait for threads to complete before finishing program
-    client_thread.wait_completion()
-
-
-
@@ -0,0 +1,334 @@
+import bisect
+import hashlib
+import hmac
+import posixpath
+import protocol
+import random
+import socket
+import threading
+import time
+
+# Spreading files over several storage nodes, each a ser.py with its own
+# root. A directory server (directory_server.py) keeps the list of nodes.
+# Clients fetch it once and find the node of a file themselves on a
+# consistent hash ring, then talk to that node directly, so the directory
+# server isn't on the path of reads and writes. Adding or removing a node
+# only moves the files of the ring arcs it takes over or gives up, about
+# 1/n of them. Directories exist on every node: mkdir and rmdir are sent to
+# all of them and a listing is the union of theirs. Nodes share a cluster
+# key and sign the requests that join or leave the cluster with it
+
+DEFAULT_DIRECTORY_PORT = 8020
+
+# Points each node has on the ring. More points spread files more evenly
+VIRTUAL_NODES = 128
+
+# Message of a read refused by a copy of a file older than the client asked
+# for (FLAG_VERSIONED), the client reads another copy
+STALE_REPLICA = "stale replica"
+
+# Requests that change a file, answered with the sequence number of the
+# change when the cluster keeps several copies (replication.py)
+CHANGE_OPCODES = frozenset((protocol.OP_WRITE, protocol.OP_APPEND, protocol.OP_DELETE))
+
+# Requests any copy of a file can answer
+READ_OPCODES = frozenset((protocol.OP_READ, protocol.OP_STAT))
+
+# Seconds a signed join or leave request is accepted for after it was made,
+# so one seen on the network can't be sent again later
+SIGNATURE_LIFETIME = 60
+
+
+# Returns the signature of the arguments of a request, made with the
+# cluster key
+def sign(key, args):
+    message = "\0".join(str(arg) for arg in args).encode("utf-8")
+    return hmac.new(key.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+# Returns True if signature is the one key makes for args
+def authentic(key, args, signature):
+    return hmac.compare_digest(sign(key, args), signature)
+
+
+# Returns the arguments of a join or leave request of node: the node, the
+# time it was made and their signature
+def membership_args(key, action, node):
+    made = str(int(time.time()))
+    return (node, made, sign(key, (action, node, made)))
+
+
+# Returns True if args are those of a join or leave request signed with key
+# in the last SIGNATURE_LIFETIME seconds
+def authentic_membership(key, action, args):
+    node, made, signature = args
+    if not key or not made.isdecimal() or \
+            abs(time.time() - int(made)) > SIGNATURE_LIFETIME:
+        return False
+    return authentic(key, (action, node, made), signature)
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+# Returns the key a path is placed by, the same for every spelling of it
+def ring_key(path):
+    return posixpath.normpath(path).strip("/")
+
+
+class HashRing:
+    # Consistent hash ring of node addresses. Every client that builds one
+    # from the same nodes places each path on the same node
+    def __init__(self, nodes=(), virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.nodes = set()
+        # sorted hashes of the points and the node of each one
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return False
+        self.nodes.add(node)
+        self.rebuild()
+        return True
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return False
+        self.nodes.discard(node)
+        self.rebuild()
+        return True
+
+    def rebuild(self):
+        points = sorted((hash_key("%s#%d" % (node, index)), node)
+                        for node in self.nodes for index in range(self.virtual_nodes))
+        self.points = [point for point, node in points]
+        self.owners = [node for point, node in points]
+
+    # Returns the node a path lives on. Raises LookupError if there are no
+    # nodes
+    def node_for(self, path):
+        if not self.points:
+            raise LookupError("no storage nodes")
+        index = bisect.bisect(self.points, hash_key(ring_key(path)))
+        return self.owners[index % len(self.points)]
+
+    # Returns the nodes that keep copies of a path, the node it lives on
+    # first then the next distinct nodes around the ring
+    def nodes_for(self, path, count):
+        if not self.points:
+            raise LookupError("no storage nodes")
+        count = min(count, len(self.nodes))
+        index = bisect.bisect(self.points, hash_key(ring_key(path)))
+        nodes = []
+        while len(nodes) < count:
+            node = self.owners[index % len(self.points)]
+            if node not in nodes:
+                nodes.append(node)
+            index = index + 1
+        return nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+# Splits a host:port address
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+
+# Opens a connection to a node. Requests and their payloads are sent in
+# several writes that shouldn't wait for acks
+def connect(node, timeout=None):
+    sock = socket.create_connection(parse_address(node), timeout)
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+# Sends one request to a server and returns its response frame, with the
+# payload read
+def call(address, opcode, args=()):
+    with socket.create_connection(parse_address(address)) as sock:
+        protocol.send_frame(sock, opcode, 1, args)
+        frame = protocol.recv_frame(sock)
+        frame.payload = protocol.payload_from_bytes(frame.payload.read())
+        protocol.send_frame(sock, protocol.OP_EXIT)
+    return frame
+
+
+# Asks the directory server for the storage nodes
+# Returns (epoch, node addresses, copies kept of each file), the epoch goes
+# up when the nodes change
+def fetch_nodes(directory):
+    frame = call(directory, protocol.OP_NODES)
+    nodes = frame.payload.read().decode().split("\n")
+    return (int(frame.message), [node for node in nodes if node], int(frame.args[2]))
+
+
+# Adds a storage node to the directory server, returns the status
+def join(directory, node, key):
+    return call(directory, protocol.OP_JOIN, membership_args(key, "join", node)).status
+
+
+# Removes a storage node from the directory server, returns the status
+def leave(directory, node, key):
+    return call(directory, protocol.OP_LEAVE, membership_args(key, "leave", node)).status
+
+
+class ClusterConnection:
+    # Pipelined connections to every storage node of a cluster. Requests
+    # about a file are sent to the node that owns it, others to every node.
+    # When the cluster keeps several copies of each file, request spreads
+    # reads over the copies and moves on to the next copy when a node is
+    # down. Reads refuse copies older than the changes this connection saw
+    def __init__(self, directory, on_invalidate=None):
+        self.epoch, nodes, self.copies = fetch_nodes(directory)
+        self.ring = HashRing(nodes)
+        # node address -> PipelinedConnection
+        self.connections = {}
+        # path -> sequence number of the latest change seen
+        self.versions = {}
+        self.versions_lock = threading.Lock()
+        try:
+            for node in nodes:
+                connection = protocol.PipelinedConnection(connect(node), on_invalidate)
+                self.connections[node] = connection
+                connection.negotiate()
+        except BaseException:
+            self.close()
+            raise
+
+    def connection_for(self, path):
+        return self.connections[self.ring.node_for(path)]
+
+    # Sends a request about the file at path, relative to the root, to its
+    # node. path is the first argument
+    def submit(self, opcode, path, args=(), payload=b'', flags=0):
+        return self.connection_for(path).submit(
+            opcode, [path] + list(args), payload, flags)
+
+    # Sends a request about the file at path and waits for its response.
+    # Changes go to the first copy that is up, reads to a random one
+    # Raises ConnectionClosed if no copy can be reached
+    def request(self, opcode, path, args=(), payload=b'', flags=0, timeout=None):
+        nodes = self.ring.nodes_for(path, self.copies)
+        args = [path] + list(args)
+        if opcode in READ_OPCODES:
+            random.shuffle(nodes)
+        if opcode == protocol.OP_READ and self.copies > 1:
+            with self.versions_lock:
+                least = self.versions.get(ring_key(path), 0)
+            args.append(str(least))
+            flags = flags | protocol.FLAG_VERSIONED
+        stale = None
+        for node in nodes:
+            connection = self.connections[node]
+            if connection.error is not None:
+                continue
+            try:
+                frame = connection.submit(opcode, args, payload, flags).result(timeout)
+            except protocol.ConnectionClosed:
+                continue
+            if frame.status == protocol.STATUS_FAILED and frame.message == STALE_REPLICA:
+                stale = frame
+                continue
+            if opcode in CHANGE_OPCODES and frame.status == protocol.STATUS_OK and \
+                    len(frame.args) > 2:
+                with self.versions_lock:
+                    self.versions[ring_key(path)] = int(frame.args[2])
+            return frame
+        if stale is not None:
+            return stale
+        raise protocol.ConnectionClosed("no copy of %s can be reached" % path)
+
+    # Sends a request to every node that is up
+    # Returns {node address: Future of the response}
+    def broadcast(self, opcode, args=()):
+        return dict((node, connection.submit(opcode, args))
+                    for node, connection in self.connections.items()
+                    if connection.error is None)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
+
+if __name__ == '__main__':
+    # Starts a directory server and 1 to 8 storage nodes on localhost and
+    # measures the writes and reads of small files a set of client threads
+    # gets through with each cluster size
+    import os
+    import subprocess
+    import sys
+    import tempfile
+    import threading
+    import time
+
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    base_port = 9500
+    here = os.path.dirname(os.path.abspath(__file__))
+    contents = os.urandom(4096)
+
+    def wait_listening(port):
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("nothing listening on port %d" % port)
+
+    def run_client(cluster, index, deadline, counts):
+        done = 0
+        while time.monotonic() < deadline:
+            path = "c%d-%d.bin" % (index, done % 100)
+            cluster.request(protocol.OP_WRITE, path, payload=contents)
+            cluster.request(protocol.OP_READ, path).payload.read()
+            done = done + 2
+        counts[index] = done
+
+    for node_count in (1, 2, 4, 8):
+        processes = []
+        with tempfile.TemporaryDirectory() as top:
+            try:
+                directory = "127.0.0.1:%d" % base_port
+                processes.append(subprocess.Popen(
+                    [sys.executable, os.path.join(here, "directory_server.py"),
+                     "--port", str(base_port), "--cluster-key", "benchmark"],
+                    stdout=subprocess.DEVNULL))
+                wait_listening(base_port)
+                for index in range(node_count):
+                    root = os.path.join(top, "node%d" % index)
+                    os.makedirs(root)
+                    processes.append(subprocess.Popen(
+                        [sys.executable, os.path.join(here, "ser.py"), "--quiet",
+                         "--port", str(base_port + 1 + index), "--root", root,
+                         "--directory", directory, "--cluster-key", "benchmark"],
+                        stdout=subprocess.DEVNULL))
+                while len(fetch_nodes(directory)[1]) < node_count:
+                    time.sleep(0.05)
+                connections = [ClusterConnection(directory) for _ in range(clients)]
+                counts = [0] * clients
+                deadline = time.monotonic() + duration
+                threads = [threading.Thread(target=run_client,
+                                            args=(connections[index], index, deadline, counts))
+                           for index in range(clients)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                for connection in connections:
+                    connection.close()
+                print("%d nodes: %6.0f requests/s" % (node_count, sum(counts) / duration))
+            finally:
+                for process in processes:
+                    process.kill()
+                    process.wait()
+        base_port = base_port + 10
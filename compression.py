@@ -0,0 +1,175 @@
+import threading
+import zlib
+
+# Payload compression. A client offers the codecs it knows in a hello
+# request when it connects and the server picks the first one it has
+# enabled. From then on either end may compress the payload of any frame it
+# sends with that codec, and flags the frame so the other end knows.
+# Payloads are only compressed when that pays: small ones aren't, and a
+# sample of big ones is compressed first so data that doesn't shrink, like
+# archives and media, costs a few microseconds rather than a full pass
+
+# Payloads smaller than this are sent as they are
+COMPRESS_THRESHOLD = 1024
+
+# Biggest payload compressed, bigger ones are streamed as they are
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+# Payloads bigger than SAMPLE_SIZE are compressed only if their first
+# SAMPLE_SIZE bytes shrink to at most MAX_RATIO of their size
+SAMPLE_SIZE = 16 * 1024
+MAX_RATIO = 0.9
+
+DEFAULT_LEVEL = 1
+
+
+class ZlibCodec:
+    # zlib at a fast level by default. zlib lets go of the GIL while it
+    # works, so threads compressing responses run in parallel
+    name = "zlib"
+
+    def __init__(self, level=DEFAULT_LEVEL):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    # Returns an object whose compress(data) and flush() give the pieces of
+    # one compressed stream, for payloads compressed a chunk at a time
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    # Raises ValueError if data doesn't decompress to at most max_length
+    # bytes
+    def decompress(self, data, max_length):
+        decompressor = zlib.decompressobj()
+        try:
+            result = decompressor.decompress(data, max_length)
+        except zlib.error as e:
+            raise ValueError(str(e))
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("compressed payload too big or truncated")
+        return result
+
+
+# Codec classes by name, codecs added here can be enabled and negotiated
+codec_types = {
+    ZlibCodec.name: ZlibCodec,
+}
+
+def register_codec(codec_type):
+    codec_types[codec_type.name] = codec_type
+
+# Codecs this end accepts, most preferred first
+enabled = [ZlibCodec()]
+
+# Enables the codecs named, most preferred first, compressing at level
+def configure(names, level=DEFAULT_LEVEL):
+    global enabled
+    enabled = [codec_types[name](level) for name in names]
+
+# Returns the enabled codec of a name, or None
+def find(name):
+    for codec in enabled:
+        if codec.name == name:
+            return codec
+    return None
+
+# Returns the first of the codec names a peer offered that is enabled, or
+# None
+def negotiate(offered):
+    for name in offered:
+        codec = find(name)
+        if codec is not None:
+            return codec
+    return None
+
+# Returns the names of the enabled codecs, to offer them to a server
+def offered():
+    return [codec.name for codec in enabled]
+
+
+class CompressionStats:
+    # Counts payloads sent compressed and skipped, and bytes saved
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {"compressed_payloads": 0, "compression_skipped": 0,
+                         "compressed_bytes_in": 0, "compressed_bytes_out": 0}
+
+    def add(self, skipped, size=0, compressed_size=0):
+        with self.lock:
+            if skipped:
+                self.counters["compression_skipped"] += 1
+                return
+            self.counters["compressed_payloads"] += 1
+            self.counters["compressed_bytes_in"] += size
+            self.counters["compressed_bytes_out"] += compressed_size
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+stats = CompressionStats()
+
+# Checks whether a payload of size bytes is worth trying to compress
+def worth_trying(codec, size):
+    return codec is not None and COMPRESS_THRESHOLD <= size <= MAX_PAYLOAD
+
+# Checks whether the start of a payload compresses well enough to compress
+# the rest. sample is the first SAMPLE_SIZE bytes
+def looks_compressible(codec, sample):
+    if len(codec.compress(sample)) <= len(sample) * MAX_RATIO:
+        return True
+    stats.add(True)
+    return False
+
+# Returns data compressed with codec, or None when it isn't worth it
+def compress(codec, data):
+    if not worth_trying(codec, len(data)):
+        return None
+    if len(data) > SAMPLE_SIZE * 4 and \
+            not looks_compressible(codec, bytes(data[:SAMPLE_SIZE])):
+        return None
+    compressed = codec.compress(data)
+    if len(compressed) > len(data) * MAX_RATIO:
+        stats.add(True)
+        return None
+    stats.add(False, len(data), len(compressed))
+    return compressed
+
+def decompress(codec, data):
+    if codec is None:
+        raise ValueError("compressed payload without a codec")
+    return codec.decompress(data, MAX_PAYLOAD)
+
+
+if __name__ == '__main__':
+    # Compares the time taken to compress typical payloads with the time
+    # they take to cross links of a few speeds
+    import os
+    import random
+    import sys
+    import time
+
+    generator = random.Random(1)
+    words = [bytes(generator.choice(b"abcdefghijklmnopqrstuvwxyz")
+                   for _ in range(generator.randint(2, 10))) for _ in range(5000)]
+    text = b" ".join(generator.choice(words) for _ in range(200000))
+    listing = b"\n".join(b"f\t%d\t2026-10-18 12:%02d:%02d\tfile%d.txt" % (
+        generator.randrange(100000), index % 60, index % 60, index) for index in range(30000))
+    payloads = [("text", text), ("listing", listing), ("random", os.urandom(len(text)))]
+    for level in (1, 6):
+        codec = ZlibCodec(level)
+        for name, data in payloads:
+            start = time.perf_counter()
+            compressed = compress(codec, data)
+            elapsed = time.perf_counter() - start
+            size = len(compressed) if compressed is not None else len(data)
+            line = "level %d %-8s %7d -> %7d bytes, %6.1f MB/s" % (
+                level, name, len(data), size, len(data) / elapsed / 1e6)
+            for megabits in (10, 100, 1000):
+                raw = len(data) * 8 / (megabits * 1e6)
+                line = line + ", %d Mbit/s %.0fms -> %.0fms" % (
+                    megabits, raw * 1e3, (elapsed + size * 8 / (megabits * 1e6)) * 1e3)
+            print(line)
+    sys.stdout.flush()
@@ -0,0 +1,190 @@
+import collections
+import threading
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Files bigger than this are always streamed from disk
+DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024
+
+
+# The version of a file an entry was read from
+def file_version(stat):
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+# The version of a file as a string clients can send back, it changes
+# whenever the file is replaced or modified
+def version_tag(stat):
+    return "%x-%x-%x" % file_version(stat)
+
+
+# The version of a directory a listing was read from. Its mtime changes when
+# entries are added, removed or renamed
+def directory_version(stat):
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+class ContentCache:
+    # Byte bounded LRU cache of file contents keyed by resolved path. Each
+    # entry remembers the inode, size and mtime of the file it was read from
+    # and only hits while the file still has them. Writes and deletes going
+    # through the server invalidate entries straight away
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        # path -> (version, contents), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Checks whether a file of this size is worth caching
+    def accepts(self, size):
+        return size <= self.max_entry_bytes
+
+    # Returns the cached contents of path if they match the passed stat
+    def get(self, path, stat):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+            if entry[0] != file_version(stat):
+                self.remove_locked(path)
+                self.misses = self.misses + 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits = self.hits + 1
+            return entry[1]
+
+    def put(self, path, stat, contents):
+        if not self.accepts(len(contents)):
+            return
+        with self.lock:
+            self.remove_locked(path)
+            self.entries[path] = (file_version(stat), contents)
+            self.size = self.size + len(contents)
+            while self.size > self.max_bytes:
+                self.remove_locked(next(iter(self.entries)))
+                self.evictions = self.evictions + 1
+
+    def remove_locked(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size = self.size - len(entry[1])
+        return entry is not None
+
+    def invalidate(self, path):
+        with self.lock:
+            if self.remove_locked(path):
+                self.invalidations = self.invalidations + 1
+
+    # Drops every entry at or below a directory
+    def invalidate_tree(self, directory):
+        prefix = directory.rstrip("/") + "/"
+        with self.lock:
+            for path in [path for path in self.entries if path.startswith(prefix)]:
+                self.remove_locked(path)
+                self.invalidations = self.invalidations + 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def __len__(self):
+        return len(self.entries)
+
+
+DEFAULT_MAX_LISTED_ENTRIES = 200000
+
+# Directories with more entries than this are always listed from disk
+DEFAULT_MAX_DIRECTORY_ENTRIES = 10000
+
+
+class DirectoryCache:
+    # LRU cache of directory listings keyed by resolved path, bounded by the
+    # total number of entries it holds. A listing only hits while the
+    # directory keeps the inode and mtime it had when listed. Changes that
+    # don't touch the directory's mtime (a file growing) invalidate it
+    # explicitly
+    def __init__(self, max_entries=DEFAULT_MAX_LISTED_ENTRIES,
+                 max_directory_entries=DEFAULT_MAX_DIRECTORY_ENTRIES):
+        self.max_entries = max_entries
+        self.max_directory_entries = min(max_directory_entries, max_entries)
+        # path -> (version, entries), least recently used first
+        self.listings = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # incremented by every invalidation, a listing read while one
+        # happened may be stale and isn't added
+        self.generation = 0
+
+    def accepts(self, count):
+        return count <= self.max_directory_entries
+
+    # Returns the cached entries of a directory if they match the passed stat
+    def get(self, path, stat):
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is None or listing[0] != directory_version(stat):
+                self.misses = self.misses + 1
+                return None
+            self.listings.move_to_end(path)
+            self.hits = self.hits + 1
+            return listing[1]
+
+    # Adds the entries of a directory listed when generation was current
+    def put(self, path, stat, entries, generation):
+        if not self.accepts(len(entries)):
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.remove_locked(path)
+            self.listings[path] = (directory_version(stat), entries)
+            self.size = self.size + len(entries)
+            while self.size > self.max_entries:
+                self.remove_locked(next(iter(self.listings)))
+
+    def remove_locked(self, path):
+        listing = self.listings.pop(path, None)
+        if listing is not None:
+            self.size = self.size - len(listing[1])
+
+    def invalidate(self, path):
+        with self.lock:
+            self.generation = self.generation + 1
+            self.remove_locked(path.rstrip("/"))
+
+    # Drops the listings of a directory and everything below it
+    def invalidate_tree(self, directory):
+        directory = directory.rstrip("/")
+        prefix = directory + "/"
+        with self.lock:
+            self.generation = self.generation + 1
+            for path in [path for path in self.listings
+                         if path == directory or path.startswith(prefix)]:
+                self.remove_locked(path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "listings": len(self.listings),
+                "listed_entries": self.size,
+                "listing_hits": self.hits,
+                "listing_misses": self.misses,
+            }
+
@@ -0,0 +1,262 @@
+import hashlib
+import io
+import math
+import struct
+import zlib
+
+# rsync style delta transfer. The side that has an old version of a file
+# sends a signature of it, a weak and a strong checksum per block. The side
+# with the new version looks for those blocks at every offset of its data,
+# rolling the weak checksum a byte at a time, and sends a delta: the blocks
+# of the old version to copy and the bytes that are new. Only the new bytes
+# and the checksums cross the network
+
+# Smallest and biggest blocks. Files are split into about sqrt(size) blocks
+# of about sqrt(size) bytes, as rsync does
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 64 * 1024
+
+# Bytes of the strong checksum kept per block
+STRONG_SIZE = 8
+
+# The weak checksum is adler32, whose sums can be rolled
+ADLER_MODULUS = 65521
+
+SIGNATURE_HEADER = struct.Struct('!II')
+SIGNATURE_ENTRY = struct.Struct('!I%ds' % STRONG_SIZE)
+
+DELTA_HEADER = struct.Struct('!IQ')
+COPY = b'C'
+COPY_ENTRY = struct.Struct('!II')
+DATA = b'D'
+DATA_ENTRY = struct.Struct('!I')
+
+# Largest run of new bytes sent in one data instruction
+MAX_DATA_LENGTH = 1024 * 1024
+
+# Biggest file the server reads into memory to send a delta of. Making a
+# delta takes about 0.3s of CPU per MB of new bytes
+MAX_DELTA_FILE = 4 * 1024 * 1024
+
+# The server stops making a delta and sends the whole file once the new
+# bytes pass this fraction of it, a delta that big saves little and a
+# signature of unrelated data would cost the most CPU
+MAX_LITERAL_FRACTION = 0.25
+
+# Message of the response to a delta write whose basis isn't the version of
+# the file anymore, the client sends the whole file instead
+BASIS_CHANGED = "file changed since its signature"
+
+
+def block_size_for(size):
+    block_size = int(math.sqrt(size)) & ~7
+    return min(max(block_size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+
+# Returns the signature of the contents of file, a stream with read
+def signature(file, size):
+    block_size = block_size_for(size)
+    entries = [SIGNATURE_HEADER.pack(block_size, (size + block_size - 1) // block_size)]
+    while True:
+        block = file.read(block_size)
+        if not block:
+            break
+        entries.append(SIGNATURE_ENTRY.pack(zlib.adler32(block), strong_checksum(block)))
+    return b"".join(entries)
+
+
+class Signature:
+    # A decoded signature, indexed by weak checksum
+    def __init__(self, data):
+        if len(data) < SIGNATURE_HEADER.size:
+            raise ValueError("truncated signature")
+        self.block_size, count = SIGNATURE_HEADER.unpack_from(data)
+        if self.block_size == 0 or \
+                len(data) != SIGNATURE_HEADER.size + count * SIGNATURE_ENTRY.size:
+            raise ValueError("bad signature")
+        # weak checksum -> {strong checksum: index of the first such block}
+        self.blocks = {}
+        for index in range(count):
+            weak, strong = SIGNATURE_ENTRY.unpack_from(
+                data, SIGNATURE_HEADER.size + index * SIGNATURE_ENTRY.size)
+            self.blocks.setdefault(weak, {}).setdefault(strong, index)
+        self.count = count
+
+
+# Returns the delta that turns the file of the signature into data. Where a
+# block matches, the next one is checked with a fresh adler32, so unchanged
+# runs cost a checksum per block. Only the bytes after a change are looked
+# at one by one until the blocks line up again
+# Returns None once more than max_literal bytes of data would be sent as
+# they are
+def make_delta(signature_data, data, max_literal=None):
+    signature = Signature(signature_data)
+    block_size = signature.block_size
+    blocks = signature.blocks
+    instructions = [DELTA_HEADER.pack(block_size, len(data))]
+    # pending copy of blocks first_block to first_block + copied
+    first_block = None
+    copied = 0
+    literal_start = 0
+    position = 0
+    weak = None
+    end = len(data) - block_size
+    if max_literal is None:
+        max_literal = len(data)
+    # the window may go this far past literal_start before there are too
+    # many new bytes
+    literal_limit = max_literal
+    while position <= end:
+        if weak is None:
+            weak = zlib.adler32(data[position:position + block_size])
+        candidates = blocks.get(weak)
+        index = None
+        if candidates is not None:
+            index = candidates.get(strong_checksum(data[position:position + block_size]))
+        if index is not None:
+            if literal_start < position:
+                add_copy(instructions, first_block, copied)
+                first_block = None
+                copied = 0
+                add_data(instructions, data[literal_start:position])
+                max_literal = max_literal - (position - literal_start)
+            if first_block is not None and first_block + copied == index:
+                copied = copied + 1
+            else:
+                add_copy(instructions, first_block, copied)
+                first_block = index
+                copied = 1
+            position = position + block_size
+            literal_start = position
+            literal_limit = literal_start + max_literal
+            weak = None
+            continue
+        if position == end:
+            break
+        if position > literal_limit:
+            return None
+        # roll the window a byte
+        removed = data[position]
+        added = data[position + block_size]
+        low = ((weak & 0xffff) - removed + added) % ADLER_MODULUS
+        high = ((weak >> 16) - block_size * removed + low - 1) % ADLER_MODULUS
+        weak = (high << 16) | low
+        position = position + 1
+    add_copy(instructions, first_block, copied)
+    if literal_start < len(data):
+        if len(data) - literal_start > max_literal:
+            return None
+        add_data(instructions, data[literal_start:])
+    return b"".join(instructions)
+
+
+def add_copy(instructions, first_block, count):
+    if count:
+        instructions.append(COPY + COPY_ENTRY.pack(first_block, count))
+
+
+def add_data(instructions, data):
+    for start in range(0, len(data), MAX_DATA_LENGTH):
+        part = data[start:start + MAX_DATA_LENGTH]
+        instructions.append(DATA + DATA_ENTRY.pack(len(part)) + part)
+
+
+# Yields the pieces of the new version of a file from the old one, basis, a
+# seekable stream, and a delta read from source, a stream with read. Raises
+# ValueError if the delta doesn't fit the basis
+def patch(basis, source):
+    block_size, length = DELTA_HEADER.unpack(read_exact(source, DELTA_HEADER.size))
+    produced = 0
+    while produced < length:
+        kind = read_exact(source, 1)
+        if kind == COPY:
+            first_block, count = COPY_ENTRY.unpack(read_exact(source, COPY_ENTRY.size))
+            basis.seek(first_block * block_size)
+            remaining = count * block_size
+            while remaining > 0:
+                piece = basis.read(min(remaining, MAX_DATA_LENGTH))
+                if not piece:
+                    break
+                remaining = remaining - len(piece)
+                produced = produced + len(piece)
+                yield piece
+        elif kind == DATA:
+            size, = DATA_ENTRY.unpack(read_exact(source, DATA_ENTRY.size))
+            produced = produced + size
+            yield read_exact(source, size)
+        else:
+            raise ValueError("bad delta instruction")
+    if produced != length:
+        raise ValueError("delta doesn't match its basis")
+
+
+# Applies a delta to the bytes of an old version, returns the new version
+def apply_delta(basis, delta_data):
+    return b"".join(patch(io.BytesIO(basis), io.BytesIO(delta_data)))
+
+
+class PatchedStream(io.RawIOBase):
+    # The new version of a file as a stream, built while it is read
+    def __init__(self, basis, source):
+        self.pieces = patch(basis, source)
+        self.piece = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.piece:
+            piece = next(self.pieces, None)
+            if piece is None:
+                return 0
+            self.piece = memoryview(piece)
+        count = min(len(buffer), len(self.piece))
+        buffer[:count] = self.piece[:count]
+        self.piece = self.piece[count:]
+        return count
+
+
+# Returns a buffered stream of the new version of a file, see patch
+def patched(basis, source):
+    return io.BufferedReader(PatchedStream(basis, source))
+
+
+def read_exact(source, size):
+    data = source.read(size)
+    if len(data) != size:
+        raise ValueError("delta ended early")
+    return data
+
+
+if __name__ == '__main__':
+    # Measures the bytes sent to update a file after a few small edits, and
+    # the time taken to make and apply the delta
+    import random
+    import sys
+    import time
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 16 * 1024 * 1024
+    generator = random.Random(1)
+    old = generator.randbytes(size)
+    new = bytearray(old)
+    for _ in range(5):
+        position = generator.randrange(size)
+        new[position:position + 100] = generator.randbytes(150)
+    new = bytes(new)
+    start = time.perf_counter()
+    old_signature = signature(io.BytesIO(old), len(old))
+    signed = time.perf_counter()
+    delta = make_delta(old_signature, new)
+    made = time.perf_counter()
+    assert apply_delta(old, delta) == new
+    applied = time.perf_counter()
+    print("file %d bytes, 5 edits" % len(new))
+    print("signature %d bytes in %.3fs, delta %d bytes in %.3fs, applied in %.3fs" % (
+        len(old_signature), signed - start, len(delta), made - signed, applied - made))
+    print("sent %d bytes instead of %d, %.0fx less" % (
+        len(old_signature) + len(delta), len(new),
+        len(new) / (len(old_signature) + len(delta))))
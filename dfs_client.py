@@ -0,0 +1,1277 @@
+import asyncio
+import cluster
+import collections
+import compression
+import delta
+import io
+import lock_manager
+import protocol
+import random
+import socket
+import tempfile
+import threading
+import time
+
+# Client library of the file system. Client talks to a server, or to the
+# storage nodes of a cluster, over pools of pipelined connections and
+# returns what requests answer instead of printing it. AsyncClient does the
+# same on an asyncio event loop. A request goes to the least busy
+# connection of its pool. A lost connection is opened again by the next
+# request, and requests that can safely run twice are sent again on it.
+# The changes of one path all go to the same connection, so the server
+# applies them in the order they were sent. Leases belong to a connection,
+# so the requests about a file the client locked go to the connection that
+# holds the lock. Paths are relative to the root, the client has no working
+# directory
+
+DEFAULT_ADDRESS = ('127.0.0.1', 8019)
+
+# Connections a pool opens at most, one more is opened whenever every open
+# one has requests in flight
+DEFAULT_POOL_SIZE = 4
+
+# Longest a connection takes to open
+CONNECT_TIMEOUT = 10.0
+
+# Files at least this big are sent as deltas in delta mode
+DELTA_THRESHOLD = 64 * 1024
+
+# Requests sent again on a new connection when theirs was lost before the
+# response came, running them twice changes nothing. Writes aren't: a delta
+# needs its basis and another client may have written since, the caller
+# gets ConnectionClosed and decides
+RETRIED_OPCODES = protocol.CONCURRENT_OPCODES
+
+# Commands about one file, sent to the node that owns it
+FILE_COMMANDS = frozenset(("read", "write", "append", "delete", "lock", "release",
+                           "renew", "stat", "signature", "chunks"))
+# Commands sent to every node of a cluster, the first node answers unless
+# another one fails
+MIRRORED_COMMANDS = frozenset(("mkdir", "rmdir", "KILL_SERVICE"))
+# Commands sent to every node of a cluster, each node answers
+GATHERED_COMMANDS = frozenset(("ls", "tree", "du", "find", "leases", "cachestats", "stats"))
+
+
+class DFSError(Exception):
+    # A request the server refused, with the status and message it answered
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+# An entry of a listing: its type, f or d, its size, its modification time
+# as the server formats it and its path from the directory listed
+Entry = collections.namedtuple("Entry", "type size modified path")
+
+# The type, size, modification time in nanoseconds and version tag of an
+# item
+Stat = collections.namedtuple("Stat", "type size mtime_ns tag")
+
+# Bytes below a directory, the files and directories there and the bytes
+# below each of its entries by name
+Usage = collections.namedtuple("Usage", "size files directories children")
+
+
+#
+# Requests and their results, for both clients
+#
+
+# Raises DFSError if a response isn't a success
+# Returns the response frame
+def checked(frame):
+    if frame.status != protocol.STATUS_OK:
+        raise DFSError(frame.status, frame.message)
+    return frame
+
+# Returns the entries of a streamed listing, the answer to ls, tree or find
+def listing(frame):
+    entries = []
+    for part in list(frame.parts) + [checked(frame)]:
+        for line in part.payload.read().decode(errors='replace').split("\n"):
+            fields = line.split("\t", 3)
+            if len(fields) == 4 and fields[0] in ("f", "d"):
+                entries.append(Entry(fields[0], int(fields[1]), fields[2], fields[3]))
+    return entries
+
+def stat_result(frame):
+    args = checked(frame).args
+    return Stat(args[2], int(args[3]), int(args[4]), args[5])
+
+def usage(frame):
+    lines = checked(frame).payload.read().decode(errors='replace').split("\n")
+    children = {}
+    for line in lines[1:-1]:
+        size, name = line.split("\t", 1)
+        children[name] = int(size)
+    words = frame.message.split()
+    return Usage(int(words[0]), int(words[3]), int(words[6]), children)
+
+# Returns the lines of name and value of leases or cachestats as a dict
+def counters(frame):
+    values = {}
+    for line in checked(frame).payload.read().decode(errors='replace').split("\n"):
+        if "\t" in line:
+            name, value = line.split("\t", 1)
+            try:
+                values[name] = int(value)
+            except ValueError:
+                values[name] = value
+    return values
+
+# Returns the arguments after the path of a read, of the whole file or of
+# length bytes from offset
+def read_args(offset, length):
+    if offset is None:
+        return []
+    return [offset, length]
+
+# Returns the arguments after the path of a lock
+def lock_args(mode, ttl, wait):
+    args = [mode] if mode is not None else []
+    if ttl is not None or wait is not None:
+        args.append(ttl if ttl is not None else lock_manager.DEFAULT_LEASE_TIME)
+    if wait is not None:
+        args.append(wait)
+    return args
+
+# Returns the key a path is cached and locked by
+def path_key(path):
+    return cluster.ring_key(path)
+
+
+#
+# Synchronous client
+#
+
+# Opens a pipelined connection to a server and agrees on a codec with it
+def open_connection(address, compress=True, on_invalidate=None):
+    sock = socket.create_connection(address, CONNECT_TIMEOUT)
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # idle pooled connections are kept, the OS notices a dead peer
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    connection = protocol.PipelinedConnection(sock, on_invalidate)
+    if compress:
+        try:
+            connection.negotiate()
+        except BaseException:
+            connection.close()
+            raise
+    return connection
+
+
+class ConnectionPool:
+    # Up to size pipelined connections to a server, each in a slot. They are
+    # opened when a request needs them and again once they are lost
+    def __init__(self, address, size=DEFAULT_POOL_SIZE, compress=True, on_invalidate=None):
+        self.address = address
+        self.size = max(size, 1)
+        self.compress = compress
+        self.on_invalidate = on_invalidate
+        self.lock = threading.Lock()
+        self.slots = [None] * self.size
+        self.reconnects = 0
+
+    # Returns the connection of a slot, opening it if it isn't open
+    def connection(self, slot):
+        with self.lock:
+            connection = self.slots[slot]
+        if connection is not None and connection.error is None:
+            return connection
+        opened = open_connection(self.address, self.compress, self.on_invalidate)
+        with self.lock:
+            connection = self.slots[slot]
+            if connection is not None and connection.error is None:
+                # another thread opened it meanwhile
+                opened.close()
+                return connection
+            if connection is not None:
+                connection.close()
+                self.reconnects = self.reconnects + 1
+            self.slots[slot] = opened
+            return opened
+
+    # Returns the slot whose connection has the fewest requests in flight.
+    # Slots not open count as idle after those that are, so connections are
+    # only added while all of them are busy
+    def least_busy(self):
+        with self.lock:
+            loads = [(len(connection.pending), slot) if connection is not None and
+                     connection.error is None else (0, self.size + slot)
+                     for slot, connection in enumerate(self.slots)]
+        return min(loads)[1] % self.size
+
+    # Returns the slot the changes of a path go to
+    def slot_for(self, key):
+        return cluster.hash_key(key) % self.size
+
+    # Closes a connection found broken, the next request of its slot opens
+    # another
+    def discard(self, slot, connection):
+        connection.close()
+        with self.lock:
+            if self.slots[slot] is connection:
+                self.slots[slot] = None
+                self.reconnects = self.reconnects + 1
+
+    def stats(self):
+        with self.lock:
+            open_connections = sum(1 for connection in self.slots
+                                   if connection is not None and connection.error is None)
+            return {"connections": open_connections, "reconnects": self.reconnects}
+
+    def close(self):
+        with self.lock:
+            connections, self.slots = self.slots, [None] * self.size
+        for connection in connections:
+            if connection is not None:
+                connection.close()
+
+
+class ClientCache:
+    # LRU cache of whole files read from the server, bounded by a number of
+    # entries and of bytes. Entries are keyed by path from the root. Entries
+    # the server holds a callback for are served until the server says the
+    # file changed. Others are served for cache_time seconds, then
+    # revalidated with a conditional read that only transfers the file if
+    # its version changed
+    def __init__(self, max_entries=256, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # path -> CacheEntry, least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    # Returns the entry of path or None
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+            return entry
+
+    def put(self, path, contents, tag, callback=False):
+        if len(contents) > self.max_bytes:
+            self.invalidate(path)
+            return
+        with self.lock:
+            self.remove_locked(path)
+            self.entries[path] = CacheEntry(contents, tag, callback)
+            self.size = self.size + len(contents)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.remove_locked(next(iter(self.entries)))
+
+    # Marks an entry the server reported unchanged as fresh again, returns
+    # it or None if it was dropped meanwhile
+    def refresh(self, path, tag, callback=False):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry.tag != tag:
+                return None
+            entry.fetched = time.monotonic()
+            entry.callback = callback
+            return entry
+
+    # Marks an entry stale so its next read revalidates it, entries smaller
+    # than min_size are dropped
+    def expire(self, path, min_size):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return
+            if len(entry.contents) < min_size:
+                self.remove_locked(path)
+                return
+            entry.callback = False
+            entry.fetched = float('-inf')
+
+    def remove_locked(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size = self.size - len(entry.contents)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.remove_locked(path)
+
+    # Drops every entry below a directory
+    def invalidate_tree(self, directory):
+        prefix = directory.rstrip("/") + "/"
+        with self.lock:
+            for path in [path for path in self.entries if path.startswith(prefix)]:
+                self.remove_locked(path)
+
+    # Returns (path, entry) pairs, least recently used first
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CacheEntry:
+    # A file read from the server, with the version tag the server sent.
+    # callback is set when the server will say if the file changes
+    def __init__(self, contents, tag, callback=False):
+        self.contents = contents
+        self.tag = tag
+        self.callback = callback
+        self.fetched = time.monotonic()
+
+    # Checks whether the entry can be used without asking the server
+    def is_fresh(self, max_age):
+        return self.callback or time.monotonic() - self.fetched < max_age
+
+
+class Client:
+    # Client of the server at address, or of the storage nodes of the
+    # cluster whose directory server is at directory, host:port, with a
+    # pool of pool_size connections to each. Files read are kept in cache, a
+    # ClientCache, if given: for cache_time seconds or, when the server holds
+    # a callback, until it says they changed. With delta_mode files of
+    # DELTA_THRESHOLD bytes or more are written and refreshed as deltas.
+    # Requests wait timeout seconds at most for their response
+    def __init__(self, address=DEFAULT_ADDRESS, pool_size=DEFAULT_POOL_SIZE, directory=None,
+                 cache=None, cache_time=2.0, delta_mode=False, compress=True, timeout=None):
+        self.cache = cache
+        self.cache_time = cache_time
+        self.delta_mode = delta_mode
+        self.timeout = timeout
+        self.state_lock = threading.Lock()
+        # path -> (node, connection) holding a lock on it
+        self.locks = {}
+        # path -> reads in flight, each a list whose item is set if the file
+        # changes before the read is answered, its contents aren't cached
+        self.reading = {}
+        # path -> sequence number of the latest change seen, when the
+        # cluster keeps several copies of each file
+        self.versions = {}
+        # node address, or None for a single server -> ConnectionPool
+        self.pools = collections.OrderedDict()
+        self.ring = None
+        self.copies = 1
+        if directory is None:
+            self.pools[None] = ConnectionPool(address, pool_size, compress,
+                                              self.invalidation_received)
+            return
+        epoch, nodes, self.copies = cluster.fetch_nodes(directory)
+        if not nodes:
+            raise DFSError(protocol.STATUS_FAILED,
+                           "the cluster of %s has no storage nodes" % directory)
+        self.ring = cluster.HashRing(nodes)
+        for node in nodes:
+            self.pools[node] = ConnectionPool(cluster.parse_address(node), pool_size,
+                                              compress, self.invalidation_received)
+
+    #
+    # Files
+    #
+
+    # Reads a file, or length bytes of it from offset, from the cache when it
+    # holds a fresh copy. If the cached copy the read relied on goes away
+    # while it is in flight it is tried once more, then read without the
+    # cache
+    # Raises DFSError if the file can't be read
+    # Returns the contents
+    def read(self, path, offset=None, length=None):
+        for _ in range(2):
+            contents = self.cached_read(path, offset, length)
+            if contents is not None:
+                return contents
+        return checked(self.call(protocol.OP_READ, path, read_args(offset, length))).payload.read()
+
+    # Reads a file through the cache
+    # Returns the contents, or None if the cached copy the read relied on
+    # went away
+    def cached_read(self, path, offset, length):
+        key = path_key(path)
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.get(key)
+            if entry is not None and entry.is_fresh(self.cache_time):
+                return cached_range(entry, offset, length)
+        args = read_args(offset, length)
+        payload = b''
+        flags = 0
+        if self.cache is not None and offset is None:
+            flags = protocol.FLAG_CALLBACK
+        if entry is not None:
+            args.append(entry.tag)
+            flags = flags | protocol.FLAG_CONDITIONAL
+            if self.delta_mode and offset is None and \
+                    len(entry.contents) >= DELTA_THRESHOLD:
+                # if the file changed, only the changes are sent back
+                payload = delta.signature(io.BytesIO(entry.contents), len(entry.contents))
+                flags = flags | protocol.FLAG_DELTA
+        reading = [False]
+        with self.state_lock:
+            self.reading.setdefault(key, []).append(reading)
+        try:
+            frame = self.call(protocol.OP_READ, path, args, payload, flags)
+        finally:
+            with self.state_lock:
+                self.reading[key].remove(reading)
+                if not self.reading[key]:
+                    del self.reading[key]
+        if self.cache is None:
+            return checked(frame).payload.read()
+        return self.cache_response(path, offset, length, key, frame, entry, reading[0])
+
+    # Updates the cache with the response to a read
+    # Returns the contents read, or None if the copy the response refers to
+    # went away
+    def cache_response(self, path, offset, length, key, frame, entry, changed):
+        callback = bool(frame.flags & protocol.FLAG_CALLBACK)
+        if frame.status == protocol.STATUS_NOT_MODIFIED:
+            entry = self.cache.refresh(key, frame.args[2], callback)
+            if entry is None:
+                # evicted or invalidated while the read was in flight
+                return None
+            return cached_range(entry, offset, length)
+        if frame.status != protocol.STATUS_OK:
+            self.cache.invalidate(key)
+            raise DFSError(frame.status, frame.message)
+        contents = frame.payload.read()
+        if frame.flags & protocol.FLAG_DELTA:
+            current = self.cache.get(key)
+            if current is not entry:
+                # the copy the delta applies to is gone
+                self.cache.invalidate(key)
+                return None
+            contents = delta.apply_delta(entry.contents, contents)
+        if offset is not None:
+            # a ranged read only updates the cache by showing the copy is stale
+            current = self.cache.get(key)
+            if current is not None and current.tag != frame.args[2]:
+                self.cache.invalidate(key)
+        elif not changed:
+            self.cache.put(key, contents, frame.args[2], callback)
+        return contents
+
+    # Replaces a file with data, bytes or a protocol.FileRegion, or writes
+    # data at offset leaving the rest of the file as it is
+    # Raises DFSError if the server refuses the write
+    # Returns the server's message
+    def write(self, path, data, offset=None):
+        key = path_key(path)
+        self.changed(key)
+        try:
+            if offset is not None:
+                frame = self.call(protocol.OP_WRITE, path, [offset], data)
+            elif self.delta_mode and isinstance(data, (bytes, bytearray)) and \
+                    len(data) >= DELTA_THRESHOLD:
+                frame = self.write_delta(path, data)
+            else:
+                frame = self.call(protocol.OP_WRITE, path, (), data)
+        finally:
+            # a read answered before the change may have cached the old contents
+            self.changed(key)
+        return checked(frame).message
+
+    # Writes a file as a delta against the server's version of it, or whole
+    # if the server has none or it changed since its signature was sent
+    def write_delta(self, path, data):
+        frame = self.call(protocol.OP_SIGNATURE, path)
+        if frame.status == protocol.STATUS_OK:
+            patch = delta.make_delta(frame.payload.read(), data)
+            frame = self.call(protocol.OP_WRITE, path, [frame.args[2]], patch,
+                              protocol.FLAG_DELTA)
+            if frame.message != delta.BASIS_CHANGED:
+                return frame
+        return self.call(protocol.OP_WRITE, path, (), data)
+
+    def append(self, path, data):
+        return self.change(protocol.OP_APPEND, path, (), data)
+
+    def delete(self, path):
+        return self.change(protocol.OP_DELETE, path)
+
+    def stat(self, path):
+        return stat_result(self.call(protocol.OP_STAT, path))
+
+    # Reads several files at once, spread over the connections without
+    # going through the cache
+    # Raises DFSError if one of them can't be read
+    # Returns their contents in the order of paths
+    def read_many(self, paths):
+        futures = [self.submit(protocol.OP_READ, path) for path in paths]
+        return [checked(future.result(self.timeout)).payload.read() for future in futures]
+
+    #
+    # Locks
+    #
+
+    # Locks a file, see the lock command. The requests about it go to the
+    # connection holding the lock until it is released
+    # Returns the server's message
+    def lock(self, path, mode=None, ttl=None, wait=None):
+        key = path_key(path)
+        for node in self.nodes_for(path):
+            try:
+                pool = self.pools[node]
+                connection = pool.connection(pool.slot_for(key))
+                break
+            except OSError:
+                continue
+        else:
+            raise protocol.ConnectionClosed("no copy of %s can be reached" % path)
+        frame = checked(connection.request(protocol.OP_LOCK, [path] + lock_args(mode, ttl, wait),
+                                           timeout=self.timeout))
+        with self.state_lock:
+            self.locks[key] = (node, connection)
+        return frame.message
+
+    def release(self, path):
+        try:
+            return self.change(protocol.OP_RELEASE, path)
+        finally:
+            with self.state_lock:
+                self.locks.pop(path_key(path), None)
+
+    def renew(self, path, ttl=None):
+        args = [ttl] if ttl is not None else []
+        return self.change(protocol.OP_RENEW, path, args)
+
+    #
+    # Directories
+    #
+
+    def ls(self, path=""):
+        return self.gather_listing(protocol.OP_LS, [path] if path else [])
+
+    def tree(self, path=""):
+        return self.gather_listing(protocol.OP_TREE, [path] if path else [])
+
+    def find(self, pattern, path=""):
+        return self.gather_listing(protocol.OP_FIND, [pattern, path] if path else [pattern])
+
+    # Lists a directory on every node, directories and the copies of a
+    # file are on several of them
+    def gather_listing(self, opcode, args):
+        entries = []
+        seen = set()
+        for node, frame in self.broadcast(opcode, args):
+            for entry in listing(frame):
+                if entry.path not in seen:
+                    seen.add(entry.path)
+                    entries.append(entry)
+        return entries
+
+    # Returns the bytes used below a directory, on every node of a cluster
+    # with the copies of files counted each time
+    def du(self, path=""):
+        results = [usage(frame) for node, frame in
+                   self.broadcast(protocol.OP_DU, [path] if path else [])]
+        children = collections.Counter()
+        for result in results:
+            children.update(result.children)
+        return Usage(sum(result.size for result in results),
+                     sum(result.files for result in results),
+                     results[0].directories, dict(children))
+
+    def mkdir(self, path):
+        return self.mirror(protocol.OP_MKDIR, [path])
+
+    def rmdir(self, path):
+        self.changed(path_key(path), True)
+        return self.mirror(protocol.OP_RMDIR, [path])
+
+    # Sends a change to every node, directories exist on all of them
+    # Raises DFSError if a node refuses it
+    # Returns the first node's message
+    def mirror(self, opcode, args):
+        results = self.broadcast(opcode, args)
+        for node, frame in results:
+            checked(frame)
+        return results[0][1].message
+
+    # Copies a file or directory tree on the server. In a cluster a file
+    # that belongs on another node, or whose copies are on several nodes, is
+    # read and written through the client. Directories are copied on the
+    # first node
+    def copy(self, source, destination):
+        return self.copy_or_move(protocol.OP_COPY, source, destination)
+
+    def move(self, source, destination):
+        return self.copy_or_move(protocol.OP_MOVE, source, destination)
+
+    def copy_or_move(self, opcode, source, destination):
+        for path in (source, destination):
+            self.changed(path_key(path), True)
+        if self.ring is None or (self.copies == 1 and self.nodes_for(source)[0] ==
+                                 self.nodes_for(destination)[0]) or self.stat(source).type != "f":
+            return self.change(opcode, source, [destination])
+        contents = checked(self.call(protocol.OP_READ, source)).payload.read()
+        checked(self.call(protocol.OP_WRITE, destination, (), contents))
+        if opcode == protocol.OP_MOVE:
+            self.delete(source)
+            return "%s moved to %s" % (source, destination)
+        return "%s copied to %s" % (source, destination)
+
+    #
+    # Server state
+    #
+
+    # Returns the leases held on the server, summed over the nodes
+    def leases(self):
+        return self.gather_counters(protocol.OP_LEASES)
+
+    # Returns the cache and storage counters of the server, summed over the
+    # nodes
+    def cachestats(self):
+        return self.gather_counters(protocol.OP_CACHE_STATS)
+
+    def gather_counters(self, opcode):
+        values = {}
+        for node, frame in self.broadcast(opcode):
+            for name, value in counters(frame).items():
+                if isinstance(value, int) and isinstance(values.get(name, 0), int):
+                    values[name] = values.get(name, 0) + value
+                else:
+                    values.setdefault(name, value)
+        return values
+
+    # Returns the nodes of the cluster, or [] for a single server
+    def nodes(self):
+        if self.ring is None:
+            return []
+        return sorted(self.ring.nodes)
+
+    # Returns the node a file lives on, None for a single server
+    def locate(self, path):
+        return self.nodes_for(path)[0]
+
+    # Returns the counters of the connection pools
+    def stats(self):
+        values = collections.Counter()
+        for pool in self.pools.values():
+            values.update(pool.stats())
+        return dict(values)
+
+    #
+    # Sending requests
+    #
+
+    # Sends a command by name, routed like the commands of its kind
+    # Returns [(node, response frame)], a frame for each node answering in
+    # a cluster when one answer isn't enough
+    def request(self, command, args=(), payload=b'', flags=0):
+        opcode = protocol.COMMANDS.get(command, protocol.OP_UNKNOWN)
+        args = list(args)
+        if command in FILE_COMMANDS and args:
+            if command in ("write", "append", "delete"):
+                self.changed(path_key(args[0]))
+            return [(self.locate(args[0]),
+                     self.call(opcode, args[0], args[1:], payload, flags))]
+        if self.ring is not None and command in GATHERED_COMMANDS:
+            return self.broadcast(opcode, args, payload)
+        if self.ring is not None and command in MIRRORED_COMMANDS:
+            results = self.broadcast(opcode, args, payload)
+            return results[:1] + [(node, frame) for node, frame in results[1:]
+                                  if frame.status != protocol.STATUS_OK]
+        if command in ("rmdir", "copy", "move"):
+            for path in args:
+                self.changed(path_key(path), True)
+        node = next(iter(self.pools))
+        return [(node, self.send_to([node], "", opcode, args, payload, flags))]
+
+    # Sends a request about the file at path and waits for its response.
+    # Changes go to the first copy that is up, reads to a random one
+    # Raises ConnectionClosed if no copy can be reached
+    def call(self, opcode, path, args=(), payload=b'', flags=0):
+        nodes = self.nodes_for(path, opcode in protocol.CONCURRENT_OPCODES)
+        args = [path] + list(args)
+        key = path_key(path)
+        if opcode == protocol.OP_READ and self.copies > 1:
+            with self.state_lock:
+                least = self.versions.get(key, 0)
+            args.append(least)
+            flags = flags | protocol.FLAG_VERSIONED
+        frame = self.send_to(nodes, key, opcode, args, payload, flags)
+        if opcode in cluster.CHANGE_OPCODES and frame.status == protocol.STATUS_OK and \
+                len(frame.args) > 2:
+            with self.state_lock:
+                self.versions[key] = int(frame.args[2])
+        return frame
+
+    # Sends a change and checks it succeeded
+    # Returns the server's message
+    def change(self, opcode, path, args=(), payload=b''):
+        key = path_key(path)
+        self.changed(key)
+        try:
+            return checked(self.call(opcode, path, args, payload)).message
+        finally:
+            self.changed(key)
+
+    # Sends a request about the file at path without waiting for it
+    # Returns a concurrent.futures.Future of the response frame
+    def submit(self, opcode, path, args=(), payload=b'', flags=0):
+        key = path_key(path)
+        node, connection = self.pinned(key)
+        if connection is None:
+            changes = opcode not in protocol.CONCURRENT_OPCODES
+            node = self.nodes_for(path, not changes)[0]
+            pool = self.pools[node]
+            slot = pool.slot_for(key) if changes else pool.least_busy()
+            connection = pool.connection(slot)
+        return connection.submit(opcode, [path] + list(args), payload, flags)
+
+    # Sends a request to the first of nodes that answers, on the connection
+    # of the lock held on key or of changes to key, or the least busy one
+    # Returns the response frame
+    def send_to(self, nodes, key, opcode, args, payload, flags):
+        pinned_node, pinned = self.pinned(key)
+        changes = opcode not in protocol.CONCURRENT_OPCODES
+        stale = None
+        for node in nodes:
+            if pinned is not None and node == pinned_node:
+                try:
+                    return pinned.request(opcode, args, payload, flags, self.timeout)
+                except protocol.ConnectionClosed:
+                    # the server dropped the lock along with the connection
+                    with self.state_lock:
+                        self.locks.pop(key, None)
+                    raise
+            pool = self.pools[node]
+            slot = pool.slot_for(key) if changes else pool.least_busy()
+            try:
+                frame = self.send(pool, slot, opcode, args, payload, flags)
+            except (protocol.ConnectionClosed, OSError):
+                continue
+            if frame.status == protocol.STATUS_FAILED and frame.message == cluster.STALE_REPLICA:
+                stale = frame
+                continue
+            return frame
+        if stale is not None:
+            return stale
+        raise protocol.ConnectionClosed("no server can be reached for %s" % (key or "the request"))
+
+    # Sends a request on a slot of a pool and waits for its response. A
+    # request the connection was lost before sending is sent on a new one,
+    # and so is a request lost after if it is safe to run twice
+    def send(self, pool, slot, opcode, args, payload, flags):
+        connection = pool.connection(slot)
+        try:
+            future = connection.submit(opcode, args, payload, flags)
+        except (protocol.ConnectionClosed, OSError):
+            pool.discard(slot, connection)
+            future = pool.connection(slot).submit(opcode, args, payload, flags)
+        try:
+            return future.result(self.timeout)
+        except protocol.ConnectionClosed:
+            if opcode not in RETRIED_OPCODES:
+                raise
+        return pool.connection(slot).request(opcode, args, payload, flags, self.timeout)
+
+    # Sends a request to every node that is up
+    # Returns [(node, response frame)]
+    def broadcast(self, opcode, args=(), payload=b''):
+        futures = []
+        for node, pool in self.pools.items():
+            try:
+                connection = pool.connection(pool.least_busy())
+                futures.append((node, connection.submit(opcode, args, payload)))
+            except (protocol.ConnectionClosed, OSError):
+                continue
+        results = []
+        for node, future in futures:
+            try:
+                results.append((node, future.result(self.timeout)))
+            except protocol.ConnectionClosed:
+                continue
+        if not results:
+            raise protocol.ConnectionClosed("no server can be reached")
+        return results
+
+    # Returns the nodes that may answer a request about path in the order
+    # to try them, shuffled with spread
+    def nodes_for(self, path, spread=False):
+        if self.ring is None:
+            return [None]
+        nodes = self.ring.nodes_for(path_key(path), self.copies)
+        if spread:
+            random.shuffle(nodes)
+        return nodes
+
+    # Returns (node, connection) holding a lock on key, or (None, None)
+    def pinned(self, key):
+        with self.state_lock:
+            node, connection = self.locks.get(key, (None, None))
+        if connection is not None and connection.error is not None:
+            with self.state_lock:
+                self.locks.pop(key, None)
+            return (None, None)
+        return (node, connection)
+
+    #
+    # Cache
+    #
+
+    # Drops a path changed by this client from the cache, along with the
+    # contents of reads of it in flight
+    def changed(self, key, tree=False):
+        if self.cache is None:
+            return
+        if tree:
+            self.cache.invalidate_tree(key)
+        self.cache.invalidate(key)
+        with self.state_lock:
+            for reading in self.reading.get(key, ()):
+                reading[0] = True
+
+    # Drops a file the server said changed from the cache, along with the
+    # contents of reads of it in flight
+    def invalidation_received(self, path):
+        if self.cache is None:
+            return
+        key = path_key(path)
+        if self.delta_mode:
+            # big files are kept so their next read only fetches the changes
+            self.cache.expire(key, DELTA_THRESHOLD)
+        else:
+            self.cache.invalidate(key)
+        with self.state_lock:
+            for reading in self.reading.get(key, ()):
+                reading[0] = True
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.close()
+
+
+# Returns the contents of a cache entry, or length bytes from offset
+def cached_range(entry, offset, length):
+    if offset is None:
+        return entry.contents
+    return entry.contents[int(offset):int(offset) + int(length)]
+
+
+#
+# asyncio client
+#
+
+class AsyncConnection:
+    # Pipelined connection on an asyncio event loop, as
+    # protocol.PipelinedConnection: any number of requests in flight, a task
+    # reads the responses and completes their futures. Requests are queued
+    # and written in order by another task, which streams file regions
+    # instead of reading them into memory
+    def __init__(self, reader, writer, on_invalidate=None):
+        self.reader = reader
+        self.writer = writer
+        self.on_invalidate = on_invalidate
+        # request id -> Future of the response
+        self.pending = {}
+        # request id -> frames received so far of a streamed response
+        self.parts = {}
+        self.next_request_id = 0
+        # set once the connection is closed
+        self.error = None
+        self.codec = None
+        # (opcode, request id, args, payload, flags) not written yet, None
+        # once the connection failed
+        self.outgoing = asyncio.Queue()
+        self.reader_task = asyncio.ensure_future(self.run_reader())
+        self.writer_task = asyncio.ensure_future(self.run_writer())
+
+    # Sends a request
+    # Returns an asyncio.Future of the response frame
+    def submit(self, opcode, args=(), payload=b'', flags=0):
+        if self.error is not None:
+            raise self.error
+        # arguments too long are refused here rather than by the writer
+        protocol.encode_args(args)
+        payload, compressed = protocol.compress_payload(self.codec, payload)
+        self.next_request_id = self.next_request_id % 0xFFFFFFFF + 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_request_id] = future
+        self.outgoing.put_nowait((opcode, self.next_request_id, args, payload,
+                                  flags | compressed))
+        return future
+
+    async def request(self, opcode, args=(), payload=b'', flags=0):
+        return await self.sent(self.submit(opcode, args, payload, flags))
+
+    # Waits for the response to a request
+    async def sent(self, future):
+        return await future
+
+    async def run_writer(self):
+        try:
+            while True:
+                request = await self.outgoing.get()
+                if request is None:
+                    return
+                opcode, request_id, args, payload, flags = request
+                try:
+                    await protocol.send_frame_async(self.writer, opcode, request_id, args,
+                                                    payload, flags)
+                finally:
+                    protocol.close_compressed(payload, flags & protocol.FLAG_COMPRESSED)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.fail(protocol.ConnectionClosed(str(e) or type(e).__name__))
+
+    # Reads a payload into memory, or into a temporary file if it is big
+    async def read_payload(self, length):
+        if length <= protocol.SPOOL_MEMORY_LIMIT:
+            return protocol.payload_from_bytes(await self.reader.readexactly(length))
+        loop = asyncio.get_running_loop()
+        spool = tempfile.TemporaryFile()
+        try:
+            remaining = length
+            while remaining > 0:
+                chunk = await self.reader.read(min(protocol.CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                await loop.run_in_executor(None, spool.write, chunk)
+                remaining = remaining - len(chunk)
+            spool.seek(0)
+        except BaseException:
+            spool.close()
+            raise
+        payload = protocol.PayloadReader(spool, length)
+        payload.spool = spool
+        return payload
+
+    async def negotiate(self, names=None):
+        if names is None:
+            names = compression.offered()
+        await self.request(protocol.OP_HELLO, names)
+        return self.codec
+
+    async def run_reader(self):
+        try:
+            while True:
+                opcode, flags, arg_length, request_id, length = protocol.parse_header(
+                    await self.reader.readexactly(protocol.HEADER.size))
+                args = protocol.decode_args(await self.reader.readexactly(arg_length))
+                payload = await self.read_payload(length)
+                frame = protocol.Frame(opcode, flags, request_id, args, payload)
+                if frame.flags & protocol.FLAG_COMPRESSED:
+                    protocol.decompress_frame(self.codec, frame)
+                if frame.opcode == protocol.OP_HELLO and frame.status == protocol.STATUS_OK:
+                    self.codec = compression.find(frame.message)
+                if frame.opcode == protocol.OP_EXIT and frame.request_id == 0:
+                    # the server refused the connection
+                    self.fail(protocol.ConnectionClosed(frame.message))
+                    return
+                if frame.opcode == protocol.OP_INVALIDATE:
+                    if self.on_invalidate is not None:
+                        self.on_invalidate(frame.args[0])
+                    continue
+                if frame.flags & protocol.FLAG_MORE:
+                    self.parts.setdefault(frame.request_id, []).append(frame)
+                    continue
+                frame.parts = self.parts.pop(frame.request_id, [])
+                future = self.pending.pop(frame.request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        except asyncio.CancelledError:
+            self.fail(protocol.ConnectionClosed("connection closed"))
+            raise
+        except Exception as e:
+            # whatever stopped the reader, a malformed response included, no
+            # response can come any more
+            self.fail(protocol.ConnectionClosed(str(e) or type(e).__name__))
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+            self.outgoing.put_nowait(None)
+        self.writer.close()
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(self.error)
+
+    def close(self):
+        self.writer.close()
+        self.reader_task.cancel()
+        self.writer_task.cancel()
+
+
+async def open_async_connection(address, compress=True, on_invalidate=None):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*address),
+                                            CONNECT_TIMEOUT)
+    sock = writer.get_extra_info('socket')
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    connection = AsyncConnection(reader, writer, on_invalidate)
+    if compress:
+        try:
+            await connection.negotiate()
+        except BaseException:
+            connection.close()
+            raise
+    return connection
+
+
+class AsyncConnectionPool:
+    # ConnectionPool of AsyncConnections
+    def __init__(self, address, size=DEFAULT_POOL_SIZE, compress=True):
+        self.address = address
+        self.size = max(size, 1)
+        self.compress = compress
+        self.slots = [None] * self.size
+        # a slot is opened by one task at a time
+        self.opening = [asyncio.Lock() for _ in range(self.size)]
+        self.reconnects = 0
+
+    async def connection(self, slot):
+        async with self.opening[slot]:
+            connection = self.slots[slot]
+            if connection is not None and connection.error is None:
+                return connection
+            opened = await open_async_connection(self.address, self.compress)
+            if connection is not None:
+                connection.close()
+                self.reconnects = self.reconnects + 1
+            self.slots[slot] = opened
+            return opened
+
+    def least_busy(self):
+        loads = [(len(connection.pending), slot) if connection is not None and
+                 connection.error is None else (0, self.size + slot)
+                 for slot, connection in enumerate(self.slots)]
+        return min(loads)[1] % self.size
+
+    def slot_for(self, key):
+        return cluster.hash_key(key) % self.size
+
+    def stats(self):
+        open_connections = sum(1 for connection in self.slots
+                               if connection is not None and connection.error is None)
+        return {"connections": open_connections, "reconnects": self.reconnects}
+
+    def close(self):
+        connections, self.slots = self.slots, [None] * self.size
+        for connection in connections:
+            if connection is not None:
+                connection.close()
+
+
+class AsyncClient:
+    # Client of the server at address for asyncio programs, with a pool of
+    # pool_size connections. It has the methods of Client as coroutines,
+    # without a cache and without clusters
+    def __init__(self, address=DEFAULT_ADDRESS, pool_size=DEFAULT_POOL_SIZE, compress=True,
+                 timeout=None):
+        self.pool = AsyncConnectionPool(address, pool_size, compress)
+        self.timeout = timeout
+        # path -> connection holding a lock on it
+        self.locks = {}
+
+    async def read(self, path, offset=None, length=None):
+        frame = await self.call(protocol.OP_READ, path, read_args(offset, length))
+        return checked(frame).payload.read()
+
+    async def write(self, path, data, offset=None):
+        args = [offset] if offset is not None else []
+        return checked(await self.call(protocol.OP_WRITE, path, args, data)).message
+
+    async def append(self, path, data):
+        return checked(await self.call(protocol.OP_APPEND, path, (), data)).message
+
+    async def delete(self, path):
+        return checked(await self.call(protocol.OP_DELETE, path)).message
+
+    async def stat(self, path):
+        return stat_result(await self.call(protocol.OP_STAT, path))
+
+    # Reads several files at once, see Client.read_many
+    async def read_many(self, paths):
+        return await asyncio.gather(*[self.read(path) for path in paths])
+
+    async def lock(self, path, mode=None, ttl=None, wait=None):
+        key = path_key(path)
+        connection = await self.pool.connection(self.pool.slot_for(key))
+        frame = checked(await self.wait(connection.request(
+            protocol.OP_LOCK, [path] + lock_args(mode, ttl, wait))))
+        self.locks[key] = connection
+        return frame.message
+
+    async def release(self, path):
+        try:
+            return checked(await self.call(protocol.OP_RELEASE, path)).message
+        finally:
+            self.locks.pop(path_key(path), None)
+
+    async def renew(self, path, ttl=None):
+        args = [ttl] if ttl is not None else []
+        return checked(await self.call(protocol.OP_RENEW, path, args)).message
+
+    async def ls(self, path=""):
+        return listing(await self.send(protocol.OP_LS, [path] if path else []))
+
+    async def tree(self, path=""):
+        return listing(await self.send(protocol.OP_TREE, [path] if path else []))
+
+    async def find(self, pattern, path=""):
+        return listing(await self.send(protocol.OP_FIND, [pattern, path] if path else [pattern]))
+
+    async def du(self, path=""):
+        return usage(await self.send(protocol.OP_DU, [path] if path else []))
+
+    async def mkdir(self, path):
+        return checked(await self.send(protocol.OP_MKDIR, [path])).message
+
+    async def rmdir(self, path):
+        return checked(await self.send(protocol.OP_RMDIR, [path])).message
+
+    async def copy(self, source, destination):
+        return checked(await self.call(protocol.OP_COPY, source, [destination])).message
+
+    async def move(self, source, destination):
+        return checked(await self.call(protocol.OP_MOVE, source, [destination])).message
+
+    async def leases(self):
+        return counters(await self.send(protocol.OP_LEASES))
+
+    async def cachestats(self):
+        return counters(await self.send(protocol.OP_CACHE_STATS))
+
+    def stats(self):
+        return self.pool.stats()
+
+    # Sends a command by name
+    # Returns the response frame
+    async def request(self, command, args=(), payload=b'', flags=0):
+        opcode = protocol.COMMANDS.get(command, protocol.OP_UNKNOWN)
+        if command in FILE_COMMANDS and args:
+            return await self.call(opcode, args[0], list(args)[1:], payload, flags)
+        return await self.send(opcode, list(args), payload, flags)
+
+    # Sends a request about the file at path, on the connection holding its
+    # lock or of changes to it, or the least busy one
+    async def call(self, opcode, path, args=(), payload=b'', flags=0):
+        key = path_key(path)
+        args = [path] + list(args)
+        connection = self.locks.get(key)
+        if connection is not None:
+            if connection.error is None:
+                return await self.wait(connection.request(opcode, args, payload, flags))
+            # the server dropped the lock along with the connection
+            del self.locks[key]
+        return await self.send(opcode, args, payload, flags, key)
+
+    # Sends a request on a connection of the pool, again on a new connection
+    # if it was lost and the request is safe to run twice
+    async def send(self, opcode, args=(), payload=b'', flags=0, key=""):
+        if opcode in protocol.CONCURRENT_OPCODES:
+            slot = self.pool.least_busy()
+        else:
+            slot = self.pool.slot_for(key)
+        connection = await self.pool.connection(slot)
+        try:
+            future = connection.submit(opcode, args, payload, flags)
+        except protocol.ConnectionClosed:
+            # lost while idle, the request wasn't sent
+            connection = await self.pool.connection(slot)
+            future = connection.submit(opcode, args, payload, flags)
+        try:
+            return await self.wait(connection.sent(future))
+        except protocol.ConnectionClosed:
+            if opcode not in RETRIED_OPCODES:
+                raise
+        connection = await self.pool.connection(slot)
+        return await self.wait(connection.request(opcode, args, payload, flags))
+
+    async def wait(self, awaitable):
+        if self.timeout is None:
+            return await awaitable
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+    def close(self):
+        self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, error_type, error, traceback):
+        self.close()
+
+
+if __name__ == '__main__':
+    # Starts a server and measures the reads of small files a set of
+    # threads, then of coroutines, gets through with pools of 1 to 8
+    # connections. One connection is what a client had before the pool
+    import os
+    import subprocess
+    import sys
+    import tempfile
+
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    port = 9700
+    here = os.path.dirname(os.path.abspath(__file__))
+    contents = os.urandom(4096)
+    files = ["f%d.bin" % index for index in range(64)]
+
+    def run_threads(client):
+        counts = [0] * clients
+        deadline = time.monotonic() + duration
+
+        def run(index):
+            done = 0
+            while time.monotonic() < deadline:
+                client.read(files[(index + done) % len(files)])
+                done = done + 1
+            counts[index] = done
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(counts) / duration
+
+    async def run_tasks(pool_size):
+        async with AsyncClient(('127.0.0.1', port), pool_size) as client:
+            counts = [0] * clients
+            deadline = time.monotonic() + duration
+
+            async def run(index):
+                done = 0
+                while time.monotonic() < deadline:
+                    await client.read(files[(index + done) % len(files)])
+                    done = done + 1
+                counts[index] = done
+
+            await asyncio.gather(*[run(index) for index in range(clients)])
+            return sum(counts) / duration
+
+    with tempfile.TemporaryDirectory() as root:
+        server = subprocess.Popen([sys.executable, os.path.join(here, "ser.py"), "--quiet",
+                                   "--port", str(port), "--root", root],
+                                  stdout=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            with Client(('127.0.0.1', port)) as client:
+                for name in files:
+                    client.write(name, contents)
+            for pool_size in (1, 2, 4, 8):
+                with Client(('127.0.0.1', port), pool_size) as client:
+                    threaded = run_threads(client)
+                tasks = asyncio.run(run_tasks(pool_size))
+                print("%d connections: %6.0f reads/s from %d threads, %6.0f reads/s "
+                      "from %d coroutines" % (pool_size, threaded, clients, tasks, clients))
+        finally:
+            server.kill()
+            server.wait()
@@ -0,0 +1,163 @@
+import argparse
+import cluster
+import os
+import protocol
+import socket
+import threading
+import threadpool
+
+# Directory server of a cluster. It keeps the storage nodes on a hash ring:
+# nodes join when they start (ser.py --directory), clients fetch the list
+# once and place files themselves (cluster.py). Joining and leaving are
+# signed with the cluster key, the directory refuses them without one
+
+# threads serving connections, they are short lived. Four are kept while
+# idle, up to 64 are started while connections wait
+server_thread = threadpool.ThreadPool(64, 4)
+
+
+class Directory:
+    # The storage nodes of a cluster. epoch goes up whenever they change, so
+    # clients can tell their list is out of date
+    def __init__(self, nodes=(), replicas=1):
+        self.lock = threading.Lock()
+        self.ring = cluster.HashRing(nodes)
+        self.epoch = 0
+        # copies kept of each file, on consecutive nodes of the ring
+        self.replicas = replicas
+
+    # Returns True if the node wasn't in the cluster
+    def join(self, node):
+        with self.lock:
+            if not self.ring.add(node):
+                return False
+            self.epoch = self.epoch + 1
+            return True
+
+    # Returns True if the node was in the cluster
+    def leave(self, node):
+        with self.lock:
+            if not self.ring.remove(node):
+                return False
+            self.epoch = self.epoch + 1
+            return True
+
+    # Returns (epoch, sorted node addresses)
+    def nodes(self):
+        with self.lock:
+            return (self.epoch, sorted(self.ring.nodes))
+
+    # Returns the node of a path or None if there are no nodes
+    def locate(self, path):
+        with self.lock:
+            try:
+                return self.ring.node_for(path)
+            except LookupError:
+                return None
+
+
+directory = Directory()
+
+# key shared by the nodes of the cluster, see --cluster-key
+cluster_key = ''
+
+# join <node> <time> <signature> adds a storage node
+def join(request):
+    if len(request.args) == 3:
+        cluster.parse_address(request.args[0])
+        if not cluster.authentic_membership(cluster_key, "join", request.args):
+            return protocol.Response(protocol.STATUS_FAILED, "not signed with the cluster key")
+        if directory.join(request.args[0]):
+            return protocol.Response(protocol.STATUS_OK, "%s joined" % request.args[0])
+        return protocol.Response(protocol.STATUS_OK, "%s already joined" % request.args[0])
+    return error_response()
+
+# leave <node> <time> <signature> removes a storage node
+def leave(request):
+    if len(request.args) == 3:
+        if not cluster.authentic_membership(cluster_key, "leave", request.args):
+            return protocol.Response(protocol.STATUS_FAILED, "not signed with the cluster key")
+        if directory.leave(request.args[0]):
+            return protocol.Response(protocol.STATUS_OK, "%s left" % request.args[0])
+        return protocol.Response(protocol.STATUS_FAILED, "%s isn't a node" % request.args[0])
+    return error_response()
+
+# nodes answers with the epoch as message, the number of copies kept of
+# each file and a node address per line
+def nodes(request):
+    if len(request.args) == 0:
+        epoch, addresses = directory.nodes()
+        return protocol.Response(protocol.STATUS_OK, str(epoch),
+                                 payload="\n".join(addresses).encode(),
+                                 extra=(directory.replicas,))
+    return error_response()
+
+def locate(request):
+    if len(request.args) == 1:
+        node = directory.locate(request.args[0])
+        if node is None:
+            return protocol.Response(protocol.STATUS_FAILED, "no storage nodes")
+        return protocol.Response(protocol.STATUS_OK, node)
+    return error_response()
+
+def error_response():
+    return protocol.Response(protocol.STATUS_BAD_REQUEST, "unrecognised command")
+
+handlers = {
+    protocol.OP_JOIN: join,
+    protocol.OP_LEAVE: leave,
+    protocol.OP_NODES: nodes,
+    protocol.OP_LOCATE: locate,
+}
+
+def handle_request(request):
+    request.payload.drain()
+    handler = handlers.get(request.opcode)
+    if handler is None:
+        return error_response()
+    try:
+        return handler(request)
+    except ValueError:
+        return error_response()
+
+def serve_connection(connection):
+    try:
+        channel = protocol.FramedChannel(connection)
+        while True:
+            request = channel.next_request()
+            if request.opcode == protocol.OP_EXIT:
+                break
+            channel.send_response(request, handle_request(request))
+    except (protocol.ConnectionClosed, protocol.ProtocolError, OSError):
+        pass
+    finally:
+        connection.close()
+
+def serve(port, backlog=socket.SOMAXCONN):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    print("starting directory server on 127.0.0.1 port %s" % port)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(backlog)
+    while True:
+        connection, client_addr = sock.accept()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not server_thread.add_task(serve_connection, connection):
+            protocol.refuse_connection(connection)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Directory server of a cluster")
+    parser.add_argument('--port', type=int, default=cluster.DEFAULT_DIRECTORY_PORT)
+    parser.add_argument('--node', action='append', default=[],
+                        help="host:port of a storage node, nodes can also join later")
+    parser.add_argument('--replicas', type=int, default=1,
+                        help="copies kept of each file, on that many nodes")
+    parser.add_argument('--cluster-key', default=os.environ.get('DFS_CLUSTER_KEY', ''),
+                        help="key shared by the nodes of the cluster, nodes sign joining "
+                             "and leaving with it (default $DFS_CLUSTER_KEY)")
+    arguments = parser.parse_args()
+    cluster_key = arguments.cluster_key
+    directory.replicas = max(arguments.replicas, 1)
+    for node in arguments.node:
+        directory.join(node)
+    serve(arguments.port)
@@ -0,0 +1,191 @@
+import collections
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+# Verbosity levels, events below the journal's verbosity are not recorded
+DEBUG = 10
+INFO = 20
+WARNING = 30
+
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning"}
+LEVELS = dict((name, level) for level, name in LEVEL_NAMES.items())
+
+# Number of events kept in memory for queries
+DEFAULT_CAPACITY = 10000
+
+# Events waiting for the writer thread. When the writer falls this far behind
+# events are dropped from the disk log rather than blocking requests
+DEFAULT_QUEUE_SIZE = 65536
+
+# Most events written to disk in one batch
+BATCH_SIZE = 512
+
+# The log file is rotated when it grows past max_bytes, keeping backups
+# older files as log_path.1, log_path.2, ...
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_BACKUPS = 3
+
+
+class EventRecord(collections.namedtuple(
+        "EventRecord", "event_id timestamp level command client_id path")):
+
+    def format(self):
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.timestamp))
+        command = self.command
+        if self.path is not None:
+            command = "%s %s" % (command, self.path)
+        return "%d\t%s.%06d\t%s" % (self.event_id, timestamp,
+                                     int(self.timestamp % 1 * 1e6), command)
+
+    def to_json(self):
+        return json.dumps({
+            "id": self.event_id,
+            "time": self.timestamp,
+            "level": LEVEL_NAMES.get(self.level, self.level),
+            "command": self.command,
+            "client": self.client_id,
+            "path": self.path,
+        })
+
+
+class EventJournal:
+    # Keeps the most recent events in a ring buffer and hands them to a
+    # background thread that writes them in batches to a rotating JSON lines
+    # file and, if echo is set, to stdout. Recording an event never waits on
+    # I/O
+    def __init__(self, log_path=None, verbosity=DEBUG, echo=False,
+                 capacity=DEFAULT_CAPACITY, max_bytes=DEFAULT_MAX_BYTES,
+                 backups=DEFAULT_BACKUPS):
+        self.log_path = log_path
+        self.verbosity = verbosity
+        self.echo = echo
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.ring = collections.deque(maxlen=capacity)
+        self.event_ids = itertools.count()
+        self.dropped = 0
+        self.pending = None
+        if log_path is not None or echo:
+            self.pending = queue.SimpleQueue()
+            self.log_file = None
+            thread = threading.Thread(target=self.run_writer)
+            thread.daemon = True
+            thread.start()
+
+    # Records an event, returns its id or None if it is below the verbosity
+    def add(self, command, client_id=None, path=None, level=INFO):
+        if level < self.verbosity:
+            return None
+        record = EventRecord(next(self.event_ids), time.time(), level,
+                             command, client_id, path)
+        self.ring.append(record)
+        if self.pending is not None:
+            if self.pending.qsize() < DEFAULT_QUEUE_SIZE:
+                self.pending.put(record)
+            else:
+                self.dropped = self.dropped + 1
+        return record.event_id
+
+    # Returns the events in memory that match all the passed filters, oldest
+    # first. since and until are epoch seconds, path matches the path and
+    # everything below it
+    def query(self, since=None, until=None, client_id=None, path=None, limit=None):
+        matches = []
+        directory = None
+        if path is not None:
+            directory = path.rstrip("/") + "/"
+        for record in tuple(self.ring):
+            if since is not None and record.timestamp < since:
+                continue
+            if until is not None and record.timestamp > until:
+                continue
+            if client_id is not None and record.client_id != client_id:
+                continue
+            if path is not None and record.path != path and \
+                    not (record.path or "").startswith(directory):
+                continue
+            matches.append(record)
+        if limit is not None:
+            matches = matches[-limit:]
+        return matches
+
+    # Blocks until the writer thread has written every event queued so far
+    def flush(self, timeout=None):
+        if self.pending is not None:
+            written = threading.Event()
+            self.pending.put(written)
+            written.wait(timeout)
+
+    def run_writer(self):
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            # flush() markers are set once the events before them are written
+            markers = [item for item in batch if isinstance(item, threading.Event)]
+            records = [item for item in batch if not isinstance(item, threading.Event)]
+            try:
+                if records:
+                    self.write_batch(records)
+            except Exception as e:
+                sys.stderr.write("event log: %s\n" % e)
+            for marker in markers:
+                marker.set()
+
+    def write_batch(self, batch):
+        if self.echo:
+            sys.stdout.write("".join(record.format() + "\n" for record in batch))
+            sys.stdout.flush()
+        if self.log_path is None:
+            return
+        data = "".join(record.to_json() + "\n" for record in batch).encode()
+        if self.log_file is None:
+            self.log_file = open(self.log_path, "ab")
+        if self.log_file.tell() > 0 and self.log_file.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.log_file.write(data)
+        self.log_file.flush()
+
+    def rotate(self):
+        self.log_file.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.log_path, index)
+            if os.path.exists(older):
+                os.replace(older, "%s.%d" % (self.log_path, index + 1))
+        if self.backups > 0:
+            os.replace(self.log_path, self.log_path + ".1")
+        else:
+            os.remove(self.log_path)
+        self.log_file = open(self.log_path, "ab")
+
+    def __len__(self):
+        return len(self.ring)
+
+
+if __name__ == '__main__':
+    # Measures the cost of recording an event on the request path
+    import tempfile
+    import timeit
+
+    operations = 200000
+    with tempfile.TemporaryDirectory() as directory:
+        journals = [
+            ("memory only", EventJournal()),
+            ("memory + disk log", EventJournal(os.path.join(directory, "events.log"))),
+            ("filtered out", EventJournal(verbosity=INFO)),
+        ]
+        for name, journal in journals:
+            level = DEBUG if name == "filtered out" else INFO
+            seconds = timeit.timeit(
+                lambda: journal.add("write", 7, "files/file1.txt", level),
+                number=operations)
+            journal.flush()
+            print("%-20s %.2f us per event" % (name, seconds / operations * 1e6))
@@ -1,8 +1,21 @@
-import datetime
-import threadpool
-import time
+import callbacks
+import contextlib
+import delta
+import content_cache
+import event_log
+import lock_manager
 import os
+import posixpath
 import shutil
+import stat
+import storage
+import tempfile
+import threading
+import tree_ops
+import wal
+
+# Entries returned per page of a directory listing
+LIST_PAGE_SIZE = 1000
 
 class Client:
     # Initialise a new File System client
@@ -12,6 +25,12 @@ class Client:
         self.dir_level = 0
         # Path to root is the path to the root of the file_system
         self.dir_path = [path_to_root]
+        # dir_path joined into a string, kept up to date by the functions
+        # below so paths don't have to be rebuilt on every request
+        self.working_dir = path_to_root + "/"
+        # sends the client an invalidation, set by the server for clients
+        # that can receive them
+        self.notify = None
 
     #
     # Functions for working with directories
@@ -21,14 +40,16 @@ class Client:
     def change_directory(self, dir_name ):
         self.dir_level = self.dir_level + 1
         self.dir_path.append( dir_name )
+        self.working_dir = self.working_dir + dir_name + "/"
 
     # Move up a directory level
     # Return 0 : Success
     # Return 1 : At top directory level
     def move_up_directory(self):
         if self.dir_level > 0:
-            self.dir_path.pop()
+            removed = self.dir_path.pop()
             self.dir_level = self.dir_level - 1
+            self.working_dir = self.working_dir[:-(len(removed) + 1)]
             return 0
         else:
             return 1
@@ -43,84 +64,110 @@ class Client:
         print("id: %d" % self.id)
         print("dir_level: %d" % self.dir_level)
         print("")
-class FileSystemManager:
-
-    # List for storing active clients
-    active_clients = []
-
-    # Next ID to be assigned to new client and events
-    next_client_id = 0
-    next_event_id = 0
 
-    # List of events and IDs
-    # ( event_id , command, time )
-    events = []
+class ClientRegistry:
+    # Sessions of the connected clients indexed by client id. Lookups are a
+    # dict access, adding and removing clients is done under a lock
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+        # Next ID to be assigned to a new client
+        self.next_client_id = 0
+
+    # Creates a session for a new client and returns it
+    def add(self, socket, path_to_root):
+        with self.lock:
+            client = Client(self.next_client_id, socket, path_to_root)
+            self.next_client_id = self.next_client_id + 1
+            self.clients[client.id] = client
+        return client
+
+    # Removes a client, returns the removed session or None
+    def remove(self, client_id):
+        with self.lock:
+            return self.clients.pop(client_id, None)
+
+    # Returns the session of a client or None
+    def get(self, client_id):
+        return self.clients.get(client_id)
+
+    def __contains__(self, client_id):
+        return client_id in self.clients
+
+    def __len__(self):
+        return len(self.clients)
+
+    # Iterates over a snapshot so clients can come and go meanwhile
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.clients.values()))
+
+    def __repr__(self):
+        return "ClientRegistry(%r)" % sorted(self.clients)
 
-    # List of the paths of currently locked files
-    # ( client_id, time, path )
-    locked_files = []
-
-    # ThreadPool will contain threads managing the autorelease
-    # of locks
-    file_system_manager_threadpool = threadpool.ThreadPool(1)
+class FileSystemManager:
 
-    # Create new File System Manager and initialise the root
-    def __init__(self, root_path):
+    # Create new File System Manager and initialise the root. Events are
+    # recorded in journal, by default an in memory event_log.EventJournal.
+    # Contents of small, frequently read files are kept in content_cache, by
+    # default a content_cache.ContentCache, and listings of directories in
+    # directory_cache, a content_cache.DirectoryCache. File contents are
+    # stored by file_storage, by default a storage.FileStorage that keeps
+    # them as they are. Changes are logged to write_log, a
+    # wal.WriteAheadLog, before they are applied, or not at all if it is None
+    def __init__(self, root_path, journal=None, cache=None, directory_cache=None,
+                 file_storage=None, write_log=None):
         self.root_path = root_path
-        #Add autorelease function to a new thread
-        self.file_system_manager_threadpool.add_task(
-            self.auto_release
-        )
-
-    # Generate a client ID and update next_client_id
-    def gen_client_id(self):
-        return_client_id = self.next_client_id
-        self.next_client_id = self.next_client_id + 1
-        return return_client_id
-
-    # Generate a client ID and update next_event_id
-    def gen_event_id(self):
-        return_event_id = self.next_event_id
-        self.next_event_id = self.next_event_id + 1
-        return return_event_id
+        if file_storage is None:
+            file_storage = storage.FileStorage()
+        self.storage = file_storage
+        self.write_log = write_log
+        if journal is None:
+            journal = event_log.EventJournal()
+        self.journal = journal
+        if cache is None:
+            cache = content_cache.ContentCache()
+        self.content_cache = cache
+        if directory_cache is None:
+            directory_cache = content_cache.DirectoryCache()
+        self.directory_cache = directory_cache
+        # Sessions of the active clients
+        self.active_clients = ClientRegistry()
+        # Locks held on files, indexed by path. Locks are leases that are
+        # released when they run out
+        self.locked_files = lock_manager.LockManager(on_expire=self.lease_expired)
+        # Clients holding a cached copy of a file, told when it changes
+        self.callbacks = callbacks.CallbackIndex()
+        # Walks and copies directory trees for the recursive commands
+        self.tree_walker = tree_ops.TreeWalker()
 
     #
     # Functions for interacting with clients
     #
 
-    # Adds a new client to the file system manager
+    # Adds a new client to the file system manager. notify(path) sends the
+    # client an invalidation for a path relative to the root, clients
+    # without one can't hold callbacks
     # Returns the id of the client
-    def add_client(self, connection):
-        new_client_id = self.gen_client_id();
-        new_client = Client(new_client_id, connection, self.root_path)
-        self.active_clients.append(new_client)
-        return new_client_id
+    def add_client(self, connection, notify=None):
+        new_client = self.active_clients.add(connection, self.root_path)
+        new_client.notify = notify
+        return new_client.id
 
+    # Removes a client and releases the locks and callbacks it held
     def remove_client(self, client_in):
-        i = 0
-        for client in self.active_clients:
-            if client.id == client_in.id:
-                self.active_clients.pop(i)
-            i = i + 1
+        if client_in is not None:
+            self.active_clients.remove(client_in.id)
+            self.callbacks.remove_client(client_in.id)
+            for file_path in self.locked_files.release_client(client_in.id):
+                self.add_event("release on disconnect", client_in.id, file_path)
 
     def get_active_client(self, client_id):
-        for client in self.active_clients:
-            if client.id == client_id:
-                return client
-
-    def update_client(self, client_in):
-        i = 0
-        for client in self.active_clients:
-            if client.id == client_in.id:
-                self.active_clients[i] = client_in
-            i = i + 1
+        return self.active_clients.get(client_id)
 
     # checks if a client exists which has the same id as the one passed in
     def client_exists(self, id_in):
-        for client in self.active_clients:
-            if ( client.id == id_in ):
-                return True
-        return False
+        return id_in in self.active_clients
 
     def disconnect_client(self, connection, client_id):
      # get client
@@ -128,27 +175,28 @@ class FileSystemManager:
      # remove client from active clients
       self.remove_client(client)
      # disconnect socket
-      connection.sendall("disconnected")
+      connection.sendall(b"disconnected")
       connection.close()
      # add event
-      self.add_event("disconnect client %d" % client_id)
+      self.add_event("disconnect", client_id)
 
 
     #
     # Functions for interacting with events
     #
 
-    def add_event(self, command):
-        new_event_id = self.gen_event_id()
-        event_timestamp = datetime.datetime.now()
-        new_event_record = (new_event_id, command, event_timestamp)
-        self.events.append(new_event_record)
-        print("%d\t%s\t%s" % (new_event_record[0], new_event_record[2], new_event_record[1]))
+    # Records an event in the journal, returns its id
+    def add_event(self, command, client_id=None, path=None, level=event_log.INFO):
+        return self.journal.add(command, client_id, path, level)
 
-    def log_events(self):
+    # Prints and returns the recorded events matching the passed filters.
+    # since and until are epoch seconds, path also matches items below it
+    def log_events(self, since=None, until=None, client_id=None, path=None, limit=None):
+        events = self.journal.query(since, until, client_id, path, limit)
         print("EID\tTIME\t\t\t\tCOMMAND")
-        for event in self.events:
-            print("%d\t%s\t%s" % (event[0], event[2], event[1]))
+        for event in events:
+            print(event.format())
+        return events
 
     #
     # Functions for moving directories
@@ -167,129 +215,181 @@ class FileSystemManager:
             return 1
         # Change directory if it does
         client.change_directory(dir_name)
-        self.update_client(client)
-        self.add_event("cd " + dir_name)
+        self.add_event("cd", client_id, new_dir_path, event_log.DEBUG)
         return 0
 
     def move_up_directory(self, client_id):
         client = self.get_active_client(client_id)
-        client.move_up_directory()
-        self.update_client(client)
-        self.add_event("up")
-
-    # Lists contents of directory
-    # returns response string
-    def list_directory_contents(self, client_id, item_name = ""):
-        path = self.resolve_path(client_id, item_name)
-        item_type = self.item_exists(client_id, item_name)
-        if item_type == -1:
-            return "No such directory %s" % item_name
-        elif item_type == 0:
-            return "Cannot list contents of %s" % item_name
-        else:
-            item_list = os.listdir("./" + path)
-            return_string = "Type\tPath"
-            for item in item_list:
-                list_item_type = self.item_exists(client_id, item)
-                if list_item_type == 0:
-                    return_string = return_string + "\n" + "f\t" + item
-                elif list_item_type == 1:
-                    return_string = return_string + "\n" + "d\t" + item
-            return return_string
+        res = client.move_up_directory()
+        self.add_event("up", client_id, client.working_dir, event_log.DEBUG)
+        return res
+
+    # Lists a directory. Entries are (name, is_dir, size, mtime_ns) and come
+    # page_size at a time, so big directories are never held in memory
+    # Return (0, path, pages) : pages iterates over lists of entries
+    # Return (1, path, None) : Directory doesn't exist
+    # Return (2, path, None) : Item is a file
+    def list_directory(self, client_id, item_name="", page_size=LIST_PAGE_SIZE):
+        path = posixpath.normpath(self.resolve_path(client_id, item_name))
+        try:
+            dir_stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return (1, path, None)
+        if not stat.S_ISDIR(dir_stat.st_mode):
+            return (2, path, None)
+        self.add_event("ls", client_id, path, event_log.DEBUG)
+        entries = self.directory_cache.get(path, dir_stat)
+        if entries is not None:
+            pages = (entries[start:start + page_size]
+                     for start in range(0, len(entries), page_size))
+            return (0, path, pages)
+        return (0, path, self.scan_directory(path, dir_stat, page_size))
+
+    # Reads a directory with os.scandir, which returns the type of each entry
+    # with its name, so each entry costs one stat. Listings that fit in the
+    # directory cache are added to it once the scan is complete
+    def scan_directory(self, path, dir_stat, page_size):
+        generation = self.directory_cache.generation
+        listed = []
+        page = []
+        with os.scandir(path) as scan:
+            for entry in scan:
+                try:
+                    entry_stat = entry.stat()
+                except FileNotFoundError:
+                    # removed while listing
+                    continue
+                item = (entry.name, stat.S_ISDIR(entry_stat.st_mode),
+                        entry_stat.st_size, entry_stat.st_mtime_ns)
+                page.append(item)
+                if listed is not None:
+                    listed.append(item)
+                    if not self.directory_cache.accepts(len(listed)):
+                        listed = None
+                if len(page) == page_size:
+                    yield page
+                    page = []
+        if page:
+            yield page
+        if listed is not None:
+            self.directory_cache.put(path, dir_stat, listed, generation)
 
     # Passed the name of an item this function returns the path
     # to that item
     def resolve_path(self, client_id, item_name):
-        client = self.get_active_client(client_id)
-        file_path = ""
-        for path_element in client.dir_path:
-            file_path = file_path + "%s/" % path_element
-        file_path = file_path + item_name
-        return file_path
+        return self.active_clients.get(client_id).working_dir + item_name
 
-    # Passed the name of an item this function returns the path
-    # to that item
+    # Returns the path of the working directory of a client
     def get_working_dir(self, client_id):
-            client = self.get_active_client(client_id)
-            file_path = ""
-            for path_element in client.dir_path:
-                file_path = file_path + "%s/" % path_element
-            return file_path
-
-
-            #
-        # Functions for interacting with locking
-        #
-
-        # Locks an item if it is not locked
-        # Return 0 : Item was locked
-        # Return 1 : Item was already locked
-        # Return 2 : Item doesn't exist
-        # Return 3 : Item is a directory
-    def lock_item(self, client, item_name):
-            file_path = self.resolve_path(client.id, item_name)
-            # if item is not a file or doesnt exist exit
-            item_type = self.item_exists(client.id, item_name)
-            if item_type == -1:
-                return 2
-            elif item_type == 1:
-                return 3
-            if self.check_lock(client, item_name) == True:
-                return 1
-            else:
-                lock_timestamp = datetime.datetime.now()
-                lock_record = (client.id, lock_timestamp, file_path)
-                self.locked_files.append(lock_record)
-                self.add_event("lock " + file_path)
-                return 0
+        return self.active_clients.get(client_id).working_dir
+
+    # Returns the path of a file relative to the root, as clients see it
+    def root_relative(self, file_path):
+        return posixpath.relpath(file_path, self.root_path)
+
+    #
+    # Functions for interacting with callbacks
+    #
+
+    # Registers a callback for a client on a file it is about to read, so it
+    # is told when the file changes. Must be called before the file is read
+    # Returns True if the client can receive callbacks
+    def register_callback(self, client_id, item_name):
+        client = self.get_active_client(client_id)
+        if client is None or client.notify is None:
+            return False
+        file_path = self.resolve_path(client_id, item_name)
+        self.callbacks.subscribe(client_id, self.root_relative(file_path))
+        return True
+
+    # Returns the notify function of a connected client, or None
+    def client_notifier(self, client_id):
+        client = self.get_active_client(client_id)
+        if client is None:
+            return None
+        return client.notify
 
-        # Unlocks an item if it was locked
+
+    #
+    # Functions for interacting with locking
+    #
+
+    # Locks an item if it is not locked. Shared locks can be held by several
+    # clients at once, an exclusive lock by a single client. The lock is a
+    # lease of ttl seconds that the client can renew. If the item is locked
+    # by another client, waits up to wait seconds for it to be released
+    # Return 0 : Item was locked
+    # Return 1 : Item was already locked
+    # Return 2 : Item doesn't exist
+    # Return 3 : Item is a directory
+    # Return 4 : The client already holds the lock
+    # Return 5 : The client's shared lock, held by no one else, became
+    #            exclusive
+    def lock_item(self, client, item_name, mode=lock_manager.EXCLUSIVE,
+                  ttl=lock_manager.DEFAULT_LEASE_TIME, wait=0):
+        file_path = self.resolve_path(client.id, item_name)
+        # if item is not a file or doesnt exist exit
+        item_type = self.item_exists(client.id, item_name)
+        if item_type == -1:
+            return 2
+        elif item_type == 1:
+            return 3
+        res = self.locked_files.acquire(client.id, file_path, mode, ttl, wait)
+        if res == lock_manager.CONFLICT:
+            return 1
+        elif res == lock_manager.ALREADY_HELD:
+            return 4
+        elif res == lock_manager.UPGRADED:
+            self.add_event("lock upgraded", client.id, file_path)
+            return 5
+        self.add_event("lock " + mode, client.id, file_path)
+        return 0
+
+    # Unlocks an item if it was locked
+    # Return 0 : Item released
+    # Return -1 : The client did not hold a lock on the item
     def release_item(self, client, item_name):
-            file_path = self.resolve_path(client.id, item_name)
-            i = 0
-            item_released = False
-            for locked_file in self.locked_files:
-                if file_path == locked_file[2]:
-                    if client.id == locked_file[0]:
-                        self.locked_files.pop(i)
-                        self.add_event("release " + file_path)
-                        item_released = True
-                i = i + 1
-            if item_released:
-                return 0
-            else:
-                return -1
+        file_path = self.resolve_path(client.id, item_name)
+        if self.locked_files.release(client.id, file_path):
+            self.add_event("release", client.id, file_path)
+            return 0
+        return -1
 
+    # Makes the lock lock_item upgraded for a client shared again
+    def downgrade_item(self, client, item_name):
+        file_path = self.resolve_path(client.id, item_name)
+        if self.locked_files.downgrade(client.id, file_path):
+            self.add_event("lock downgraded", client.id, file_path)
 
-    # Checks if an item is locked
+    # Checks if an item is locked by another client
     # Return True : Item is locked
     # Returns False : Item is not locked
     def check_lock(self, client, item_name):
         file_path = self.resolve_path(client.id, item_name)
-        for locked_file in self.locked_files:
-            if locked_file[2] == file_path:
-                return True
-        return False
-
-    # Traverses the list of locked items and releases locked item if
-    # client does not exist
-    # Run in a thread initialized in the __init__ function
-    def auto_release(self):
-        while True:
-            # auto release occurs every minute
-            time.sleep(60)
-            new_locked_file_list = []
-            for locked_file in self.locked_files:
-                for client in self.active_clients:
-                    if locked_file[0] == client.id:
-                        new_locked_file_list.append(locked_file)
-            self.locked_files = new_locked_file_list
-            self.add_event("lock auto-release")
+        return self.locked_files.is_locked(file_path, client.id)
+
+    # Extends the lease of a lock the client holds to ttl seconds from now
+    # Return 0 : Lease renewed
+    # Return -1 : The client did not hold a lock on the item
+    def renew_item(self, client, item_name, ttl=lock_manager.DEFAULT_LEASE_TIME):
+        file_path = self.resolve_path(client.id, item_name)
+        if self.locked_files.renew(client.id, file_path, ttl):
+            self.add_event("renew", client.id, file_path, event_log.DEBUG)
+            return 0
+        return -1
+
+    # Called by the lock manager when a lease runs out without being renewed
+    def lease_expired(self, file_path, client_id):
+        self.add_event("lease expired", client_id, file_path, event_log.WARNING)
+
+    # Returns the lease counters of the lock manager
+    def lease_stats(self):
+        return self.locked_files.lease_stats()
 
     def log_locks(self):
-        print("LID\tTIME\t\t\t\tPATH")
-        for locked_file in self.locked_files:
-            print("%d\t%s\t%s" % locked_file)
+        print("CID\tTIME\t\t\t\tPATH\tMODE\tLEASE")
+        for locked_file in self.locked_files.records():
+            print("%d\t%s\t%s\t%s\t%.1fs" % locked_file)
 
     #
     # Functions for interacting with items
@@ -311,29 +411,108 @@ class FileSystemManager:
         else:
             return -1
 
-    # Returns the path and contents of a file as a string
-    def read_item(self, client_id, item_name):
+    # Returns the metadata of an item
+    # Return (0, path, stat) : Item exists, stat is its os.stat_result
+    # Return (1, path, None) : Item doesn't exist
+    def stat_item(self, client_id, item_name):
+        file_path = self.resolve_path(client_id, item_name)
+        try:
+            return (0, file_path, os.stat(file_path))
+        except (FileNotFoundError, NotADirectoryError):
+            return (1, file_path, None)
+
+    # Reads a file. Small files are served from the content cache, or read
+    # and added to it. Bigger files are returned open so the caller can stream
+    # them (sendfile) instead of loading them in memory, and must close them
+    # Along with the contents comes the version tag of the file
+    # (content_cache.version_tag). When the caller passes the tag of a copy it
+    # already has and the file still has it, nothing is read
+    # Return (0, path, contents, tag) : Read successfull, contents is bytes or
+    #                                   an open file
+    # Return (1, path, None, None) : Item doesn't exist
+    # Return (2, path, None, None) : Item is a directory
+    # Return (3, path, None, tag) : The file is unchanged since version
+    def read_item(self, client_id, item_name, version=None):
+        file_path = self.resolve_path(client_id, item_name)
         # check if item exists
-        item_type = self.item_exists(client_id, item_name)
-        if item_type == -1:
-            return "%s doesn't exist" % item_name
-        elif item_type == 1:
-            return "%s is a directory" % item_name
-        elif item_type == 0:
-            # read item
-            file_path = self.resolve_path(client_id, item_name)
-            file = open(file_path, 'r')
-            file_contents = file.read()
-            # add event
-            self.add_event("read " + file_path)
-            return_string = "%s////%s" % (file_path, file_contents)
-            return return_string
-
-    # Writes a passed string to a file with a passed name
+        try:
+            file_stat = os.stat(file_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return (1, file_path, None, None)
+        if stat.S_ISDIR(file_stat.st_mode):
+            return (2, file_path, None, None)
+        # add event
+        self.add_event("read", client_id, file_path, event_log.DEBUG)
+        tag = content_cache.version_tag(file_stat)
+        if version is not None and version == tag:
+            return (3, file_path, None, tag)
+        contents = self.content_cache.get(file_path, file_stat)
+        if contents is not None:
+            return (0, file_path, contents, tag)
+        # open item
+        try:
+            file = self.storage.open(file_path)
+        except FileNotFoundError:
+            return (1, file_path, None, None)
+        open_stat = self.storage.fstat(file)
+        tag = content_cache.version_tag(open_stat)
+        if not self.content_cache.accepts(open_stat.st_size):
+            return (0, file_path, file, tag)
+        with file:
+            contents = file.read()
+            # only cache what was read from a file that didn't change meanwhile
+            version = content_cache.file_version(self.storage.fstat(file))
+            if version == content_cache.file_version(open_stat):
+                self.content_cache.put(file_path, open_stat, contents)
+        return (0, file_path, contents, tag)
+
+    # Returns the signature of a file (delta.signature), for a client about
+    # to send a delta of its new version
+    # Return (0, path, signature, tag) : Signature of the version tag
+    # Return (1, path, None, None) : Item doesn't exist
+    # Return (2, path, None, None) : Item is a directory
+    def file_signature(self, client_id, item_name):
+        file_path = self.resolve_path(client_id, item_name)
+        try:
+            file = self.storage.open(file_path)
+        except (FileNotFoundError, NotADirectoryError):
+            return (1, file_path, None, None)
+        except IsADirectoryError:
+            return (2, file_path, None, None)
+        with file:
+            file_stat = self.storage.fstat(file)
+            signature = delta.signature(file, file_stat.st_size)
+        self.add_event("signature", client_id, file_path, event_log.DEBUG)
+        return (0, file_path, signature, content_cache.version_tag(file_stat))
+
+    # Reads a byte range of a file. The range is clamped to the end of the
+    # file, contents and version are handled as with read_item
+    # Return (0, path, contents, count, tag) : Read successfull
+    # Return (1, path, None, 0, None) : Item doesn't exist
+    # Return (2, path, None, 0, None) : Item is a directory
+    # Return (3, path, None, 0, tag) : The file is unchanged since version
+    def read_range(self, client_id, item_name, offset, length, version=None):
+        res, file_path, contents, tag = self.read_item(client_id, item_name, version)
+        if res != 0:
+            return (res, file_path, None, 0, tag)
+        if isinstance(contents, bytes):
+            contents = memoryview(contents)[offset:offset + length]
+            return (0, file_path, contents, len(contents), tag)
+        size = self.storage.fstat(contents).st_size
+        count = max(min(length, size - offset), 0)
+        return (0, file_path, contents, count, tag)
+
+    # Writes the contents of source (bytes or a stream) to a file with a
+    # passed name. Readers never see a half written file. With manifest,
+    # source lists the chunks of the contents and holds those the server
+    # lacks, see storage.ChunkStorage.write_manifest. With basis, source is
+    # a delta against the version of the file whose tag is basis
     # Return 0 : Write successfull
     # Return 1 : Write unsuccessfull, File locked
     # Return 2 : Write unsuccessfull, File is a directory
-    def write_item(self, client_id, item_name, file_contents):
+    # Return 3 : Write unsuccessfull, Chunks are missing
+    # Return 4 : Write unsuccessfull, The file isn't at version basis
+    def write_item(self, client_id, item_name, source, manifest=False, basis=None):
         item_type = self.item_exists(client_id, item_name)
         # exit if the item is a directory
         if item_type == 1:
@@ -346,23 +525,99 @@ class FileSystemManager:
             return 1
         # write to it
         file_path = self.resolve_path(client_id, item_name)
-        file = open(file_path, 'w+')
-        file.truncate()
-        file.write(file_contents)
-        # add write event
-        self.add_event("write " + file_path)
-        # If item had previously never existed
-        if lock_res == 2:
+        try:
+            if basis is not None:
+                if not self.write_delta(file_path, source, basis):
+                    return 4
+            elif not manifest:
+                with self.logged(wal.WRITE, file_path, source) as source:
+                    self.storage.write(file_path, source)
+            else:
+                with self.logged(wal.MANIFEST, file_path, source) as source:
+                    if not self.storage.write_manifest(file_path, source):
+                        return 3
+            self.item_changed(client_id, file_path)
+            # add write event
+            self.add_event("write", client_id, file_path)
             return 0
-        # release it
-        self.release_item(client, item_name)
-        return 0
-        # Deletes a file
-        # Return 0 : Delete successfull
-        # Return 1 : Delete unsuccessfull, File locked
-        # Return 2 : Delete unsuccessfull, File is a Directory
-        # Return 3 : Delete unsuccessfull, File Doesn't exist
+        finally:
+            # If item had previously never existed, or the client had locked
+            # it before writing, there is no lock to release. A shared lock
+            # the client held is given back
+            if lock_res == 0:
+                self.release_item(client, item_name)
+            elif lock_res == 5:
+                self.downgrade_item(client, item_name)
+
+    # Replaces a file with the version built from a delta against its
+    # version basis, the blocks it copies are read from the old version as
+    # the new one is written
+    # Returns False if the file isn't at version basis
+    def write_delta(self, file_path, source, basis):
+        try:
+            file = self.storage.open(file_path)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return False
+        with file:
+            if content_cache.version_tag(self.storage.fstat(file)) != basis:
+                return False
+            with self.logged(wal.WRITE, file_path, delta.patched(file, source)) as contents:
+                self.storage.write(file_path, contents)
+        return True
+
+    # Writes the contents of source into a file at a byte offset, leaving the
+    # rest of the file untouched. The file is created if it doesn't exist
+    # Return 0 : Write successfull
+    # Return 1 : Write unsuccessfull, File locked
+    # Return 2 : Write unsuccessfull, File is a directory
+    def write_range(self, client_id, item_name, offset, source):
+        return self.write_in_place(client_id, item_name, source, offset)
 
+    # Appends the contents of source to the end of a file
+    # Return values are the same as write_range
+    def append_item(self, client_id, item_name, source):
+        return self.write_in_place(client_id, item_name, source, None)
+
+    def write_in_place(self, client_id, item_name, source, offset):
+        item_type = self.item_exists(client_id, item_name)
+        # exit if the item is a directory
+        if item_type == 1:
+            return 2
+        client = self.get_active_client(client_id)
+        lock_res = self.lock_item(client, item_name)
+        # Exit if file is locked
+        if lock_res == 1:
+            return 1
+        file_path = self.resolve_path(client_id, item_name)
+        logged_offset = offset
+        if offset is None and self.write_log is not None:
+            # the log holds where the data went, an append applied again
+            # after a crash must not append it twice
+            logged_offset = self.file_size(file_path)
+        try:
+            try:
+                with self.logged(wal.WRITE_AT, file_path, source, logged_offset) as source:
+                    self.storage.write_at(file_path, source, logged_offset)
+            finally:
+                self.item_changed(client_id, file_path)
+            if offset is None:
+                self.add_event("append", client_id, file_path)
+            else:
+                self.add_event("write at %d" % offset, client_id, file_path)
+            return 0
+        finally:
+            # also when the write failed half way, the lock was only taken
+            # for it
+            if lock_res == 0:
+                self.release_item(client, item_name)
+            elif lock_res == 5:
+                self.downgrade_item(client, item_name)
+
+    # Deletes a file
+    # Return 0 : Delete successfull
+    # Return 1 : Delete unsuccessfull, File locked
+    # Return 2 : Delete unsuccessfull, File is a Directory
+    # Return 3 : Delete unsuccessfull, File Doesn't exist
     def delete_file(self, client_id, item_name):
         item_type = self.item_exists(client_id, item_name)
         # exit if the item does not exist
@@ -379,55 +634,261 @@ class FileSystemManager:
             return 1
         # delete file
         file_path = self.resolve_path(client_id, item_name)
-        os.remove(file_path)
+        with self.logged(wal.DELETE, file_path):
+            self.storage.delete(file_path)
+        self.item_changed(client_id, file_path)
         # add delete event
-        self.add_event("delete " + file_path)
-        # release it
+        self.add_event("delete", client_id, file_path)
+        # release it, also when the client had locked it before
         self.release_item(client, item_name)
         return 0
 
-        # Makes new directory in current directory
-        # return 0 : successfull
-        # return 1 : file of same name exists
-        # return 2 : directory of same name exists
-        def make_directory(self, client_id, directory_name):
-            path = self.resolve_path(client_id, directory_name)
-            exists = self.item_exists(client_id, directory_name)
-            # is file
-            if exists == 0:
-                return 1
-            # is dir
-            elif exists == 1:
-                return 2
-            # doesn't exist
-            elif -1:
+    # Returns the digests of chunks the storage doesn't have, or None if it
+    # doesn't store files as chunks
+    def missing_chunks(self, digests):
+        if not self.storage.stores_chunks:
+            return None
+        return self.storage.missing_chunks(digests)
+
+    # Drops the cached copies of a file that was changed or deleted by a
+    # client, on the server and on the clients holding callbacks on it
+    def item_changed(self, client_id, file_path):
+        self.content_cache.invalidate(file_path)
+        self.directory_cache.invalidate(posixpath.dirname(posixpath.normpath(file_path)))
+        self.callbacks.break_path(
+            self.root_relative(file_path), self.client_notifier, client_id)
+
+    # Makes new directory in current directory
+    # return 0 : successfull
+    # return 1 : file of same name exists
+    # return 2 : directory of same name exists
+    def make_directory(self, client_id, directory_name):
+        path = self.resolve_path(client_id, directory_name)
+        exists = self.item_exists(client_id, directory_name)
+        # is file
+        if exists == 0:
+            return 1
+        # is dir
+        elif exists == 1:
+            return 2
+        # doesn't exist
+        else:
+            with self.logged(wal.MKDIR, path):
                 os.makedirs(path)
-                self.add_event("mkdir " + path)
-                return 0
+            self.directory_cache.invalidate(posixpath.dirname(posixpath.normpath(path)))
+            self.add_event("mkdir", client_id, path)
+            return 0
 
-        # remove directory
-        # return -1 : directory doesn't exist
-        # return 0 : successfull
-        # return 1 : is a file
-        # return 2 : directory has locked contents
-        def remove_directory(self, client_id, directory_name):
-            path = self.resolve_path(client_id, directory_name)
-            item_type = self.item_exists(client_id, directory_name)
-            if item_type == -1:
-                return -1
-            elif item_type == 0:
-                return 1
-            elif item_type == 1:
-                directory_has_locked_elements = False
-                for lock_record in self.locked_files:
-                    if lock_record[2][0:len(path)] == path:
-                        directory_has_locked_elements = True
-                if directory_has_locked_elements:
-                    return 2
-                else:
+    # remove directory
+    # return -1 : directory doesn't exist
+    # return 0 : successfull
+    # return 1 : is a file
+    # return 2 : directory has locked contents
+    def remove_directory(self, client_id, directory_name):
+        path = self.resolve_path(client_id, directory_name)
+        item_type = self.item_exists(client_id, directory_name)
+        if item_type == -1:
+            return -1
+        elif item_type == 0:
+            return 1
+        elif item_type == 1:
+            if self.locked_files.has_locked_descendants(path):
+                return 2
+            else:
+                with self.logged(wal.RMDIR, path):
                     shutil.rmtree(path)
-                    self.add_event("rmdir " + path)
-                    return 0
+                self.tree_changed(client_id, path)
+                self.add_event("rmdir", client_id, path)
+                return 0
+
+    # Drops everything cached about a directory tree that was removed or
+    # moved, on the server and on the clients holding callbacks below it
+    def tree_changed(self, client_id, path):
+        self.content_cache.invalidate_tree(path)
+        path = posixpath.normpath(path)
+        self.directory_cache.invalidate_tree(path)
+        self.directory_cache.invalidate(posixpath.dirname(path))
+        self.callbacks.break_tree(self.root_relative(path), self.client_notifier, client_id)
+
+    #
+    # Functions for working on directory trees
+    #
+
+    # Walks the tree below a directory, see tree_ops.TreeWalker.walk
+    # Return (0, path, walk) : walk iterates over (relative path, entries)
+    #                          for every directory of the tree
+    # Return (1, path, None) : Directory doesn't exist
+    # Return (2, path, None) : Item is a file
+    def walk_directory(self, client_id, item_name=""):
+        path = posixpath.normpath(self.resolve_path(client_id, item_name))
+        item_type = self.item_exists(client_id, item_name)
+        if item_type == -1:
+            return (1, path, None)
+        elif item_type == 0:
+            return (2, path, None)
+        self.add_event("walk", client_id, path, event_log.DEBUG)
+        return (0, path, self.tree_walker.walk(path))
+
+    # Copies a file or a directory tree on the server, the data never goes
+    # through the client. A file replaces the destination file, a tree is
+    # copied to a new directory
+    # Return (0, files, bytes) : Copy successfull
+    # Return (1, 0, 0) : Source doesn't exist
+    # Return (2, 0, 0) : Destination is locked
+    # Return (3, 0, 0) : Destination is a directory that exists
+    # Return (4, 0, 0) : Destination is inside the source directory
+    # Return (5, 0, 0) : Destination's directory doesn't exist
+    def copy_item(self, client_id, source_name, destination_name):
+        source = posixpath.normpath(self.resolve_path(client_id, source_name))
+        destination = posixpath.normpath(self.resolve_path(client_id, destination_name))
+        res = self.check_tree_destination(client_id, source, destination)
+        if res != 0:
+            return (res, 0, 0)
+        if os.path.isdir(source):
+            files, copied = self.tree_walker.copy_tree(source, destination, self.copy_file,
+                                                       self.make_copied_directory)
+            self.directory_cache.invalidate(posixpath.dirname(destination))
+        else:
+            self.copy_file(source, destination)
+            files, copied = 1, os.stat(destination).st_size
+            self.item_changed(client_id, destination)
+        self.add_event("copy to %s" % destination, client_id, source)
+        return (0, files, copied)
+
+    # Copies a file to destination, which is replaced. With a write-ahead
+    # log the copy is logged as a write of destination, which names the
+    # chunks of source if the storage keeps chunks
+    def copy_file(self, source, destination):
+        if self.write_log is None:
+            fd, temp_path = tempfile.mkstemp(dir=posixpath.dirname(destination),
+                                             prefix=".", suffix=".tmp")
+            os.close(fd)
+            try:
+                self.storage.copy(source, temp_path)
+                os.replace(temp_path, destination)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+            return
+        manifest = self.storage.copy_manifest(source)
+        if manifest is None:
+            with self.storage.open(source) as file:
+                with self.logged(wal.WRITE, destination, file) as contents:
+                    self.storage.write(destination, contents)
+            return
+        with self.logged(wal.MANIFEST, destination, manifest) as contents:
+            # the chunks are gone if source was deleted since
+            if not self.storage.write_manifest(destination, contents):
+                raise FileNotFoundError("%s was removed during the copy" % source)
+
+    def make_copied_directory(self, path):
+        with self.logged(wal.MKDIR, path):
+            os.makedirs(path, exist_ok=True)
+
+    # Moves a file or a directory tree on the server. A file replaces the
+    # destination file, a directory is moved to a new path. Locks held by
+    # the client on a moved file are released
+    # Return 0 : Move successfull
+    # Return 1 : Source doesn't exist
+    # Return 2 : Source or destination is locked
+    # Return 3 : Destination is a directory that exists
+    # Return 4 : Destination is inside the source directory
+    # Return 5 : Destination's directory doesn't exist
+    def move_item(self, client_id, source_name, destination_name):
+        return self.unlogged(self.move_unlogged, client_id, source_name, destination_name)
+
+    def move_unlogged(self, client_id, source_name, destination_name):
+        source = posixpath.normpath(self.resolve_path(client_id, source_name))
+        destination = posixpath.normpath(self.resolve_path(client_id, destination_name))
+        res = self.check_tree_destination(client_id, source, destination)
+        if res != 0:
+            return res
+        if os.path.isdir(source):
+            if self.locked_files.has_locked_descendants(source):
+                return 2
+            os.rename(source, destination)
+            self.tree_changed(client_id, source)
+            self.directory_cache.invalidate(posixpath.dirname(destination))
+        else:
+            if self.locked_files.is_locked(source, client_id):
+                return 2
+            os.replace(source, destination)
+            self.locked_files.release(client_id, source)
+            self.item_changed(client_id, source)
+            self.item_changed(client_id, destination)
+        self.add_event("move to %s" % destination, client_id, source)
+        return 0
+
+    # Checks that source can be copied or moved to destination, see
+    # copy_item for the return values
+    def check_tree_destination(self, client_id, source, destination):
+        if not os.path.lexists(source):
+            return 1
+        if self.locked_files.is_locked(destination, client_id):
+            return 2
+        if os.path.isdir(destination):
+            return 3
+        if os.path.isdir(source) and os.path.exists(destination):
+            return 3
+        if (destination + "/").startswith(source + "/"):
+            return 4
+        if not os.path.isdir(posixpath.dirname(destination)):
+            return 5
+        return 0
+
+    #
+    # Functions for the write-ahead log
+    #
+
+    # Returns a context manager to apply a change of path in, it gives the
+    # data of the change read from source. With a write-ahead log the change
+    # is logged and on disk when the block starts, see wal.WriteAheadLog
+    def logged(self, kind, path, source=b'', offset=0):
+        if self.write_log is None:
+            return contextlib.nullcontext(source)
+        return self.write_log.change(kind, self.root_relative(path), source, offset)
+
+    # Runs work(*args), a change that isn't logged because applying it again
+    # after a crash could undo the changes made after it, like a move. Other
+    # changes wait and the files are synced before they go on
+    def unlogged(self, work, *args):
+        if self.write_log is None:
+            return work(*args)
+        return self.write_log.checkpoint(lambda: work(*args))
+
+    # Returns the size of a file, 0 if it doesn't exist
+    def file_size(self, file_path):
+        try:
+            with self.storage.open(file_path) as file:
+                return self.storage.fstat(file).st_size
+        except FileNotFoundError:
+            return 0
+
+    # Applies the changes left in the write-ahead log by a crash, called
+    # before the server starts
+    # Returns the number of changes applied
+    def recover(self):
+        return self.write_log.replay(self.redo)
+
+    # Applies a wal.Record again. It may already be applied, or a later
+    # change may have removed its directory, then it is skipped
+    def redo(self, record):
+        path = posixpath.join(self.root_path, record.path)
+        try:
+            if record.kind == wal.WRITE:
+                self.storage.write(path, record.data)
+            elif record.kind == wal.WRITE_AT:
+                self.storage.write_at(path, record.data, record.offset)
+            elif record.kind == wal.MANIFEST:
+                self.storage.write_manifest(path, record.data)
+            elif record.kind == wal.DELETE:
+                self.storage.delete(path)
+            elif record.kind == wal.MKDIR:
+                os.makedirs(path, exist_ok=True)
+            elif record.kind == wal.RMDIR:
+                shutil.rmtree(path)
+        except (OSError, ValueError):
+            pass
 
 
     #
@@ -436,8 +897,30 @@ class FileSystemManager:
     def log_member_data(self):
         print("")
         print("active_clients: "+ (self.active_clients).__repr__())
-        print("events: "+ (self.events).__repr__())
+        print("events: %d in memory" % len(self.journal))
         print("locked_files: "+ (self.locked_files).__repr__())
-        print("next_client_id: %d" % self.next_client_id)
-        print("next_event_id: %d" % self.next_event_id)
+        print("next_client_id: %d" % self.active_clients.next_client_id)
         print("")
+
+if __name__ == '__main__':
+    # Measures the cost of the per request client lookups as the number of
+    # connected clients grows
+    import timeit
+
+    file_manager = FileSystemManager('files')
+    operations = 100000
+    print("clients\tget_active_client\tresolve_path\titem_exists")
+    for num_clients in [10, 100, 1000, 10000]:
+        while len(file_manager.active_clients) < num_clients:
+            file_manager.add_client(None)
+        # the most recent client is the worst case for a linear scan
+        client_id = file_manager.active_clients.next_client_id - 1
+        costs = []
+        for operation in [
+            lambda: file_manager.get_active_client(client_id),
+            lambda: file_manager.resolve_path(client_id, "file1.txt"),
+            lambda: file_manager.item_exists(client_id, "file1.txt"),
+        ]:
+            seconds = timeit.timeit(operation, number=operations)
+            costs.append(seconds / operations * 1e9)
+        print("%d\t%.0f ns\t\t\t%.0f ns\t\t%.0f ns" % tuple([num_clients] + costs))
@@ -0,0 +1,395 @@
+import datetime
+import heapq
+import itertools
+import posixpath
+import threading
+import time
+
+# Lock modes
+SHARED = "shared"
+EXCLUSIVE = "exclusive"
+
+# Results of LockManager.acquire
+LOCKED = 0
+CONFLICT = 1
+ALREADY_HELD = 2
+UPGRADED = 3
+
+DEFAULT_SHARDS = 16
+
+# Seconds a lock is held for unless its holder renews it
+DEFAULT_LEASE_TIME = 60.0
+
+# The lease heap is compacted once it holds more stale entries than this and
+# they make up half of it
+COMPACT_MIN_STALE = 1024
+
+STAT_NAMES = ("granted", "renewed", "released", "expired", "waits", "wait_timeouts")
+
+
+def normalize_path(path):
+    return posixpath.normpath(path)
+
+
+class Lease:
+    # The hold of one client on a lock. It ends at expires (time.monotonic)
+    # unless it is renewed
+    def __init__(self, ttl):
+        self.granted = datetime.datetime.now()
+        self.renew(ttl)
+
+    def renew(self, ttl):
+        self.ttl = ttl
+        self.expires = time.monotonic() + ttl
+
+
+class LockRecord:
+    # A locked path and the clients holding it, with the lease of each of them
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        self.holders = {}
+
+    def __repr__(self):
+        return "LockRecord(%r, %r, %r)" % (self.path, self.mode, sorted(self.holders))
+
+
+class PathTrie:
+    # Counts the locked paths below every directory, so finding out whether a
+    # directory contains locked files walks a single branch
+    def __init__(self):
+        # nodes are [count, children]
+        self.root = [0, {}]
+
+    def add(self, path):
+        node = self.root
+        node[0] = node[0] + 1
+        for part in path.split("/"):
+            node = node[1].setdefault(part, [0, {}])
+            node[0] = node[0] + 1
+
+    def remove(self, path):
+        node = self.root
+        node[0] = node[0] - 1
+        for part in path.split("/"):
+            child = node[1][part]
+            child[0] = child[0] - 1
+            if child[0] == 0:
+                del node[1][part]
+                return
+            node = child
+
+    # Returns the number of locked paths at or below path
+    def count_under(self, path):
+        node = self.root
+        for part in path.split("/"):
+            node = node[1].get(part)
+            if node is None:
+                return 0
+        return node[0]
+
+
+class LeaseTimer:
+    # Expires leases in deadline order from a heap in a background thread.
+    # Each wake up only pops the leases that are due. Renewing or releasing a
+    # lease leaves its entry in the heap, on_expire skips it when it comes up
+    # and once stale entries pile up the heap is rebuilt with the entries
+    # is_live(path, client_id, deadline) keeps
+    def __init__(self, on_expire, is_live):
+        self.on_expire = on_expire
+        self.is_live = is_live
+        self.heap = []
+        self.stale = 0
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def schedule(self, deadline, path, client_id):
+        with self.condition:
+            heapq.heappush(self.heap, (deadline, next(self.counter), path, client_id))
+            # wake the timer if this is now the earliest deadline
+            if self.heap[0][0] == deadline:
+                self.condition.notify()
+            if self.stale > COMPACT_MIN_STALE and self.stale * 2 > len(self.heap):
+                self.compact()
+
+    # Marks one scheduled entry as no longer needed
+    def cancel(self):
+        with self.condition:
+            self.stale = self.stale + 1
+
+    def compact(self):
+        self.heap = [entry for entry in self.heap
+                     if self.is_live(entry[2], entry[3], entry[0])]
+        heapq.heapify(self.heap)
+        self.stale = 0
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    timeout = None
+                    if self.heap:
+                        timeout = self.heap[0][0] - time.monotonic()
+                    self.condition.wait(timeout)
+                due = []
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap))
+            for deadline, _, path, client_id in due:
+                self.on_expire(path, client_id, deadline)
+
+    # Returns the time left before the next deadline, or None
+    def next_deadline(self):
+        with self.condition:
+            if not self.heap:
+                return None
+            return max(self.heap[0][0] - time.monotonic(), 0)
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class LockShard:
+    def __init__(self):
+        self.mutex = threading.Lock()
+        # signalled whenever a lock in the shard is released
+        self.condition = threading.Condition(self.mutex)
+        self.stats = dict((name, 0) for name in STAT_NAMES)
+        # path -> LockRecord
+        self.records = {}
+        # client id -> set of paths the client holds
+        self.client_paths = {}
+        self.trie = PathTrie()
+
+
+class LockManager:
+    # Lock table keyed by normalized path. Paths are spread over shards that
+    # each have their own mutex, so clients locking different files rarely
+    # wait on each other. Every hold is a lease that ends after its ttl
+    # unless renewed. on_expire(path, client_id) is called for each lease
+    # that runs out
+    def __init__(self, num_shards=DEFAULT_SHARDS, on_expire=None):
+        self.shards = [LockShard() for _ in range(num_shards)]
+        self.on_expire = on_expire
+        self.timer = LeaseTimer(self.expire, self.lease_is_live)
+
+    def shard_for(self, path):
+        return self.shards[hash(path) % len(self.shards)]
+
+    # Takes a lock on path for a client, held for ttl seconds. When another
+    # client holds a conflicting lock, waits up to timeout seconds for it to
+    # be released
+    # Return LOCKED : Lock taken
+    # Return ALREADY_HELD : The client already holds a compatible lock, its
+    #                       lease is extended to ttl if that is later
+    # Return UPGRADED : The client was the only holder of a shared lock, it
+    #                   is now exclusive and its lease is extended the same
+    # Return CONFLICT : Another client holds a conflicting lock
+    def acquire(self, client_id, path, mode=EXCLUSIVE, ttl=DEFAULT_LEASE_TIME, timeout=0):
+        path = normalize_path(path)
+        shard = self.shard_for(path)
+        with shard.condition:
+            res = self.acquire_locked(shard, client_id, path, mode, ttl)
+            if res == CONFLICT and timeout > 0:
+                shard.stats["waits"] = shard.stats["waits"] + 1
+                deadline = time.monotonic() + timeout
+                while res == CONFLICT:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        shard.stats["wait_timeouts"] = shard.stats["wait_timeouts"] + 1
+                        break
+                    shard.condition.wait(remaining)
+                    res = self.acquire_locked(shard, client_id, path, mode, ttl)
+            return res
+
+    def acquire_locked(self, shard, client_id, path, mode, ttl):
+        record = shard.records.get(path)
+        if record is None:
+            record = LockRecord(path, mode)
+            shard.records[path] = record
+            shard.trie.add(path)
+        elif client_id in record.holders:
+            upgrade = mode == EXCLUSIVE and record.mode == SHARED
+            # a sole shared holder can upgrade to exclusive
+            if upgrade and len(record.holders) > 1:
+                return CONFLICT
+            lease = record.holders[client_id]
+            if time.monotonic() + ttl > lease.expires:
+                self.renew_lease(shard, path, client_id, lease, ttl)
+            if upgrade:
+                record.mode = EXCLUSIVE
+                return UPGRADED
+            return ALREADY_HELD
+        elif mode == EXCLUSIVE or record.mode == EXCLUSIVE:
+            return CONFLICT
+        lease = Lease(ttl)
+        record.holders[client_id] = lease
+        shard.client_paths.setdefault(client_id, set()).add(path)
+        shard.stats["granted"] = shard.stats["granted"] + 1
+        self.timer.schedule(lease.expires, path, client_id)
+        return LOCKED
+
+    def renew_lease(self, shard, path, client_id, lease, ttl):
+        lease.renew(ttl)
+        self.timer.cancel()
+        shard.stats["renewed"] = shard.stats["renewed"] + 1
+        self.timer.schedule(lease.expires, path, client_id)
+
+    # Extends the lease a client holds on path by ttl seconds from now
+    # Return True : Lease renewed
+    # Return False : The client does not hold a lock on path
+    def renew(self, client_id, path, ttl=DEFAULT_LEASE_TIME):
+        path = normalize_path(path)
+        shard = self.shard_for(path)
+        with shard.mutex:
+            record = shard.records.get(path)
+            if record is None or client_id not in record.holders:
+                return False
+            self.renew_lease(shard, path, client_id, record.holders[client_id], ttl)
+            return True
+
+    # Checks whether a scheduled deadline still belongs to a held lease. Runs
+    # without the shard mutex, a stale answer only keeps an extra entry
+    def lease_is_live(self, path, client_id, deadline):
+        record = self.shard_for(path).records.get(path)
+        if record is None:
+            return False
+        lease = record.holders.get(client_id)
+        return lease is not None and lease.expires <= deadline
+
+    # Called by the timer when a lease deadline passes. The lease is only
+    # released if it wasn't renewed since the deadline was scheduled
+    def expire(self, path, client_id, deadline):
+        shard = self.shard_for(path)
+        with shard.mutex:
+            record = shard.records.get(path)
+            if record is None:
+                return
+            lease = record.holders.get(client_id)
+            if lease is None or lease.expires > deadline:
+                return
+            self.release_locked(shard, client_id, path)
+            shard.stats["expired"] = shard.stats["expired"] + 1
+        if self.on_expire is not None:
+            self.on_expire(path, client_id)
+
+    # Turns the exclusive lock a client upgraded to back into a shared one
+    # Return True : Lock downgraded
+    # Return False : The client does not hold an exclusive lock on path
+    def downgrade(self, client_id, path):
+        path = normalize_path(path)
+        shard = self.shard_for(path)
+        with shard.mutex:
+            record = shard.records.get(path)
+            if record is None or client_id not in record.holders or \
+                    record.mode != EXCLUSIVE:
+                return False
+            record.mode = SHARED
+            # other readers may take it now
+            shard.condition.notify_all()
+            return True
+
+    # Releases the lock a client holds on path
+    # Return True : Lock released
+    # Return False : The client did not hold a lock on path
+    def release(self, client_id, path):
+        path = normalize_path(path)
+        shard = self.shard_for(path)
+        with shard.mutex:
+            if not self.release_locked(shard, client_id, path):
+                return False
+            shard.stats["released"] = shard.stats["released"] + 1
+            return True
+
+    def release_locked(self, shard, client_id, path):
+        record = shard.records.get(path)
+        if record is None or client_id not in record.holders:
+            return False
+        del record.holders[client_id]
+        self.timer.cancel()
+        if not record.holders:
+            del shard.records[path]
+            shard.trie.remove(path)
+        paths = shard.client_paths[client_id]
+        paths.discard(path)
+        if not paths:
+            del shard.client_paths[client_id]
+        # wake clients waiting for the lock
+        shard.condition.notify_all()
+        return True
+
+    # Releases every lock held by a client, returns the released paths
+    def release_client(self, client_id):
+        released = []
+        for shard in self.shards:
+            with shard.mutex:
+                for path in list(shard.client_paths.get(client_id, ())):
+                    self.release_locked(shard, client_id, path)
+                    shard.stats["released"] = shard.stats["released"] + 1
+                    released.append(path)
+        return released
+
+    # Returns the record of a locked path or None
+    def get(self, path):
+        path = normalize_path(path)
+        return self.shard_for(path).records.get(path)
+
+    # Checks whether path is locked by a client other than client_id
+    def is_locked(self, path, client_id=None):
+        record = self.get(path)
+        if record is None:
+            return False
+        return any(holder != client_id for holder in record.holders)
+
+    # Checks whether any file at or below a directory is locked
+    def has_locked_descendants(self, directory):
+        directory = normalize_path(directory)
+        for shard in self.shards:
+            with shard.mutex:
+                if shard.trie.count_under(directory) > 0:
+                    return True
+        return False
+
+    # Returns the ids of the clients holding at least one lock
+    def client_ids(self):
+        client_ids = set()
+        for shard in self.shards:
+            with shard.mutex:
+                client_ids.update(shard.client_paths)
+        return client_ids
+
+    # Returns a snapshot of the locks as
+    # (client_id, time, path, mode, seconds left on the lease)
+    def records(self):
+        records = []
+        now = time.monotonic()
+        for shard in self.shards:
+            with shard.mutex:
+                for record in shard.records.values():
+                    for client_id, lease in record.holders.items():
+                        records.append((client_id, lease.granted, record.path,
+                                        record.mode, max(lease.expires - now, 0)))
+        return records
+
+    # Returns counters of the leases granted, renewed, released and expired
+    # and of the waits for contended locks, along with the number of active
+    # leases and the time to the next deadline
+    def lease_stats(self):
+        stats = dict((name, 0) for name in STAT_NAMES)
+        active = 0
+        for shard in self.shards:
+            with shard.mutex:
+                for name in STAT_NAMES:
+                    stats[name] = stats[name] + shard.stats[name]
+                for record in shard.records.values():
+                    active = active + len(record.holders)
+        stats["active"] = active
+        stats["scheduled"] = len(self.timer)
+        stats["next_expiry"] = self.timer.next_deadline()
+        return stats
+
+    def __len__(self):
+        return sum(len(shard.records) for shard in self.shards)
@@ -0,0 +1,245 @@
+import collections
+import http.server
+import threading
+
+# Counters, gauges and latency histograms of a server. The time each request
+# takes is recorded in a Histogram of its command: log-linear buckets like an
+# HDR histogram, SUB_BUCKETS linear buckets per power of two of
+# microseconds, so any percentile is known within 1/SUB_BUCKETS of its value
+# from a fixed array of counts, whatever the range. The stats command shows
+# them as a table and a stats port serves them, with the gauges, in the
+# Prometheus text format
+
+# Linear buckets per power of two, the relative error of a percentile
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# Longest time recorded exactly, about 71 minutes in microseconds. Longer
+# ones count as this
+HIGHEST = (1 << 32) - 1
+
+# Percentiles the stats command shows
+PERCENTILES = (50, 99, 99.9)
+
+# Upper bounds in seconds of the buckets of the Prometheus histograms, a
+# 1-2-5 series from 50us to 10s
+PROMETHEUS_BOUNDS = (0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01,
+                     0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+PREFIX = "dfs_"
+
+
+# Returns the bucket of a value in microseconds
+def bucket_index(value):
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+# Returns the highest value in microseconds of a bucket
+def bucket_top(index):
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return ((index % SUB_BUCKETS + SUB_BUCKETS + 1) << shift) - 1
+
+BUCKETS = bucket_index(HIGHEST) + 1
+
+
+class Histogram:
+    # Durations recorded in microseconds, see the top of the module
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.highest = 0
+
+    def record(self, seconds):
+        value = min(max(int(seconds * 1000000), 0), HIGHEST)
+        index = bucket_index(value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count = self.count + 1
+            self.total = self.total + value
+            if value > self.highest:
+                self.highest = value
+
+    # Returns a copy that stops changing
+    def snapshot(self):
+        copy = Histogram()
+        with self.lock:
+            copy.counts = list(self.counts)
+            copy.count = self.count
+            copy.total = self.total
+            copy.highest = self.highest
+        return copy
+
+    # Returns the pth percentile in seconds, the top of the bucket holding
+    # it, or 0 if nothing was recorded
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = max(int(self.count * p / 100.0 + 0.5), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen = seen + count
+            if seen >= rank:
+                return min(bucket_top(index), self.highest) / 1000000.0
+        return self.highest / 1000000.0
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count / 1000000.0
+
+    # Returns the number of values of at most bound seconds, for each bound
+    def cumulative(self, bounds):
+        counts = []
+        seen = 0
+        index = 0
+        for bound in bounds:
+            limit = bound * 1000000
+            while index < BUCKETS and bucket_top(index) <= limit:
+                seen = seen + self.counts[index]
+                index = index + 1
+            counts.append(seen)
+        return counts
+
+
+class Metrics:
+    # Requests of each command by status with a histogram of their times,
+    # and gauges read when the metrics are shown
+    def __init__(self):
+        self.lock = threading.Lock()
+        # command -> Histogram
+        self.histograms = collections.OrderedDict()
+        # (command, status) -> requests
+        self.statuses = collections.Counter()
+        # name -> (type, help, function returning the value)
+        self.gauges = collections.OrderedDict()
+
+    def record(self, command, status, seconds):
+        histogram = self.histograms.get(command)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(command, Histogram())
+        histogram.record(seconds)
+        with self.lock:
+            self.statuses[(command, status)] += 1
+
+    # Adds a value read when the metrics are shown. kind is gauge, or
+    # counter for values that only go up
+    def add_gauge(self, name, help, function, kind="gauge"):
+        self.gauges[name] = (kind, help, function)
+
+    # Returns [(name, type, help, value)] of the gauges. A gauge that fails
+    # is left out
+    def read_gauges(self):
+        values = []
+        for name, (kind, help, function) in list(self.gauges.items()):
+            try:
+                values.append((name, kind, help, function()))
+            except Exception:
+                continue
+        return values
+
+    # Returns {command: histogram snapshot} and {(command, status): count}
+    def snapshot(self):
+        with self.lock:
+            histograms = list(self.histograms.items())
+            statuses = dict(self.statuses)
+        return (collections.OrderedDict((command, histogram.snapshot())
+                                        for command, histogram in sorted(histograms)),
+                statuses)
+
+    # Returns the text of the stats command: a line for each command with
+    # its requests, failures and times in milliseconds, then the gauges
+    def report(self):
+        histograms, statuses = self.snapshot()
+        lines = ["Command\tCount\tFailed\tMean ms\t%s\tMax ms" % "\t".join(
+            "p%g ms" % p for p in PERCENTILES)]
+        for command, histogram in histograms.items():
+            failed = sum(count for (name, status), count in statuses.items()
+                         if name == command and status != 0)
+            lines.append("%s\t%d\t%d\t%.3f\t%s\t%.3f" % (
+                command, histogram.count, failed, histogram.mean() * 1000,
+                "\t".join("%.3f" % (histogram.percentile(p) * 1000) for p in PERCENTILES),
+                histogram.highest / 1000.0))
+        lines.append("")
+        for name, kind, help, value in self.read_gauges():
+            lines.append("%s\t%s" % (name, value))
+        return "\n".join(lines)
+
+    # Returns the metrics in the Prometheus text format
+    def prometheus(self):
+        histograms, statuses = self.snapshot()
+        lines = ["# HELP %srequests_total Requests answered, by command and status" % PREFIX,
+                 "# TYPE %srequests_total counter" % PREFIX]
+        for (command, status), count in sorted(statuses.items()):
+            lines.append('%srequests_total{command="%s",status="%d"} %d' % (
+                PREFIX, command, status, count))
+        name = PREFIX + "request_duration_seconds"
+        lines.append("# HELP %s Time taken by the handler of each command" % name)
+        lines.append("# TYPE %s histogram" % name)
+        for command, histogram in histograms.items():
+            counts = histogram.cumulative(PROMETHEUS_BOUNDS)
+            for bound, count in zip(PROMETHEUS_BOUNDS, counts):
+                lines.append('%s_bucket{command="%s",le="%g"} %d' % (name, command, bound, count))
+            lines.append('%s_bucket{command="%s",le="+Inf"} %d' % (name, command, histogram.count))
+            lines.append('%s_sum{command="%s"} %.6f' % (name, command, histogram.total / 1000000.0))
+            lines.append('%s_count{command="%s"} %d' % (name, command, histogram.count))
+        for gauge, kind, help, value in self.read_gauges():
+            lines.append("# HELP %s%s %s" % (PREFIX, gauge, help))
+            lines.append("# TYPE %s%s %s" % (PREFIX, gauge, kind))
+            lines.append("%s%s %s" % (PREFIX, gauge, value))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    # Answers GET /metrics with the metrics of the server
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serves metrics over HTTP on a local port from a daemon thread
+# Returns the HTTP server
+def serve(metrics, port, host='127.0.0.1'):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    # Measures the cost of recording a duration and checks the percentiles
+    # of a known distribution
+    import random
+    import time
+
+    histogram = Histogram()
+    values = [random.expovariate(1000) for _ in range(200000)]
+    started = time.perf_counter()
+    for value in values:
+        histogram.record(value)
+    elapsed = time.perf_counter() - started
+    print("%.0f ns per record" % (elapsed / len(values) * 1e9))
+    values.sort()
+    for p in PERCENTILES + (99.99,):
+        exact = values[min(int(len(values) * p / 100.0 + 0.5), len(values)) - 1]
+        print("p%g: %.1f us, exactly %.1f us" % (
+            p, histogram.percentile(p) * 1e6, exact * 1e6))
@@ -0,0 +1,855 @@
+import asyncio
+import compression
+import concurrent.futures
+import io
+import os
+import socket
+import struct
+import tempfile
+import threading
+import traceback
+
+#
+# Wire protocol shared by the server and the client
+#
+# Every message is a frame made of a fixed size header, an argument block
+# and a payload:
+#
+#   magic       2 bytes   b'DF'
+#   version     1 byte
+#   opcode      1 byte
+#   flags       2 bytes
+#   arg_length  2 bytes   length of the argument block
+#   request_id  4 bytes   echoed back in the response
+#   length      8 bytes   length of the payload
+#
+# The argument block holds the command arguments as utf-8 strings, each one
+# terminated by a NUL byte. The payload is raw bytes (file contents,
+# listings) and is streamed in chunks, it is never built up as a string.
+#
+# Clients don't have to wait for a response before sending the next request.
+# Requests that only read (CONCURRENT_OPCODES) may run at the same time and be
+# answered out of order, clients match responses to requests by request_id.
+#
+
+MAGIC = b'DF'
+VERSION = 1
+
+HEADER = struct.Struct('!2sBBHHIQ')
+
+MAX_ARGS_LENGTH = 0xFFFF
+
+# Size of the chunks payloads are streamed in
+CHUNK_SIZE = 256 * 1024
+
+# Payloads up to this size are sent in the same call as the header
+SMALL_PAYLOAD = 64 * 1024
+
+# Regions up to this size are compressed in memory, bigger ones into a
+# temporary file
+COMPRESS_IN_MEMORY = 256 * 1024
+
+# Payloads read ahead of their use are kept in memory up to this size, in a
+# temporary file beyond it
+SPOOL_MEMORY_LIMIT = 1024 * 1024
+
+# Opcodes
+OP_UNKNOWN = 0
+OP_LS = 1
+OP_CD = 2
+OP_UP = 3
+OP_READ = 4
+OP_WRITE = 5
+OP_DELETE = 6
+OP_LOCK = 7
+OP_RELEASE = 8
+OP_MKDIR = 9
+OP_RMDIR = 10
+OP_PWD = 11
+OP_EXIT = 12
+OP_KILL = 13
+OP_APPEND = 14
+OP_RENEW = 15
+OP_LEASES = 16
+OP_CACHE_STATS = 17
+# Sent by the server, unasked, when a file a client cached has changed
+OP_INVALIDATE = 18
+OP_BATCH = 19
+OP_STAT = 20
+OP_TREE = 21
+OP_DU = 22
+OP_FIND = 23
+OP_COPY = 24
+OP_MOVE = 25
+# Asks which of the chunks whose sha256 fill the payload the server lacks
+OP_CHUNKS = 26
+# Returns the signature of a file a client is about to send a delta of
+OP_SIGNATURE = 27
+# Sent by clients when they connect, the arguments are the compression codecs
+# the client knows, most preferred first. The message of the response names
+# the codec the server picked, it is empty if none
+OP_HELLO = 28
+# Requests to the directory server of a cluster (cluster.py). join and leave
+# add and remove a storage node, nodes lists them and locate names the node
+# of a path
+OP_JOIN = 29
+OP_LEAVE = 30
+OP_NODES = 31
+OP_LOCATE = 32
+# Sent by a storage node to the other copies of a file it changed
+# (replication.py)
+OP_REPLICATE = 33
+# Request counts and latency percentiles of each command and the gauges of
+# the server (metrics.py)
+OP_STATS = 34
+
+COMMANDS = {
+    'ls': OP_LS,
+    'cd': OP_CD,
+    'up': OP_UP,
+    'read': OP_READ,
+    'write': OP_WRITE,
+    'delete': OP_DELETE,
+    'lock': OP_LOCK,
+    'release': OP_RELEASE,
+    'mkdir': OP_MKDIR,
+    'rmdir': OP_RMDIR,
+    'pwd': OP_PWD,
+    'exit': OP_EXIT,
+    'KILL_SERVICE': OP_KILL,
+    'append': OP_APPEND,
+    'renew': OP_RENEW,
+    'leases': OP_LEASES,
+    'cachestats': OP_CACHE_STATS,
+    'batch': OP_BATCH,
+    'stat': OP_STAT,
+    'tree': OP_TREE,
+    'du': OP_DU,
+    'find': OP_FIND,
+    'copy': OP_COPY,
+    'move': OP_MOVE,
+    'chunks': OP_CHUNKS,
+    'signature': OP_SIGNATURE,
+    'hello': OP_HELLO,
+    'join': OP_JOIN,
+    'leave': OP_LEAVE,
+    'nodes': OP_NODES,
+    'locate': OP_LOCATE,
+    'replicate': OP_REPLICATE,
+    'stats': OP_STATS,
+}
+
+COMMAND_NAMES = dict((opcode, name) for name, opcode in COMMANDS.items())
+
+# Requests that don't change anything on the server. Those of one connection
+# may run at the same time, any other request waits for the requests sent
+# before it and runs on its own, so changes happen in the order they were sent
+CONCURRENT_OPCODES = frozenset((OP_READ, OP_LS, OP_PWD, OP_LEASES, OP_CACHE_STATS,
+                                OP_STAT, OP_TREE, OP_DU, OP_FIND, OP_CHUNKS,
+                                OP_SIGNATURE, OP_STATS))
+
+# Most requests of one connection the server runs at the same time
+PIPELINE_DEPTH = 16
+
+# Flags
+FLAG_RESPONSE = 0x0001
+# The last argument of a read is the version tag of a copy the client has
+FLAG_CONDITIONAL = 0x0002
+# On a read, asks the server for an invalidation when the file changes. Set
+# on the response when the server registered the callback
+FLAG_CALLBACK = 0x0004
+# Set on every response frame of a batch but the last
+FLAG_MORE = 0x0008
+# The payload of a write lists the chunks of the file and holds the data of
+# those the server lacks (storage.encode_manifest_write)
+FLAG_MANIFEST = 0x0010
+# On a write, the payload is a delta (delta.py) against the version of the
+# file named by the last argument. On a conditional read, the payload is the
+# signature of the client's copy and the response, when flagged too, carries
+# a delta against that copy
+FLAG_DELTA = 0x0020
+# The payload is compressed with the codec negotiated by OP_HELLO. Either end
+# may set it on any frame, the length in the header is the compressed length
+FLAG_COMPRESSED = 0x0040
+# On a read, the last argument is the least sequence number (replication.py)
+# of the file the client accepts. A copy older than that answers with
+# STATUS_FAILED and cluster.STALE_REPLICA
+FLAG_VERSIONED = 0x0080
+
+# Status codes, sent as the first argument of every response
+STATUS_OK = 0
+STATUS_FAILED = 1
+STATUS_BAD_REQUEST = 2
+STATUS_SERVER_ERROR = 3
+STATUS_NOT_MODIFIED = 4
+# The server has no room for the request, it may be sent again later. Sent
+# with request id 0 before closing a connection the server has no thread for
+STATUS_BUSY = 5
+
+# Legacy clients send "command////arg////arg" text in a single message
+LEGACY_SEPARATOR = '////'
+LEGACY_RECV_SIZE = 64 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ConnectionClosed(Exception):
+    pass
+
+
+def encode_args(args):
+    arg_block = b''.join(str(arg).encode() + b'\0' for arg in args)
+    if len(arg_block) > MAX_ARGS_LENGTH:
+        raise ProtocolError("argument block too long")
+    return arg_block
+
+
+def decode_args(arg_block):
+    if not arg_block:
+        return []
+    return [arg.decode() for arg in arg_block.split(b'\0')[:-1]]
+
+
+class FileRegion:
+    # A byte range of an open file. It is sent with sendfile straight from the
+    # file descriptor instead of being read into memory. Files without a
+    # descriptor are read and sent a chunk at a time
+    def __init__(self, file, offset=0, count=None):
+        self.file = file
+        self.offset = offset
+        if count is None:
+            count = file.seek(0, os.SEEK_END) - offset
+        # files without a descriptor are sent from their position
+        file.seek(offset)
+        self.count = max(count, 0)
+
+    # Yields the region in chunks read with pread
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        offset = self.offset
+        end = self.offset + self.count
+        while offset < end:
+            data = read_at(self.file, min(chunk_size, end - offset), offset)
+            if not data:
+                raise ProtocolError("file shrank while being sent")
+            offset = offset + len(data)
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+# Reads up to size bytes at offset, with pread if the file has a descriptor
+def read_at(file, size, offset):
+    try:
+        fd = file.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        file.seek(offset)
+        return file.read(size)
+    return os.pread(fd, size, offset)
+
+
+class PayloadReader:
+    # Reads a frame payload from a socket or file object without buffering
+    # the whole of it
+    def __init__(self, source, length):
+        self.length = length
+        self.remaining = length
+        readinto = getattr(source, 'recv_into', None)
+        if readinto is None:
+            readinto = source.readinto
+        self._readinto = readinto
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)
+        size = min(len(view), self.remaining)
+        if size == 0:
+            return 0
+        received = self._readinto(view[:size])
+        if not received:
+            raise ConnectionClosed()
+        self.remaining = self.remaining - received
+        return received
+
+    # Reads up to size bytes, or the rest of the payload if size is negative
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        position = 0
+        while position < size:
+            position = position + self.readinto(view[position:])
+        return bytes(buffer)
+
+    # Streams the rest of the payload into a file object
+    def copy_to(self, fileobj):
+        buffer = bytearray(min(CHUNK_SIZE, max(self.remaining, 1)))
+        view = memoryview(buffer)
+        copied = 0
+        while self.remaining > 0:
+            received = self.readinto(view)
+            fileobj.write(view[:received])
+            copied = copied + received
+        return copied
+
+    # Discards whatever is left of the payload
+    def drain(self):
+        buffer = bytearray(min(CHUNK_SIZE, max(self.remaining, 1)))
+        while self.remaining > 0:
+            self.readinto(buffer)
+
+
+def payload_from_bytes(data):
+    return PayloadReader(io.BytesIO(data), len(data))
+
+
+# Reads a payload off its connection into memory, or into a temporary file
+# if it is bigger than SPOOL_MEMORY_LIMIT. The file is the spool attribute
+# of the payload returned
+# Returns a PayloadReader of the contents
+def spool_payload(payload):
+    if payload.length <= SPOOL_MEMORY_LIMIT:
+        return payload_from_bytes(payload.read())
+    spool = tempfile.TemporaryFile()
+    try:
+        payload.copy_to(spool)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    spooled = PayloadReader(spool, payload.length)
+    spooled.spool = spool
+    return spooled
+
+
+# Compresses a payload with codec, the one negotiated for the connection, if
+# that pays. Regions are only compressed once a sample of them compresses
+# well, those bigger than COMPRESS_IN_MEMORY into a temporary file a chunk
+# at a time. Senders close a compressed region once it is sent
+# Returns (payload, flags), flags is FLAG_COMPRESSED if it was compressed
+def compress_payload(codec, payload):
+    if isinstance(payload, FileRegion):
+        if not compression.worth_trying(codec, payload.count):
+            return payload, 0
+        if payload.count > compression.SAMPLE_SIZE * 4:
+            sample = read_at(payload.file, compression.SAMPLE_SIZE, payload.offset)
+            # files without a descriptor are sent from their position
+            payload.file.seek(payload.offset)
+            if not compression.looks_compressible(codec, sample):
+                return payload, 0
+        if payload.count > COMPRESS_IN_MEMORY:
+            return compress_region(codec, payload)
+        payload = b''.join(payload.chunks())
+    compressed = compression.compress(codec, payload)
+    if compressed is None:
+        return payload, 0
+    return compressed, FLAG_COMPRESSED
+
+
+# Closes the temporary file of a region compressed by compress_payload
+def close_compressed(payload, compressed):
+    if compressed and isinstance(payload, FileRegion):
+        payload.close()
+
+
+# Compresses a region into a temporary file a chunk at a time
+# Returns (payload, flags) like compress_payload
+def compress_region(codec, region):
+    compressor = codec.compressor()
+    spool = tempfile.TemporaryFile()
+    try:
+        for chunk in region.chunks():
+            spool.write(compressor.compress(chunk))
+        spool.write(compressor.flush())
+        size = spool.tell()
+    except BaseException:
+        spool.close()
+        raise
+    # files without a descriptor are sent from their position
+    region.file.seek(region.offset)
+    if size > region.count * compression.MAX_RATIO:
+        spool.close()
+        compression.stats.add(True)
+        return region, 0
+    compression.stats.add(False, region.count, size)
+    return FileRegion(spool, 0, size), FLAG_COMPRESSED
+
+
+# Replaces the payload of a frame flagged FLAG_COMPRESSED with its
+# decompressed contents
+def decompress_frame(codec, frame):
+    if frame.payload.length > compression.MAX_PAYLOAD:
+        raise ProtocolError("compressed payload too big")
+    try:
+        data = compression.decompress(codec, frame.payload.read())
+    except ValueError as e:
+        raise ProtocolError(str(e))
+    frame.payload = payload_from_bytes(data)
+    frame.flags = frame.flags & ~FLAG_COMPRESSED
+
+
+# Picks the codec of a connection from a hello request
+# Returns (codec, response args)
+def answer_hello(frame):
+    codec = compression.negotiate(frame.args)
+    return codec, (STATUS_OK, codec.name if codec is not None else '')
+
+
+class Frame:
+    def __init__(self, opcode, flags, request_id, args, payload):
+        self.opcode = opcode
+        self.flags = flags
+        self.request_id = request_id
+        self.args = args
+        self.payload = payload
+
+    @property
+    def command(self):
+        return COMMAND_NAMES.get(self.opcode, 'unknown')
+
+    # Status and message are only meaningful for responses
+    @property
+    def status(self):
+        return int(self.args[0])
+
+    @property
+    def message(self):
+        if len(self.args) > 1:
+            return self.args[1]
+        return ''
+
+
+    # Checks whether the server may run this request alongside others of its
+    # connection. Payloads are read from the connection before the next
+    # request, so requests with one never are
+    def runs_concurrently(self):
+        return self.opcode in CONCURRENT_OPCODES and self.payload.remaining == 0
+
+
+class Response:
+    # parts are responses sent before this one, each in a frame with
+    # FLAG_MORE. It may be a generator that does the work of each part as it
+    # is sent
+    def __init__(self, status, message='', payload=b'', extra=(), flags=0, parts=()):
+        self.status = status
+        self.message = message
+        self.payload = payload
+        self.extra = extra
+        self.flags = flags
+        self.parts = parts
+
+    def args(self):
+        return (self.status, self.message) + tuple(self.extra)
+
+    # Releases the file held by a FileRegion payload
+    def close(self):
+        if isinstance(self.payload, FileRegion):
+            self.payload.close()
+        close_parts = getattr(self.parts, 'close', None)
+        if close_parts is not None:
+            close_parts()
+
+
+#
+# Functions for sending and receiving frames
+#
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    position = 0
+    while position < size:
+        received = sock.recv_into(view[position:])
+        if not received:
+            raise ConnectionClosed()
+        position = position + received
+    return bytes(buffer)
+
+
+# Returns (opcode, flags, arg_length, request_id, length)
+def parse_header(header):
+    magic, version, opcode, flags, arg_length, request_id, length = \
+        HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError("bad frame magic")
+    if version != VERSION:
+        raise ProtocolError("unsupported protocol version %d" % version)
+    return (opcode, flags, arg_length, request_id, length)
+
+
+def recv_frame(sock):
+    opcode, flags, arg_length, request_id, length = \
+        parse_header(recv_exact(sock, HEADER.size))
+    args = decode_args(recv_exact(sock, arg_length))
+    return Frame(opcode, flags, request_id, args, PayloadReader(sock, length))
+
+
+def pack_header(opcode, request_id, arg_block, length, flags):
+    return HEADER.pack(MAGIC, VERSION, opcode, flags, len(arg_block),
+                       request_id, length)
+
+
+def send_region(sock, region):
+    if region.count == 0:
+        return
+    sent = sock.sendfile(region.file, region.offset, region.count)
+    if sent != region.count:
+        raise ProtocolError("file shrank while being sent")
+
+
+def send_frame(sock, opcode, request_id=0, args=(), payload=b'', flags=0):
+    arg_block = encode_args(args)
+    if isinstance(payload, FileRegion):
+        sock.sendall(pack_header(opcode, request_id, arg_block,
+                                 payload.count, flags) + arg_block)
+        send_region(sock, payload)
+        return
+    header = pack_header(opcode, request_id, arg_block, len(payload), flags)
+    if len(payload) <= SMALL_PAYLOAD:
+        sock.sendall(header + arg_block + bytes(payload))
+    else:
+        sock.sendall(header + arg_block)
+        sock.sendall(payload)
+
+
+# Encodes a frame into bytes, used for the requests of a batch
+def encode_frame(opcode, request_id=0, args=(), payload=b'', flags=0):
+    arg_block = encode_args(args)
+    return pack_header(opcode, request_id, arg_block, len(payload), flags) + \
+        arg_block + bytes(payload)
+
+
+# Builds the payload of a batch from (opcode, args, payload) requests
+def encode_batch(requests):
+    return b''.join(encode_frame(opcode, index, args, payload)
+                    for index, (opcode, args, payload) in enumerate(requests))
+
+
+# Reads the requests of a batch from its payload one at a time. The payload
+# of each request is streamed from the batch's and skipped if left unread
+def read_frames(payload):
+    while payload.remaining > 0:
+        if payload.remaining < HEADER.size:
+            raise ProtocolError("truncated batch")
+        opcode, flags, arg_length, request_id, length = \
+            parse_header(payload.read(HEADER.size))
+        if arg_length + length > payload.remaining:
+            raise ProtocolError("truncated batch")
+        args = decode_args(payload.read(arg_length))
+        frame_payload = PayloadReader(payload, length)
+        yield Frame(opcode, flags, request_id, args, frame_payload)
+        frame_payload.drain()
+
+
+#
+# asyncio versions of the functions above
+#
+
+async def read_exact_async(reader, size):
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionClosed()
+
+
+async def send_frame_async(writer, opcode, request_id=0, args=(), payload=b'',
+                           flags=0):
+    arg_block = encode_args(args)
+    if isinstance(payload, FileRegion):
+        writer.write(pack_header(opcode, request_id, arg_block,
+                                 payload.count, flags) + arg_block)
+        await writer.drain()
+        if payload.count > 0:
+            loop = asyncio.get_event_loop()
+            sent = await loop.sendfile(writer.transport, payload.file,
+                                       payload.offset, payload.count)
+            if sent != payload.count:
+                raise ProtocolError("file shrank while being sent")
+        return
+    writer.write(pack_header(opcode, request_id, arg_block, len(payload),
+                             flags) + arg_block)
+    writer.write(payload)
+    await writer.drain()
+
+
+#
+# Server side channels
+#
+
+class TrafficStats:
+    # Frames and bytes the framed channels of a server received and sent,
+    # as they were on the wire
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {"frames_received": 0, "bytes_received": 0,
+                         "frames_sent": 0, "bytes_sent": 0}
+
+    def received(self, size):
+        with self.lock:
+            self.counters["frames_received"] += 1
+            self.counters["bytes_received"] += size
+
+    def sent(self, size):
+        with self.lock:
+            self.counters["frames_sent"] += 1
+            self.counters["bytes_sent"] += size
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+traffic = TrafficStats()
+
+
+# Returns the size on the wire of a frame with args and a payload of length
+# bytes
+def frame_size(args, length):
+    return HEADER.size + sum(len(str(arg).encode()) + 1 for arg in args) + length
+
+
+def payload_size(payload):
+    if isinstance(payload, FileRegion):
+        return payload.count
+    return len(payload)
+
+
+class FramedChannel:
+    def __init__(self, sock):
+        self.sock = sock
+        # invalidations are sent from other threads than responses
+        self.send_lock = threading.Lock()
+        # compression codec picked by the client's hello, None until then
+        self.codec = None
+
+    def next_request(self):
+        while True:
+            frame = recv_frame(self.sock)
+            traffic.received(frame_size(frame.args, frame.payload.length))
+            if frame.opcode == OP_HELLO:
+                frame.payload.drain()
+                codec, args = answer_hello(frame)
+                with self.send_lock:
+                    send_frame(self.sock, OP_HELLO, frame.request_id, args, b'',
+                               FLAG_RESPONSE)
+                    # no compressed response may overtake the hello's
+                    self.codec = codec
+                continue
+            if frame.flags & FLAG_COMPRESSED:
+                decompress_frame(self.codec, frame)
+            return frame
+
+    def send_response(self, request, response):
+        for part in response.parts:
+            try:
+                self.send_frame(request, part, FLAG_MORE)
+            finally:
+                part.close()
+        self.send_frame(request, response)
+
+    # Payloads are compressed before the lock is taken, so other threads
+    # can send while this one compresses
+    def send_frame(self, request, response, flags=0):
+        payload, compressed = compress_payload(self.codec, response.payload)
+        args = response.args()
+        try:
+            with self.send_lock:
+                send_frame(self.sock, request.opcode, request.request_id,
+                           args, payload,
+                           FLAG_RESPONSE | response.flags | flags | compressed)
+        finally:
+            close_compressed(payload, compressed)
+        traffic.sent(frame_size(args, payload_size(payload)))
+
+    # Tells the client that a file it cached has changed
+    def send_invalidation(self, path):
+        with self.send_lock:
+            send_frame(self.sock, OP_INVALIDATE, 0, (path,), b'', FLAG_RESPONSE)
+
+
+# Tells a client the server has no thread for its connection before it is
+# closed. Nothing has been read from the connection yet, so it can't be told
+# whether the client is a legacy one
+def refuse_connection(sock, message="server busy"):
+    try:
+        send_frame(sock, OP_EXIT, 0, (STATUS_BUSY, message), b'', FLAG_RESPONSE)
+    except OSError:
+        pass
+    sock.close()
+
+
+class LegacyChannel:
+    # Compatibility shim for clients that still send "////" separated text
+    # commands. Kept until every client speaks the framed protocol
+    def __init__(self, sock):
+        self.sock = sock
+
+    def next_request(self):
+        data = self.sock.recv(LEGACY_RECV_SIZE)
+        if not data:
+            raise ConnectionClosed()
+        return parse_legacy_request(data.decode(errors='replace'))
+
+    def send_response(self, request, response):
+        self.sock.sendall(render_legacy_response(request, response))
+
+
+def parse_legacy_request(text):
+    parts = text.split(LEGACY_SEPARATOR)
+    opcode = COMMANDS.get(parts[0], OP_UNKNOWN)
+    args = parts[1:]
+    payload = b''
+    # the contents of a write are everything after the file name
+    if opcode == OP_WRITE and len(args) > 1:
+        payload = LEGACY_SEPARATOR.join(args[1:]).encode()
+        args = args[:1]
+    return Frame(opcode, 0, 0, args, payload_from_bytes(payload))
+
+
+def render_legacy_response(request, response):
+    # the payloads of the frames of a streamed response are sent together
+    payload = b''
+    for part in response.parts:
+        try:
+            payload = payload + legacy_payload(part)
+        finally:
+            part.close()
+    payload = payload + legacy_payload(response)
+    # legacy clients cache reads by splitting "path////contents"
+    if request.opcode == OP_READ and response.status == STATUS_OK:
+        return response.message.encode() + LEGACY_SEPARATOR.encode() + payload
+    if payload:
+        return bytes(payload)
+    return response.message.encode()
+
+
+def legacy_payload(response):
+    if isinstance(response.payload, FileRegion):
+        return b''.join(response.payload.chunks())
+    return bytes(response.payload)
+
+
+# Picks the channel type from the first bytes the client sends
+def open_channel(sock):
+    first_bytes = sock.recv(len(MAGIC), socket.MSG_PEEK | socket.MSG_WAITALL)
+    if first_bytes == MAGIC:
+        return FramedChannel(sock)
+    return LegacyChannel(sock)
+
+
+#
+# Client side
+#
+
+class PipelinedConnection:
+    # Client end of a framed connection with any number of requests in
+    # flight. submit sends a request and returns a concurrent.futures.Future
+    # that a reader thread completes with the response frame, whatever order
+    # responses arrive in. Response payloads are read into memory, or a
+    # temporary file if they are big (spool_payload). The frames of a batch before the last one are collected in the parts list
+    # of the last. Pushed invalidations are passed to on_invalidate(path).
+    # Payloads are compressed once negotiate has agreed on a codec
+    def __init__(self, sock, on_invalidate=None):
+        self.sock = sock
+        self.on_invalidate = on_invalidate
+        # request id -> Future of the response
+        self.pending = {}
+        # request id -> frames received so far of a batch
+        self.parts = {}
+        self.next_request_id = 0
+        self.send_lock = threading.Lock()
+        # set once the connection is closed
+        self.error = None
+        self.codec = None
+        thread = threading.Thread(target=self.run_reader)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, opcode, args=(), payload=b'', flags=0):
+        future = concurrent.futures.Future()
+        payload, compressed = compress_payload(self.codec, payload)
+        flags = flags | compressed
+        try:
+            with self.send_lock:
+                if self.error is not None:
+                    raise self.error
+                self.next_request_id = self.next_request_id % 0xFFFFFFFF + 1
+                request_id = self.next_request_id
+                self.pending[request_id] = future
+                try:
+                    send_frame(self.sock, opcode, request_id, args, payload, flags)
+                except BaseException:
+                    del self.pending[request_id]
+                    raise
+        finally:
+            close_compressed(payload, compressed)
+        return future
+
+    # Sends a request and waits for its response
+    def request(self, opcode, args=(), payload=b'', flags=0, timeout=None):
+        return self.submit(opcode, args, payload, flags).result(timeout)
+
+    # Offers the server the codecs named, by default every enabled one, and
+    # compresses payloads with the one it picks. Servers that predate
+    # compression answer with a failure and nothing is compressed
+    # Returns the codec picked, or None
+    def negotiate(self, names=None):
+        if names is None:
+            names = compression.offered()
+        self.request(OP_HELLO, names)
+        return self.codec
+
+    # Sends (opcode, args, payload) requests as one batch. With stop the
+    # server stops at the first one that fails
+    def submit_batch(self, requests, stop=False):
+        args = ("stop",) if stop else ()
+        return self.submit(OP_BATCH, args, encode_batch(requests))
+
+    def run_reader(self):
+        try:
+            while True:
+                frame = recv_frame(self.sock)
+                if frame.flags & FLAG_COMPRESSED:
+                    decompress_frame(self.codec, frame)
+                else:
+                    frame.payload = spool_payload(frame.payload)
+                if frame.opcode == OP_HELLO and frame.status == STATUS_OK:
+                    # set before the next frame is read, it may be compressed
+                    self.codec = compression.find(frame.message)
+                if frame.opcode == OP_EXIT and frame.request_id == 0:
+                    # the server refused the connection
+                    raise ConnectionClosed(frame.message)
+                if frame.opcode == OP_INVALIDATE:
+                    self.invalidated(frame.args[0])
+                    continue
+                if frame.flags & FLAG_MORE:
+                    self.parts.setdefault(frame.request_id, []).append(frame)
+                    continue
+                frame.parts = self.parts.pop(frame.request_id, [])
+                # submit adds requests under the lock
+                with self.send_lock:
+                    future = self.pending.pop(frame.request_id, None)
+                if future is not None:
+                    future.set_result(frame)
+        except Exception as e:
+            # whatever stopped the reader, a corrupt compressed payload
+            # included, no response can come any more
+            with self.send_lock:
+                self.error = ConnectionClosed(str(e) or type(e).__name__)
+                pending, self.pending = self.pending, {}
+            for future in pending.values():
+                future.set_exception(self.error)
+
+    # Passes a pushed invalidation to on_invalidate. Its failures are
+    # printed, they mustn't stop the responses being read
+    def invalidated(self, path):
+        if self.on_invalidate is None:
+            return
+        try:
+            self.on_invalidate(path)
+        except Exception:
+            traceback.print_exc()
+
+    def close(self):
+        self.sock.close()
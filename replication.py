@@ -0,0 +1,317 @@
+import cluster
+import concurrent.futures
+import protocol
+import threading
+import time
+
+# Keeping copies of each file on several storage nodes of a cluster. The
+# directory server says how many copies there are and the ring puts them on
+# consecutive nodes (HashRing.nodes_for). Clients send a change to the first
+# of those nodes that is up, which applies it, numbers it and ships the
+# result to the others with a replicate request:
+#   quorum  the client is answered once a majority of the copies, this
+#           node's included, have the change
+#   async   the client is answered at once and the copies catch up behind
+# Every change to a file takes the next sequence number of the file, so a
+# copy that receives changes out of order or late keeps the newest, and a
+# client that has seen a version can refuse older copies (FLAG_VERSIONED).
+# Sequence numbers follow the clock, so a node that restarts and forgot
+# them numbers its changes after those it made before. A copy refuses a
+# change older than its own, the change doesn't count toward the quorum.
+# The nodes share a cluster key and sign their replicate requests with it,
+# a node refuses changes that aren't signed
+
+MODES = ("quorum", "async")
+
+# Seconds the list of nodes is used before it is fetched again
+REFRESH_INTERVAL = 5.0
+
+# Longest a quorum change waits for the copies to answer, and longest a
+# connection to a copy may stall, it is closed and opened again after
+REPLICA_TIMEOUT = 10.0
+
+# Stripes of the locks that order the changes to one path
+PATH_LOCKS = 64
+
+
+def quorum(copies):
+    return copies // 2 + 1
+
+
+# Returns the lowest sequence number a change made now may take,
+# microseconds since the epoch
+def clock():
+    return time.time_ns() // 1000
+
+
+class VersionTable:
+    # Version of every file changed since the node started, a sequence
+    # number and the node that numbered it, which breaks ties between two
+    # nodes that numbered changes at the same time. A file this node
+    # doesn't know about may have versions from before it started, new
+    # ones are numbered from the clock to come after them
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path relative to the root -> (sequence, node)
+        self.versions = {}
+
+    def get(self, path):
+        with self.lock:
+            return self.versions.get(path, (0, ""))
+
+    # Returns the version of the next change of path made by node
+    def next_version(self, path, node):
+        with self.lock:
+            version = (max(self.versions.get(path, (0, ""))[0] + 1, clock()), node)
+            self.versions[path] = version
+            return version
+
+    def is_newer(self, path, version):
+        with self.lock:
+            return version > self.versions.get(path, (0, ""))
+
+    def set(self, path, version):
+        with self.lock:
+            if version > self.versions.get(path, (0, "")):
+                self.versions[path] = version
+
+
+class Replicator:
+    # Ships the changes a node makes to the other copies of each file.
+    # node is this node's address in the cluster of directory, key the
+    # cluster key its replicate requests are signed with
+    def __init__(self, directory, node, mode="quorum", key=""):
+        self.directory = directory
+        self.node = node
+        self.mode = mode
+        self.key = key
+        self.versions = VersionTable()
+        self.path_locks = [threading.Lock() for _ in range(PATH_LOCKS)]
+        self.lock = threading.Lock()
+        self.ring = cluster.HashRing()
+        self.copies = 1
+        self.fetched = None
+        # node address -> PipelinedConnection, dropped when it fails
+        self.connections = {}
+        self.counters = {"replicated_changes": 0, "replica_failures": 0,
+                         "stale_replicas": 0, "quorum_failures": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    # Lock held while a change of path is applied and numbered, so the
+    # sequence numbers of a path follow the order its changes were made in.
+    # It isn't held while the change is shipped, a copy that gets two
+    # changes the wrong way round keeps the newer by its number
+    def path_lock(self, path):
+        return self.path_locks[cluster.hash_key(path) % PATH_LOCKS]
+
+    # Returns the nodes that keep copies of path, fetching the list of nodes
+    # again when it is old
+    def replicas_for(self, path):
+        now = time.monotonic()
+        with self.lock:
+            fresh = self.fetched is not None and now - self.fetched < REFRESH_INTERVAL
+        if not fresh:
+            try:
+                epoch, nodes, copies = cluster.fetch_nodes(self.directory)
+            except (OSError, protocol.ConnectionClosed, protocol.ProtocolError):
+                # the directory server is down, the nodes known last will do
+                nodes = None
+            with self.lock:
+                if nodes is not None:
+                    self.ring = cluster.HashRing(nodes)
+                    self.copies = copies
+                self.fetched = now
+        with self.lock:
+            ring = self.ring
+            copies = self.copies
+        if self.node not in ring.nodes:
+            return [self.node]
+        return ring.nodes_for(path, copies)
+
+    def connection(self, node):
+        with self.lock:
+            connection = self.connections.get(node)
+        if connection is not None and connection.error is None:
+            return connection
+        if connection is not None:
+            connection.close()
+        sock = cluster.connect(node, REPLICA_TIMEOUT)
+        sock.settimeout(REPLICA_TIMEOUT)
+        connection = protocol.PipelinedConnection(sock)
+        with self.lock:
+            self.connections[node] = connection
+        return connection
+
+    # Closes a connection a request failed on, it may have sent part of a
+    # frame. The next request to node opens a new one
+    def drop(self, node, connection):
+        with self.lock:
+            if self.connections.get(node) is connection:
+                del self.connections[node]
+        connection.close()
+
+    # Sends a change of path to the other copies. action is "write", with
+    # file the open file holding the new contents, or "delete". Called
+    # without the path lock
+    # Returns (futures of the copies' responses, copies there are)
+    def replicate(self, action, path, version, file=None):
+        replicas = self.replicas_for(path)
+        args = (action, path, version[0], version[1])
+        signed = args + (cluster.sign(self.key, args),)
+        futures = []
+        for node in replicas:
+            if node == self.node:
+                continue
+            payload = b''
+            if file is not None:
+                payload = protocol.FileRegion(file, 0)
+            connection = None
+            try:
+                connection = self.connection(node)
+                futures.append(connection.submit(protocol.OP_REPLICATE, signed, payload))
+            except (OSError, protocol.ConnectionClosed):
+                if connection is not None:
+                    self.drop(node, connection)
+                self.count("replica_failures")
+        self.count("replicated_changes")
+        return (futures, len(replicas))
+
+    # Waits for a quorum of the copies to apply a change, in quorum mode
+    # Returns the copies known to have the change, this node's included
+    def wait(self, futures, copies):
+        if self.mode == "async":
+            for future in futures:
+                future.add_done_callback(self.replica_done)
+            return 1
+        needed = quorum(copies)
+        acknowledged = 1
+        try:
+            for future in concurrent.futures.as_completed(futures, REPLICA_TIMEOUT):
+                if self.replica_done(future):
+                    acknowledged = acknowledged + 1
+                if acknowledged >= needed:
+                    break
+        except concurrent.futures.TimeoutError:
+            pass
+        if acknowledged < needed:
+            self.count("quorum_failures")
+        return acknowledged
+
+    # Returns True if a copy applied a change
+    def replica_done(self, future):
+        if future.exception() is None and future.result().status == protocol.STATUS_OK:
+            return True
+        self.count("replica_failures")
+        return False
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for connection in connections.values():
+            connection.close()
+
+
+if __name__ == '__main__':
+    # Starts three storage nodes keeping 1, 2 and 3 copies of each file and
+    # measures writes in each mode and reads spread over the copies, then
+    # stops a node and checks every file can still be read
+    import os
+    import subprocess
+    import sys
+    import tempfile
+
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    here = os.path.dirname(os.path.abspath(__file__))
+    contents = os.urandom(4096)
+    base_port = 9600
+
+    def wait_for(condition):
+        for _ in range(200):
+            try:
+                if condition():
+                    return
+            except OSError:
+                pass
+            time.sleep(0.05)
+        raise RuntimeError("cluster didn't start")
+
+    def run_clients(work):
+        counts = [0] * clients
+        deadline = time.monotonic() + duration
+
+        def run(index):
+            connection = cluster.ClusterConnection(directory)
+            while time.monotonic() < deadline:
+                work(connection, index, counts[index])
+                counts[index] = counts[index] + 1
+            connection.close()
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(counts) / duration
+
+    def write(connection, index, done):
+        connection.request(protocol.OP_WRITE, "w%d-%d" % (index, done % 50), payload=contents)
+
+    def read(connection, index, done):
+        connection.request(protocol.OP_READ, "r%d" % (done % 20)).payload.read()
+
+    for copies in (1, 2, 3):
+        for mode in MODES:
+            if copies == 1 and mode == "async":
+                continue
+            processes = []
+            with tempfile.TemporaryDirectory() as top:
+                try:
+                    directory = "127.0.0.1:%d" % base_port
+                    processes.append(subprocess.Popen(
+                        [sys.executable, os.path.join(here, "directory_server.py"),
+                         "--port", str(base_port), "--replicas", str(copies),
+                         "--cluster-key", "benchmark"],
+                        stdout=subprocess.DEVNULL))
+                    wait_for(lambda: cluster.fetch_nodes(directory))
+                    for index in range(3):
+                        root = os.path.join(top, "node%d" % index)
+                        os.makedirs(root)
+                        processes.append(subprocess.Popen(
+                            [sys.executable, os.path.join(here, "ser.py"), "--quiet",
+                             "--port", str(base_port + 1 + index), "--root", root,
+                             "--directory", directory, "--replication", mode,
+                             "--cluster-key", "benchmark"],
+                            stdout=subprocess.DEVNULL))
+                    wait_for(lambda: len(cluster.fetch_nodes(directory)[1]) == 3)
+                    writes = run_clients(write)
+                    setup = cluster.ClusterConnection(directory)
+                    for index in range(20):
+                        setup.request(protocol.OP_WRITE, "r%d" % index, payload=contents)
+                    reads = run_clients(read)
+                    # the last node stops, files with a copy elsewhere stay readable
+                    processes[-1].kill()
+                    processes[-1].wait()
+                    readable = 0
+                    for index in range(20):
+                        try:
+                            frame = setup.request(protocol.OP_READ, "r%d" % index)
+                            readable = readable + (frame.status == protocol.STATUS_OK)
+                        except protocol.ConnectionClosed:
+                            pass
+                    setup.close()
+                    print("%d copies, %-6s: %6.0f writes/s %6.0f reads/s, "
+                          "%d of 20 files readable with a node down" % (
+                              copies, mode, writes, reads, readable))
+                finally:
+                    for process in processes:
+                        process.kill()
+                        process.wait()
+            base_port = base_port + 10
@@ -1,238 +1,1017 @@
+import argparse
 import socket
+import time
+import threading
 import threadpool
 import os
+import io
+import posixpath
 import file_server
-# global threadpool for server
-server_thread = threadpool.ThreadPool(500)
+import protocol
+import async_server
+import cluster
+import compression
+import lock_manager
+import metrics
+import event_log
+import content_cache
+import delta
+import replication
+import stat
+import storage
+import tempfile
+import tree_ops
+import wal
+# Most clients connected at a time, the next ones are told the server is
+# busy. A thread is kept for each of the first CONNECTION_THREADS even while
+# idle
+MAX_CLIENTS = 500
+CONNECTION_THREADS = 8
+
+# global threadpool for server, a thread per connection
+server_thread = threadpool.ThreadPool(MAX_CLIENTS, CONNECTION_THREADS, max_queue=0)
+# runs the requests connections send without waiting for the previous ones,
+# created in main. Without it every request runs on its connection's thread
+request_thread = None
+
+# Requests that jump the queue of request_thread, cheap ones that shouldn't
+# wait behind big reads
+PRIORITY_OPCODES = frozenset((protocol.OP_PWD, protocol.OP_LS, protocol.OP_STAT,
+                              protocol.OP_LEASES, protocol.OP_CACHE_STATS, protocol.OP_STATS))
 
 port_number = 8019
 
 ip_addr = socket.gethostbyname(socket.gethostname())
 
-file_manager = file_server.FileSystemManager('files')
+# created from the command line arguments by create_file_manager
+file_manager = None
+
+# ships changes to the other copies of each file, created in main when the
+# server joins a cluster
+replicator = None
+
+# request counts and latencies of each command, and the gauges of the server
+server_metrics = metrics.Metrics()
+
+# the asyncio engine, created in start_async_server
+async_engine = None
+
+# Bounds the lock requests waiting for a contended lock. On the asyncio
+# engine they wait on threads of its executor, which every connection
+# shares, so only a quarter of those may wait. Set in start_async_server,
+# connection threads wait without a bound
+lock_waiters = None
+
+def create_file_manager(arguments):
+    global file_manager
+    journal = event_log.EventJournal(
+        arguments.log_file, event_log.LEVELS[arguments.verbosity], not arguments.quiet)
+    cache = content_cache.ContentCache(arguments.cache_size * 1024 * 1024)
+    file_storage = None
+    if arguments.chunk_store:
+        file_storage = storage.ChunkStorage(arguments.root, arguments.chunk_store)
+    write_log = None
+    if arguments.wal:
+        write_log = wal.WriteAheadLog(arguments.wal, arguments.wal_sync == 'group')
+    file_manager = file_server.FileSystemManager(arguments.root, journal, cache,
+                                                 file_storage=file_storage,
+                                                 write_log=write_log)
+    if write_log is not None:
+        replayed = file_manager.recover()
+        if replayed:
+            print("applied %d changes left in the write-ahead log" % replayed)
+
+# Enables the compression codecs named on the command line
+def configure_compression(arguments):
+    names = [name for name in arguments.compression.split(',') if name and name != 'none']
+    compression.configure(names, arguments.compression_level)
+
+# Registers the gauges of the server and serves the metrics on the stats
+# port if there is one
+def configure_metrics(arguments):
+    server_metrics.add_gauge("active_clients", "Clients connected",
+                             lambda: len(file_manager.active_clients))
+    server_metrics.add_gauge("locks_held", "Locks held by clients",
+                             lambda: file_manager.lease_stats()["active"])
+    server_metrics.add_gauge("queue_depth", "Requests waiting for a worker thread", queue_depth)
+    server_metrics.add_gauge("connection_threads", "Threads kept for connections",
+                             lambda: server_thread.stats()["workers"])
+    server_metrics.add_gauge("connections_refused_total", "Connections refused as the server "
+                             "was busy", lambda: server_thread.stats()["tasks_rejected"],
+                             "counter")
+    if request_thread is not None:
+        for name, key, help in (
+                ("worker_threads", "workers", "Threads running requests"),
+                ("request_wait_p99_ms", "wait_p99_ms",
+                 "99th percentile of the time requests waited for a worker thread"),
+                ("requests_refused_total", "tasks_rejected",
+                 "Requests refused as every worker thread was busy")):
+            server_metrics.add_gauge(name, help, lambda key=key: request_thread.stats()[key],
+                                     "counter" if name.endswith("_total") else "gauge")
+    for name, help in (("frames_received", "Frames received"),
+                       ("bytes_received", "Bytes received, headers included"),
+                       ("frames_sent", "Frames sent"),
+                       ("bytes_sent", "Bytes sent, headers included")):
+        server_metrics.add_gauge(name + "_total", help,
+                                 lambda name=name: protocol.traffic.snapshot()[name], "counter")
+    if arguments.stats_port:
+        metrics.serve(server_metrics, arguments.stats_port)
+        print("serving metrics on 127.0.0.1 port %d" % arguments.stats_port)
+
+# Returns the requests waiting for a worker thread
+def queue_depth():
+    if async_engine is not None:
+        return async_engine.queue_depth()
+    if request_thread is not None:
+        return request_thread.queued()
+    return 0
+
+# Adds this server to the directory server of its cluster, called once it
+# is listening
+def join_cluster(directory, key):
+    node = "127.0.0.1:%d" % port_number
+    if cluster.join(directory, node, key) != protocol.STATUS_OK:
+        print("directory server %s refused %s" % (directory, node))
+        os._exit(1)
+    print("joined the cluster of %s as %s" % (directory, node))
 
-def create_server_socket():
+def create_server_socket(backlog=socket.SOMAXCONN, on_listening=None):
     #create socket  and initialise to localhost:8000
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock_addr = ('127.0.0.1', port_number)
     print("starting server on %s port %s" % sock_addr)
-    #bind socket to server address and wait for incoming connections4
+    #bind socket to server address and wait for incoming connections
     sock.bind(sock_addr)
-    sock.listen(1)
+    # a deep backlog so bursts of connections are queued rather than refused
+    sock.listen(backlog)
+    if on_listening is not None:
+        on_listening()
 
     while True:
         connection, client_addr = sock.accept()
-        server_thread.add_task(
+        # pipelined responses and streamed frames shouldn't wait for acks
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # a full pool refuses the connection rather than blocking the
+        # accept loop
+        if not server_thread.add_task(
             start_client_interaction,
             connection,
             client_addr
-        )
+        ):
+            protocol.refuse_connection(connection)
 
 def start_client_interaction(connection, client_addr):
+    client_id = None
+    in_flight = RequestsInFlight(protocol.PIPELINE_DEPTH)
+    try:
+        # framed clients and legacy "////" clients are told apart by the
+        # first bytes they send
+        channel = protocol.open_channel(connection)
+        # A client id is generated, that is associated with this client
+        client_id = file_manager.add_client(
+            connection, getattr(channel, 'send_invalidation', None))
+        # legacy responses carry no request id, so they must stay in order
+        pipelined = request_thread is not None and \
+            isinstance(channel, protocol.FramedChannel)
+        while True:
+            request = channel.next_request()
+            if request.opcode == protocol.OP_EXIT:
+                break
+            if pipelined and request.runs_concurrently():
+                in_flight.acquire()
+                priority = threadpool.HIGH if request.opcode in PRIORITY_OPCODES \
+                    else threadpool.NORMAL
+                if not request_thread.submit(priority, run_request, channel, request,
+                                             client_id, in_flight):
+                    in_flight.release()
+                    refuse_request(channel, request)
+            else:
+                in_flight.wait_idle()
+                run_request(channel, request, client_id)
+    except (protocol.ConnectionClosed, protocol.ProtocolError, OSError):
+        pass
+    finally:
+        # let running requests answer before the connection is closed
+        in_flight.wait_idle()
+        if client_id is not None:
+            file_manager.remove_client(file_manager.get_active_client(client_id))
+        connection.close()
+
+# Runs a request and sends its response. in_flight is released once the
+# response is sent
+def run_request(channel, request, client_id, in_flight=None):
+    try:
+        response = handle_request(request, client_id)
         try:
-            # A client id is generated, that is associated with this client
-            client_id = file_manager.add_client(connection)
-            while True:
-                data = connection.recv(1024).decode()
-                seperate_data = seperate_input_data(data)
-
-                if data == "KILL_SERVICE":
-                    kill_service(connection)
-                elif seperate_data[0] == "ls":
-                    ls(connection, client_id, seperate_data)
-                elif seperate_data[0] == "cd":
-                    cd(connection, seperate_data, client_id)
-                elif seperate_data[0] == "up":
-                    up(connection, seperate_data, client_id)
-                elif seperate_data[0] == "read":
-                    read(connection, seperate_data, client_id)
-                elif seperate_data[0] == "write":
-                    write(connection, seperate_data, client_id)
-                elif seperate_data[0] == "delete":
-                     delete(connection, seperate_data, client_id)
-                elif seperate_data[0] == "lock":
-                    lock(connection, seperate_data, client_id)
-                elif seperate_data[0] == "release":
-                    release(connection, seperate_data, client_id)
-                elif seperate_data[0] == "mkdir":
-                    mkdir(connection, seperate_data, client_id)
-                elif seperate_data[0] == "rmdir":
-                    rmdir(connection, seperate_data, client_id)
-                elif seperate_data[0] == "pwd":
-                    pwd(connection, seperate_data, client_id)
-                elif seperate_data[0] == "exit":
-                    break;
-                else:
-                    error_response(connection, 1)
-        except:
-            error_response(connection, 0)
-            connection.close()
-def kill_service(connection):
+            channel.send_response(request, response)
+        finally:
+            response.close()
+    except OSError:
+        # the connection's own thread sees it closed and cleans up
+        if in_flight is None:
+            raise
+    finally:
+        if in_flight is not None:
+            in_flight.release()
+
+# Answers a request no worker thread has room for
+def refuse_request(channel, request):
+    server_metrics.record(request.command, protocol.STATUS_BUSY, 0)
+    channel.send_response(request, protocol.Response(protocol.STATUS_BUSY, "server busy"))
+
+class RequestsInFlight:
+    # Counts the requests of a connection running on request_thread, at most
+    # limit at a time
+    def __init__(self, limit):
+        self.limit = limit
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.count >= self.limit:
+                self.condition.wait()
+            self.count = self.count + 1
+
+    def release(self):
+        with self.condition:
+            self.count = self.count - 1
+            self.condition.notify_all()
+
+    # Waits until none of the requests are running
+    def wait_idle(self):
+        with self.condition:
+            while self.count > 0:
+                self.condition.wait()
+
+# Runs a request and turns any failure into a "server error" response. The
+# time the handler takes is recorded in the metrics of its command, for
+# streamed responses until the first page
+def handle_request(request, client_id):
+    started = time.perf_counter()
+    try:
+        response = dispatch(request, client_id)
+    except Exception:
+        request.payload.drain()
+        response = error_response(0)
+    server_metrics.record(protocol.COMMAND_NAMES.get(request.opcode, 'unknown'),
+                          response.status, time.perf_counter() - started)
+    return response
+
+def dispatch(request, client_id):
+    handler = handlers.get(request.opcode)
+    if handler is None:
+        request.payload.drain()
+        return error_response(1)
+    if replicator is not None and request.opcode in replicated_opcodes and request.args:
+        return replicated_change(handler, request, client_id)
+    return handler(request, client_id)
+
+# Requests whose changes are shipped to the other copies of their file
+replicated_opcodes = frozenset((protocol.OP_WRITE, protocol.OP_APPEND, protocol.OP_DELETE))
+
+# Runs a request that changes a file, numbers the change and sends the file
+# as it now is to the other copies. The sequence number of the change is
+# added to the response. Without a quorum the change stays here but the
+# client is told it failed. The path lock is let go before the file is
+# sent, two nodes sending each other changes never wait on each other
+def replicated_change(handler, request, client_id):
+    file_path = file_manager.resolve_path(client_id, request.args[0])
+    path = root_path(client_id, request.args[0])
+    file = None
+    with replicator.path_lock(path):
+        response = handler(request, client_id)
+        if response.status != protocol.STATUS_OK:
+            return response
+        version = replicator.versions.next_version(path, replicator.node)
+        if request.opcode != protocol.OP_DELETE:
+            file = file_manager.storage.open(file_path)
+    if file is None:
+        futures, copies = replicator.replicate("delete", path, version)
+    else:
+        with file:
+            futures, copies = replicator.replicate("write", path, version, file)
+    written = replicator.wait(futures, copies)
+    if written < replication.quorum(copies) and replicator.mode == "quorum":
+        return failed_response("only %d of %d copies changed" % (written, copies))
+    response.extra = (version[0],)
+    return response
+
+# Returns the path of an item relative to the root, the same on every node
+def root_path(client_id, item_name):
+    return posixpath.normpath(file_manager.root_relative(
+        file_manager.resolve_path(client_id, item_name)))
+
+# replicate <write|delete> <path> <sequence> <node> <signature> applies a
+# change another node made to its copy of a file, the payload of a write
+# holds the file. The signature is made with the cluster key, requests from
+# anything but a node of the cluster are refused. Changes older than the
+# copy's are refused and not applied
+def replicate(request, client_id):
+    if replicator is None or len(request.args) != 5 or \
+            request.args[0] not in ("write", "delete") or not request.args[2].isdecimal():
+        request.payload.drain()
+        return error_response(1)
+    if not replicator.key or \
+            not cluster.authentic(replicator.key, request.args[:4], request.args[4]):
+        request.payload.drain()
+        return failed_response("not signed with the cluster key")
+    action, path = request.args[:2]
+    version = (int(request.args[2]), request.args[3])
+    # the file is read off the connection before the path lock is taken,
+    # the node sending it may be waiting for this one to read it
+    contents = spool_payload(request.payload)
+    try:
+        return apply_replica(client_id, action, path, version, contents)
+    finally:
+        contents.close()
+
+# Returns the payload of a request read into memory, or into a temporary
+# file if it is large, positioned at its start
+def spool_payload(payload):
+    if payload.length <= async_server.SPOOL_MEMORY_LIMIT:
+        return io.BytesIO(payload.read())
+    spool = tempfile.TemporaryFile()
+    payload.copy_to(spool)
+    spool.seek(0)
+    return spool
+
+# Applies a replicated change unless the copy is already newer
+def apply_replica(client_id, action, path, version, contents):
+    with replicator.path_lock(path):
+        if not replicator.versions.is_newer(path, version):
+            return failed_response("%s is newer" % path)
+        if action == "write":
+            res = file_manager.write_item(client_id, path, contents)
+            response = write_response(res)
+        else:
+            res = file_manager.delete_file(client_id, path)
+            response = ok_response("delete successfull")
+            if res == 1:
+                response = failed_response("file locked")
+        if response.status == protocol.STATUS_OK:
+            replicator.versions.set(path, version)
+        return response
+
+def kill_service(request, client_id):
     # Kill service
-    response = "Killing Service"
-    connection.sendall("%s" % response.encode())
-    connection.close()
     os._exit(0)
 
-def ls(connection, client_id, seperate_data):
-    response = ""
-    if len(seperate_data) == 1:
-        response = file_manager.list_directory_contents(client_id)
-        connection.sendall(response.encode())
-    elif len(seperate_data) == 2:
-        response = file_manager.list_directory_contents(client_id, seperate_data[1])
-        connection.sendall(response.encode())
-    else:
-        error_response(connection, 1)
-
-def cd(connection, seperate_data, client_id):
-    if len(seperate_data) == 2:
-        resp = file_manager.change_directory(seperate_data[1], client_id)
-        response = ""
-        if resp  == 0:
-            response = "changed directory to %s" % seperate_data[1]
+# ls [dir] lists a directory, a line per entry with its type (f or d), size,
+# modification time and name. The listing is streamed a page per frame,
+# the last frame says how many entries there were
+def ls(request, client_id):
+    if len(request.args) > 1:
+        return error_response(1)
+    name = request.args[0] if request.args else ""
+    res, path, pages = file_manager.list_directory(client_id, name)
+    if res == 1:
+        return failed_response("No such directory %s" % name)
+    elif res == 2:
+        return failed_response("Cannot list contents of %s" % name)
+    summary = ok_response("")
+    summary.parts = listing_pages(pages, summary)
+    return summary
+
+def listing_pages(pages, summary):
+    count = 0
+    header = "Type\tSize\tModified\tPath\n"
+    # files in a directory tend to share modification times, each second is
+    # formatted once per page
+    for page in pages:
+        times = {}
+        lines = [format_entry(entry, times) for entry in page]
+        count = count + len(lines)
+        yield protocol.Response(protocol.STATUS_OK, payload=(header + "\n".join(lines)).encode())
+        header = ""
+    summary.message = "%d entries" % count
+
+def format_entry(entry, times):
+    name, is_dir, size, mtime_ns = entry
+    seconds = mtime_ns // 1000000000
+    modified = times.get(seconds)
+    if modified is None:
+        modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+        times[seconds] = modified
+    return "%s\t%d\t%s\t%s" % ("d" if is_dir else "f", size, modified, name)
+
+# tree [dir] lists every entry below a directory with its path from there.
+# Directories are read in parallel and entries streamed as they are found,
+# so the order is not sorted
+def tree(request, client_id):
+    if len(request.args) > 1:
+        return error_response(1)
+    name = request.args[0] if request.args else ""
+    res, path, walk = file_manager.walk_directory(client_id, name)
+    if res != 0:
+        return walk_failed(res, name)
+    summary = ok_response("")
+    summary.parts = listing_pages(paged(tree_entries(walk)), summary)
+    return summary
+
+# find <pattern> [dir] lists the entries below a directory whose name matches
+# a glob pattern, or whose path from there does if the pattern has a /
+def find(request, client_id):
+    if len(request.args) not in (1, 2):
+        return error_response(1)
+    name = request.args[1] if len(request.args) == 2 else ""
+    res, path, walk = file_manager.walk_directory(client_id, name)
+    if res != 0:
+        return walk_failed(res, name)
+    summary = ok_response("")
+    summary.parts = listing_pages(paged(tree_ops.find(walk, request.args[0])), summary)
+    return summary
+
+# du [dir] sums the size of the files below a directory, a line per entry of
+# the directory followed by the total
+def du(request, client_id):
+    if len(request.args) > 1:
+        return error_response(1)
+    name = request.args[0] if request.args else ""
+    res, path, walk = file_manager.walk_directory(client_id, name)
+    if res != 0:
+        return walk_failed(res, name)
+    usage = tree_ops.disk_usage(walk)
+    lines = ["Size\tPath"]
+    lines.extend("%d\t%s" % (size, child) for child, size in sorted(usage.children.items()))
+    lines.append("%d\t%s" % (usage.size, name or "."))
+    message = "%d bytes in %d files and %d directories" % (
+        usage.size, usage.files, usage.directories)
+    return protocol.Response(protocol.STATUS_OK, message, payload="\n".join(lines).encode())
+
+def walk_failed(res, name):
+    if res == 1:
+        return failed_response("No such directory %s" % name)
+    return failed_response("%s is a file" % name)
+
+# Yields the entries of a walk with their path from the top of the walk
+def tree_entries(walk):
+    for relative, entries in walk:
+        for name, is_dir, size, mtime_ns in entries:
+            yield (posixpath.join(relative, name), is_dir, size, mtime_ns)
+
+# Groups entries into pages of file_server.LIST_PAGE_SIZE
+def paged(entries, size=file_server.LIST_PAGE_SIZE):
+    page = []
+    for entry in entries:
+        page.append(entry)
+        if len(page) == size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+def cd(request, client_id):
+    if len(request.args) == 1:
+        resp = file_manager.change_directory(request.args[0], client_id)
+        if resp == 0:
+            return ok_response("changed directory to %s" % request.args[0])
         elif resp == 1:
-            response = "directory %s doesn't exist" % seperate_data[1]
-        connection.sendall(response.encode())
-    else:
-        error_response(connection, 1)
-def up(connection, split_data, client_id):
-    if len(split_data) == 1:
-        file_manager.move_up_directory(client_id)
-    else:
-        error_response(connection, 1)
+            return failed_response("directory %s doesn't exist" % request.args[0])
+    return error_response(1)
 
-def read(connection, split_data, client_id):
-    if len(split_data) == 2:
-        response = file_manager.read_item(client_id, split_data[1])
-        connection.sendall(response.encode())
+def up(request, client_id):
+    if len(request.args) == 0:
+        if file_manager.move_up_directory(client_id) == 0:
+            return ok_response("moved up a directory")
+        return failed_response("already at the top directory")
+    return error_response(1)
+
+# read <path> reads the whole file, read <path> <offset> <length> a byte range.
+# Responses carry the version tag of the file, and ranged ones their offset.
+# A conditional read sends the tag of the client's copy as its last argument
+# and is answered with STATUS_NOT_MODIFIED while the file still has that tag.
+# Whole file reads with FLAG_CALLBACK register a callback, the client is sent
+# an invalidation when the file changes
+def read(request, client_id):
+    args = request.args
+    version = None
+    flags = 0
+    signature = None
+    if request.flags & protocol.FLAG_DELTA:
+        signature = request.payload.read()
+    request.payload.drain()
+    if request.flags & protocol.FLAG_VERSIONED:
+        if len(args) == 0 or not args[-1].isdecimal():
+            return error_response(1)
+        least = int(args[-1])
+        args = args[:-1]
+        if replicator is not None and args and \
+                replicator.versions.get(root_path(client_id, args[0]))[0] < least:
+            replicator.count("stale_replicas")
+            return failed_response(cluster.STALE_REPLICA)
+    if request.flags & protocol.FLAG_CONDITIONAL:
+        if len(args) == 0:
+            return error_response(1)
+        version = args[-1]
+        args = args[:-1]
+    elif signature is not None:
+        return error_response(1)
+    if len(args) == 1:
+        if request.flags & protocol.FLAG_CALLBACK and \
+                file_manager.register_callback(client_id, args[0]):
+            flags = protocol.FLAG_CALLBACK
+        res, file_path, contents, tag = file_manager.read_item(client_id, args[0], version)
+        offset = 0
+        count = None
+        extra = (tag,)
+    elif len(args) == 3 and signature is None:
+        offset = parse_offset(args[1])
+        length = parse_offset(args[2])
+        if offset is None or length is None:
+            return error_response(1)
+        res, file_path, contents, count, tag = file_manager.read_range(
+            client_id, args[0], offset, length, version)
+        extra = (tag, offset)
     else:
-        error_response(connection, 1)
+        return error_response(1)
+    if res == 0:
+        if signature is not None:
+            return delta_response(file_path, contents, signature, extra, flags)
+        # cached contents are sent from memory, other files with sendfile
+        if isinstance(contents, (bytes, memoryview)):
+            return protocol.Response(protocol.STATUS_OK, file_path, contents, extra, flags)
+        region = protocol.FileRegion(contents, offset, count)
+        return protocol.Response(protocol.STATUS_OK, file_path, region, extra, flags)
+    elif res == 3:
+        return protocol.Response(protocol.STATUS_NOT_MODIFIED, file_path, extra=extra,
+                                 flags=flags)
+    elif res == 1:
+        return failed_response("%s doesn't exist" % args[0])
+    elif res == 2:
+        return failed_response("%s is a directory" % args[0])
 
-def write(connection, split_data, client_id):
-    response = ""
-    if len(split_data) == 2:
-        res = file_manager.write_item(client_id, split_data[1], "")
-        if res == 0:
-            response = "write process is successfull"
-        elif res == 1:
-            response = "file locked"
-        elif res == 2:
-            response = "cannot write to a directory file"
-        connection.sendall(response.encode())
-    elif len(split_data) == 3:
-        res = file_manager.write_item(client_id, split_data[1], split_data[2])
+# Answers a read whose client sent the signature of its stale copy with a
+# delta against that copy, when it is smaller than the file. Making it stops
+# early when the copy has too little in common with the file
+def delta_response(file_path, contents, signature, extra, flags):
+    if not isinstance(contents, (bytes, memoryview)):
+        if file_manager.storage.fstat(contents).st_size > delta.MAX_DELTA_FILE:
+            region = protocol.FileRegion(contents)
+            return protocol.Response(protocol.STATUS_OK, file_path, region, extra, flags)
+        with contents:
+            contents = contents.read()
+    try:
+        patch = delta.make_delta(signature, contents,
+                                 int(len(contents) * delta.MAX_LITERAL_FRACTION))
+    except ValueError:
+        return error_response(1)
+    if patch is not None and len(patch) < len(contents):
+        return protocol.Response(protocol.STATUS_OK, file_path, patch, extra,
+                                 flags | protocol.FLAG_DELTA)
+    return protocol.Response(protocol.STATUS_OK, file_path, contents, extra, flags)
+
+# signature <path> returns the signature of a file (delta.signature) and its
+# version tag. A client changing a few bytes of a big file sends a write
+# flagged FLAG_DELTA with a delta against that version
+def signature(request, client_id):
+    if len(request.args) == 1:
+        res, file_path, file_signature, tag = file_manager.file_signature(
+            client_id, request.args[0])
         if res == 0:
-            response = "write process is successfull"
+            return protocol.Response(protocol.STATUS_OK, file_path, file_signature, (tag,))
         elif res == 1:
-            response = "file locked"
+            return failed_response("%s doesn't exist" % request.args[0])
         elif res == 2:
-            response = "cannot write to a directory file"
-        connection.sendall(response.encode())
+            return failed_response("%s is a directory" % request.args[0])
+    return error_response(1)
+
+# write <path> replaces the file, write <path> <offset> writes the payload
+# at offset. With FLAG_MANIFEST the payload lists the chunks of the file
+# and only holds those the server lacks. write <path> <tag> flagged
+# FLAG_DELTA sends a delta against the version tag of the file
+def write(request, client_id):
+    manifest = bool(request.flags & protocol.FLAG_MANIFEST)
+    if manifest and not file_manager.storage.stores_chunks:
+        request.payload.drain()
+        return failed_response("the server doesn't store chunks")
+    if request.flags & protocol.FLAG_DELTA:
+        if len(request.args) != 2 or manifest:
+            request.payload.drain()
+            return error_response(1)
+        try:
+            res = file_manager.write_item(client_id, request.args[0], request.payload,
+                                          basis=request.args[1])
+        except ValueError:
+            request.payload.drain()
+            return error_response(1)
+    elif len(request.args) == 1:
+        try:
+            res = file_manager.write_item(client_id, request.args[0], request.payload,
+                                          manifest)
+        except ValueError:
+            request.payload.drain()
+            return error_response(1)
+    elif manifest:
+        request.payload.drain()
+        return error_response(1)
+    elif len(request.args) == 2 and parse_offset(request.args[1]) is not None:
+        res = file_manager.write_range(
+            client_id, request.args[0], parse_offset(request.args[1]), request.payload)
     else:
-        error_response(connection, 1)
-def delete(connection, split_data, client_id):
-    if len(split_data) == 2:
-        res = file_manager.delete_file(client_id, split_data[1])
-        response = ""
+        request.payload.drain()
+        return error_response(1)
+    # the payload is left unread when the write is refused
+    request.payload.drain()
+    return write_response(res)
+
+def append(request, client_id):
+    if len(request.args) == 1:
+        res = file_manager.append_item(client_id, request.args[0], request.payload)
+        request.payload.drain()
+        return write_response(res)
+    request.payload.drain()
+    return error_response(1)
+
+# stat <path> returns the type (f or d), size, modification time in
+# nanoseconds and version tag of an item
+def stat_item(request, client_id):
+    if len(request.args) == 1:
+        res, file_path, item_stat = file_manager.stat_item(client_id, request.args[0])
         if res == 0:
-            response = "delete successfull"
-        elif res == 1:
-            response = "file locked"
-        elif res == 2:
-            response = "use rmdir to delete a directory"
-        elif res == 3:
-            response = "file doesn't exist"
-        connection.sendall(response.encode())
-    else:
-        error_response(connection, 1)
-def lock(connection, split_data, client_id):
-    if len(split_data) == 2:
-        client = file_manager.get_active_client(client_id)
-        res = file_manager.lock_item(client, split_data[1])
-        response = ""
+            item_type = "d" if stat.S_ISDIR(item_stat.st_mode) else "f"
+            extra = (item_type, item_stat.st_size, item_stat.st_mtime_ns,
+                     content_cache.version_tag(item_stat))
+            return protocol.Response(protocol.STATUS_OK, file_path, extra=extra)
+        return failed_response("%s doesn't exist" % request.args[0])
+    return error_response(1)
+
+# batch [stop] runs the requests encoded in its payload one after the other
+# and streams back a response to each as it finishes, followed by a summary.
+# With stop it ends at the first request that doesn't succeed
+def batch(request, client_id):
+    if request.args not in ([], ["stop"]):
+        request.payload.drain()
+        return error_response(1)
+    summary = ok_response("")
+    summary.parts = run_batch(request, client_id, len(request.args) == 1, summary)
+    return summary
+
+def run_batch(request, client_id, stop, summary):
+    done = 0
+    succeeded = 0
+    try:
+        for sub_request in protocol.read_frames(request.payload):
+            if sub_request.opcode in batch_excluded:
+                sub_request.payload.drain()
+                response = error_response(1)
+            else:
+                response = handle_request(sub_request, client_id)
+            done = done + 1
+            if response.status == protocol.STATUS_OK:
+                succeeded = succeeded + 1
+            yield response
+            if stop and response.status != protocol.STATUS_OK:
+                break
+    finally:
+        request.payload.drain()
+        summary.message = "%d of %d requests succeeded" % (succeeded, done)
+
+# chunks takes the sha256 digests of chunks, 32 bytes each, in its payload
+# and returns those the server doesn't have, so a client writing a file
+# only sends the chunks that are missing
+def chunks(request, client_id):
+    digests = request.payload.read()
+    if request.args or len(digests) % 32 != 0:
+        return error_response(1)
+    missing = file_manager.missing_chunks(
+        [digests[start:start + 32] for start in range(0, len(digests), 32)])
+    if missing is None:
+        return failed_response("the server doesn't store chunks")
+    return protocol.Response(protocol.STATUS_OK, "%d missing" % len(missing),
+                             payload=b"".join(missing))
+
+# Requests that can't be part of a batch
+batch_excluded = (protocol.OP_BATCH, protocol.OP_EXIT, protocol.OP_KILL)
+
+# copy <source> <destination> copies a file, or a directory to a new path.
+# The contents never leave the server, files of a directory are copied in
+# parallel
+def copy(request, client_id):
+    if len(request.args) == 2:
+        source, destination = request.args
+        res, files, copied = file_manager.copy_item(client_id, source, destination)
+        if res == 0:
+            return ok_response("copied %d files, %d bytes to %s" % (files, copied, destination))
+        return tree_change_failed(res, source, destination)
+    return error_response(1)
+
+# move <source> <destination> renames a file, or a directory to a new path
+def move(request, client_id):
+    if len(request.args) == 2:
+        source, destination = request.args
+        res = file_manager.move_item(client_id, source, destination)
         if res == 0:
-            response = "file locked"
+            return ok_response("moved %s to %s" % (source, destination))
+        return tree_change_failed(res, source, destination)
+    return error_response(1)
+
+def tree_change_failed(res, source, destination):
+    if res == 1:
+        return failed_response("%s doesn't exist" % source)
+    elif res == 2:
+        return failed_response("file locked")
+    elif res == 3:
+        return failed_response("directory %s exists" % destination)
+    elif res == 4:
+        return failed_response("cannot copy or move %s inside itself" % source)
+    return failed_response("no directory to put %s in" % destination)
+
+def write_response(res):
+    if res == 0:
+        return ok_response("write process is successfull")
+    elif res == 1:
+        return failed_response("file locked")
+    elif res == 2:
+        return failed_response("cannot write to a directory file")
+    elif res == 3:
+        return failed_response(storage.MISSING_CHUNKS)
+    elif res == 4:
+        return failed_response(delta.BASIS_CHANGED)
+
+def delete(request, client_id):
+    if len(request.args) == 1:
+        res = file_manager.delete_file(client_id, request.args[0])
+        if res == 0:
+            return ok_response("delete successfull")
         elif res == 1:
-            response = "file already locked"
+            return failed_response("file locked")
         elif res == 2:
-            response = "file doesn't exist"
+            return failed_response("use rmdir to delete a directory")
         elif res == 3:
-            response = "locking directories is not supported"
-        connection.sendall(response.encode())
-    else:
-        error_response(connection, 1)
+            return failed_response("file doesn't exist")
+    return error_response(1)
 
-def release(connection, split_data, client_id):
-    if len(split_data) == 2:
+# lock <path> [shared|exclusive] [ttl] [wait]
+# Locks are exclusive by default and last ttl seconds unless renewed. If the
+# file is locked by another client, waits up to wait seconds for it
+def lock(request, client_id):
+    args = list(request.args)
+    mode = lock_manager.EXCLUSIVE
+    if len(args) > 1 and args[1] in lock_modes:
+        mode = args.pop(1)
+    if len(args) < 1 or len(args) > 3:
+        return error_response(1)
+    ttl = lock_manager.DEFAULT_LEASE_TIME
+    wait = 0
+    if len(args) > 1:
+        ttl = parse_seconds(args[1])
+    if len(args) > 2:
+        wait = parse_seconds(args[2])
+    if ttl is None or ttl == 0 or wait is None:
+        return error_response(1)
+    client = file_manager.get_active_client(client_id)
+    res = file_manager.lock_item(client, args[0], mode, ttl)
+    if res == 1 and wait > 0:
+        if lock_waiters is not None and not lock_waiters.acquire(blocking=False):
+            return failed_response("file already locked, too many clients are waiting for "
+                                   "locks to wait for it")
+        try:
+            res = file_manager.lock_item(client, args[0], mode, ttl, min(wait, MAX_LOCK_WAIT))
+        finally:
+            if lock_waiters is not None:
+                lock_waiters.release()
+    if res == 0:
+        return ok_response("file locked")
+    elif res == 1:
+        return failed_response("file already locked")
+    elif res == 2:
+        return failed_response("file doesn't exist")
+    elif res == 3:
+        return failed_response("locking directories is not supported")
+    elif res == 4:
+        return ok_response("you already hold the lock for %s" % args[0])
+    elif res == 5:
+        return ok_response("lock on %s is now exclusive" % args[0])
+
+# renew <path> [ttl]
+def renew(request, client_id):
+    if len(request.args) in (1, 2):
+        ttl = lock_manager.DEFAULT_LEASE_TIME
+        if len(request.args) == 2:
+            ttl = parse_seconds(request.args[1])
+        if ttl is None or ttl == 0:
+            return error_response(1)
         client = file_manager.get_active_client(client_id)
-        res = file_manager.release_item(client, split_data[1])
+        if file_manager.renew_item(client, request.args[0], ttl) == 0:
+            return ok_response("lease on %s renewed for %gs" % (request.args[0], ttl))
+        return failed_response("you do not hold the lock for %s" % request.args[0])
+    return error_response(1)
+
+def cachestats(request, client_id):
+    if len(request.args) == 0:
+        stats = file_manager.content_cache.stats()
+        stats.update(file_manager.directory_cache.stats())
+        stats.update(file_manager.callbacks.stats())
+        stats.update(file_manager.storage.stats())
+        stats.update(compression.stats.snapshot())
+        if file_manager.write_log is not None:
+            stats.update(file_manager.write_log.stats())
+        if replicator is not None:
+            stats.update(replicator.stats())
+        lines = ["%s\t%s" % (name, stats[name]) for name in sorted(stats)]
+        return protocol.Response(protocol.STATUS_OK, payload="\n".join(lines).encode())
+    return error_response(1)
+
+# stats shows the requests, failures and latencies of each command and the
+# gauges of the server
+def server_stats(request, client_id):
+    if len(request.args) == 0:
+        return protocol.Response(protocol.STATUS_OK,
+                                 payload=server_metrics.report().encode())
+    return error_response(1)
+
+def leases(request, client_id):
+    if len(request.args) == 0:
+        stats = file_manager.lease_stats()
+        lines = ["%s\t%s" % (name, stats[name]) for name in sorted(stats)]
+        return protocol.Response(protocol.STATUS_OK, payload="\n".join(lines).encode())
+    return error_response(1)
+
+lock_modes = (lock_manager.SHARED, lock_manager.EXCLUSIVE)
+
+# Longest a lock request may wait for a contended lock
+MAX_LOCK_WAIT = 300.0
+
+def release(request, client_id):
+    if len(request.args) == 1:
+        client = file_manager.get_active_client(client_id)
+        res = file_manager.release_item(client, request.args[0])
         if res == 0:
-            response = split_data[1] + " released"
+            return ok_response(request.args[0] + " released")
         elif res == -1:
-            response = "you do not hold the lock for %s" % split_data[1]
-        connection.sendall(response.encode())
-    else:
-        error_response(connection, 1)
+            return failed_response("you do not hold the lock for %s" % request.args[0])
+    return error_response(1)
 
-def mkdir(connection, split_data, client_id):
-    if len(split_data) == 2:
-        response = ""
-        res = file_manager.make_directory(client_id, split_data[1])
+def mkdir(request, client_id):
+    if len(request.args) == 1:
+        res = file_manager.make_directory(client_id, request.args[0])
         if res == 0:
-            response = "new directory %s created" % split_data[1]
+            return ok_response("new directory %s created" % request.args[0])
         elif res == 1:
-            response = "file of same name exists"
+            return failed_response("file of same name exists")
         elif res == 2:
-            response = "directory of same name exists"
-        connection.sendall(response.encode())
-    else:
-        error_response(connection, 1)
+            return failed_response("directory of same name exists")
+    return error_response(1)
 
-def rmdir(connection, split_data, client_id):
-    if len(split_data) == 2:
-        response = ""
-        res = file_manager.remove_directory(client_id, split_data[1])
+def rmdir(request, client_id):
+    if len(request.args) == 1:
+        res = file_manager.remove_directory(client_id, request.args[0])
         if res == -1:
-            response = "%s doesn't exist" % split_data[1]
+            return failed_response("%s doesn't exist" % request.args[0])
         elif res == 0:
-            response = "%s removed" % split_data[1]
+            return ok_response("%s removed" % request.args[0])
         elif res == 1:
-            response = "%s is a file" % split_data[1]
+            return failed_response("%s is a file" % request.args[0])
         elif res == 2:
-            response = "directory has locked contents"
-        connection.sendall(response.encode())
-    else:
-        error_response(connection, 1)
+            return failed_response("directory has locked contents")
+    return error_response(1)
 
-def pwd(connection, split_data, client_id):
-    if len(split_data) == 1:
-        response = file_manager.get_working_dir(client_id)
-        connection.sendall(response.encode())
-    else:
-        error_response(connection, 1)
-def exit(connection, split_data, client_id):
-    if len(split_data) == 1:
-        file_manager.disconnect_client(connection, client_id)
-    else:
-        error_response(connection, 1)
+def pwd(request, client_id):
+    if len(request.args) == 0:
+        return ok_response(file_manager.get_working_dir(client_id))
+    return error_response(1)
 
-def error_response(connection, error_code):
-    response = ""
-    if error_code == 0:
-        response = "server error"
-    if error_code == 1:
-        response = "unrecognised command"
-    connection.sendall(response.encode())
+# Returns the integer value of a non negative offset or length argument,
+# or None if it isn't one
+def parse_offset(argument):
+    if not argument.isdecimal():
+        return None
+    return int(argument)
 
-def seperate_input_data(input_data):
-    seperated_data = input_data.split('////')
-    return seperated_data
+# Returns the value of a non negative number of seconds, or None
+def parse_seconds(argument):
+    try:
+        seconds = float(argument)
+    except ValueError:
+        return None
+    if not seconds >= 0 or seconds == float('inf'):
+        return None
+    return seconds
 
-if __name__ == '__main__':
-    create_server_socket()
+def ok_response(message):
+    return protocol.Response(protocol.STATUS_OK, message)
 
-    server_thread.wait_completion()
+def failed_response(message):
+    return protocol.Response(protocol.STATUS_FAILED, message)
 
+def error_response(error_code):
+    if error_code == 0:
+        return protocol.Response(protocol.STATUS_SERVER_ERROR, "server error")
+    return protocol.Response(protocol.STATUS_BAD_REQUEST, "unrecognised command")
 
+handlers = {
+    protocol.OP_KILL: kill_service,
+    protocol.OP_LS: ls,
+    protocol.OP_CD: cd,
+    protocol.OP_UP: up,
+    protocol.OP_READ: read,
+    protocol.OP_WRITE: write,
+    protocol.OP_APPEND: append,
+    protocol.OP_DELETE: delete,
+    protocol.OP_LOCK: lock,
+    protocol.OP_RELEASE: release,
+    protocol.OP_RENEW: renew,
+    protocol.OP_LEASES: leases,
+    protocol.OP_CACHE_STATS: cachestats,
+    protocol.OP_MKDIR: mkdir,
+    protocol.OP_RMDIR: rmdir,
+    protocol.OP_PWD: pwd,
+    protocol.OP_STAT: stat_item,
+    protocol.OP_BATCH: batch,
+    protocol.OP_TREE: tree,
+    protocol.OP_DU: du,
+    protocol.OP_FIND: find,
+    protocol.OP_COPY: copy,
+    protocol.OP_MOVE: move,
+    protocol.OP_CHUNKS: chunks,
+    protocol.OP_SIGNATURE: signature,
+    protocol.OP_REPLICATE: replicate,
+    protocol.OP_STATS: server_stats,
+}
+
+def start_async_server(backlog, workers, on_listening=None):
+    global async_engine, lock_waiters
+    lock_waiters = threading.BoundedSemaphore(max(workers // 4, 1))
+    print("starting asyncio server on 127.0.0.1 port %s" % port_number)
+    async_engine = async_server.AsyncServer(file_manager, handle_request, workers)
+    async_engine.run('127.0.0.1', port_number, backlog, on_listening)
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Distributed file system server")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help="one thread per connection or a single asyncio event loop")
+    parser.add_argument('--port', type=int, default=port_number)
+    parser.add_argument('--root', default='files',
+                        help="directory holding the files served")
+    parser.add_argument('--directory', default=None,
+                        help="host:port of a directory server to join as a storage node")
+    parser.add_argument('--replication', choices=replication.MODES, default='quorum',
+                        help="answer changes once a majority of the copies of the file have "
+                             "them, or at once")
+    parser.add_argument('--cluster-key', default=os.environ.get('DFS_CLUSTER_KEY', ''),
+                        help="key shared by the nodes of the cluster, joining it and replicated "
+                             "changes are signed with it (default $DFS_CLUSTER_KEY)")
+    parser.add_argument('--backlog', type=int, default=socket.SOMAXCONN,
+                        help="length of the queue of pending connections")
+    parser.add_argument('--workers', type=int, default=async_server.DEFAULT_WORKERS,
+                        help="threads running requests, shared by all connections")
+    parser.add_argument('--min-workers', type=int, default=4,
+                        help="threads kept running requests while idle, more are started up "
+                             "to --workers when requests wait")
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help="requests waiting for a thread at most once all --workers are "
+                             "busy, the next ones are answered that the server is busy. "
+                             "--workers by default")
+    parser.add_argument('--log-file', default=None,
+                        help="write events to this rotating JSON lines file")
+    parser.add_argument('--verbosity', choices=sorted(event_log.LEVELS), default='debug',
+                        help="least important events that are recorded")
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't print events to stdout")
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help="megabytes of file contents cached in memory, 0 disables the cache")
+    parser.add_argument('--chunk-store', default=None,
+                        help="store files as deduplicated chunks in this directory, outside files")
+    parser.add_argument('--wal', default=None,
+                        help="log changes in this directory, outside files, before applying "
+                             "them so acknowledged changes survive a crash")
+    parser.add_argument('--wal-sync', choices=['group', 'each'], default='group',
+                        help="changes made at the same time share a sync of the log, or each "
+                             "syncs it")
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help="serve the metrics of the server in the Prometheus text format "
+                             "on this local port")
+    parser.add_argument('--compression', default='zlib',
+                        help="comma separated codecs clients may compress payloads with, "
+                             "most preferred first, or none")
+    parser.add_argument('--compression-level', type=int, default=compression.DEFAULT_LEVEL,
+                        help="1 compresses fastest, 9 smallest")
+    arguments = parser.parse_args(argv)
+    for name in arguments.compression.split(','):
+        if name not in compression.codec_types and name not in ('', 'none'):
+            parser.error("unknown compression codec %s" % name)
+    return arguments
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    port_number = arguments.port
+    create_file_manager(arguments)
+    configure_compression(arguments)
+    if arguments.engine == 'threads':
+        request_thread = threadpool.ThreadPool(arguments.workers, arguments.min_workers,
+                                               arguments.queue_size)
+    configure_metrics(arguments)
+    on_listening = None
+    if arguments.directory:
+        on_listening = lambda: join_cluster(arguments.directory, arguments.cluster_key)
+        replicator = replication.Replicator(
+            arguments.directory, "127.0.0.1:%d" % port_number, arguments.replication,
+            arguments.cluster_key)
+    if arguments.engine == 'asyncio':
+        start_async_server(arguments.backlog, arguments.workers, on_listening)
+    else:
+        create_server_socket(arguments.backlog, on_listening)
 
+        server_thread.wait_completion()
@@ -0,0 +1,826 @@
+import hashlib
+import hmac
+import io
+import os
+import protocol
+import random
+import shutil
+import struct
+import tempfile
+import threading
+
+# Size of the chunks file contents are streamed in
+WRITE_CHUNK_SIZE = 256 * 1024
+
+# Permissions given to files created by write
+NEW_FILE_MODE = 0o644
+
+# Copies source into destination through a reusable buffer, so memory use
+# does not depend on the amount of data copied
+def copy_stream(source, destination, chunk_size=WRITE_CHUNK_SIZE):
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    copied = 0
+    while True:
+        received = source.readinto(view)
+        if not received:
+            return copied
+        destination.write(view[:received])
+        copied = copied + received
+
+# Writes source (bytes or a stream with readinto) to the file descriptor fd
+# starting at offset with pwrite. With offset None the data is written at the
+# current position, which is the end of the file for O_APPEND descriptors
+def write_at(fd, source, offset=None, chunk_size=WRITE_CHUNK_SIZE):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        chunks = [memoryview(source)]
+    else:
+        chunks = iter_chunks(source, chunk_size)
+    written = 0
+    for chunk in chunks:
+        while len(chunk) > 0:
+            if offset is None:
+                count = os.write(fd, chunk)
+            else:
+                count = os.pwrite(fd, chunk, offset + written)
+            chunk = chunk[count:]
+            written = written + count
+    return written
+
+# Yields views of a reusable buffer filled from source
+def iter_chunks(source, chunk_size=WRITE_CHUNK_SIZE):
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        received = source.readinto(view)
+        if not received:
+            return
+        yield view[:received]
+
+# Returns the bytes of source, or a stream with readinto reading them
+def as_stream(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return io.BytesIO(source)
+    return source
+
+
+class FileStorage:
+    # Stores each file as it is, in a file of the same path. This is the
+    # interface FileSystemManager reads and writes file contents through,
+    # directories are always plain directories so listings, moves and
+    # removals work on them directly whatever the storage
+    stores_chunks = False
+
+    # Opens a file for reading, raises FileNotFoundError or
+    # IsADirectoryError. The file is binary and seekable, it may not have a
+    # file descriptor
+    def open(self, file_path):
+        return open(file_path, 'rb')
+
+    # Returns the os.stat_result of a file returned by open
+    def fstat(self, file):
+        return os.fstat(file.fileno())
+
+    # Replaces the contents of file_path with source, bytes or a stream with
+    # readinto. The data goes to a temporary file in the same directory in
+    # fixed size chunks, which is then renamed over file_path so readers
+    # never see a half written file
+    def write(self, file_path, source):
+        with self.replacing(file_path) as temp_file:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                temp_file.write(source)
+            else:
+                copy_stream(source, temp_file)
+
+    # Writes source into a file at a byte offset, or at its end if offset is
+    # None, leaving the rest of the file untouched. The file is created if it
+    # doesn't exist
+    def write_at(self, file_path, source, offset):
+        flags = os.O_WRONLY | os.O_CREAT
+        if offset is None:
+            flags = flags | os.O_APPEND
+        fd = os.open(file_path, flags, NEW_FILE_MODE)
+        try:
+            write_at(fd, source, offset)
+        finally:
+            os.close(fd)
+
+    def delete(self, file_path):
+        os.remove(file_path)
+
+    # Copies a file to destination, which is replaced if it exists
+    def copy(self, source, destination):
+        shutil.copyfile(source, destination, follow_symlinks=False)
+        shutil.copymode(source, destination, follow_symlinks=False)
+
+    # Returns the source of a write_manifest that copies a file, or None if
+    # the file is stored as it is
+    def copy_manifest(self, file_path):
+        return None
+
+    # Returns a file object to write the new contents of file_path to. When
+    # the with block ends the file is renamed over file_path, keeping its
+    # permissions
+    def replacing(self, file_path):
+        return ReplacingFile(file_path)
+
+    def stats(self):
+        return {}
+
+
+class ReplacingFile:
+    # Temporary file in the directory of a file that replaces it once
+    # written, or is removed if writing it fails
+    def __init__(self, file_path):
+        self.file_path = file_path
+        directory = os.path.dirname(file_path) or "."
+        fd, self.temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        self.file = os.fdopen(fd, 'wb')
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, error_type, error, traceback):
+        try:
+            self.file.close()
+            if error_type is None:
+                try:
+                    mode = os.stat(self.file_path).st_mode & 0o777
+                except FileNotFoundError:
+                    mode = NEW_FILE_MODE
+                os.chmod(self.temp_path, mode)
+                os.replace(self.temp_path, self.file_path)
+                return
+        except BaseException:
+            os.unlink(self.temp_path)
+            raise
+        os.unlink(self.temp_path)
+
+
+#
+# Content defined chunking
+#
+
+# Chunks are cut where the content says so rather than at fixed offsets, so
+# inserting or removing bytes only changes the chunks around the edit and
+# the rest of a new version of a file is found in the store again.
+# Each position gets one bit from a hash of its byte and the one before it,
+# a gear hash with one bit gear values. A chunk ends after ANCHOR_LENGTH
+# positions in a row with the bit set, about every 8KB past MIN_CHUNK_SIZE.
+# translate, find and xor on big integers do the work in C, there is no loop
+# over bytes in Python
+MIN_CHUNK_SIZE = 2 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+ANCHOR_LENGTH = 12
+ANCHOR = b'\x01' * ANCHOR_LENGTH
+
+# Fixed so every client and server cuts the same data at the same places
+gear = random.Random(0x67656172)
+GEAR_BITS = bytes(gear.getrandbits(1) for _ in range(256))
+PREVIOUS_GEAR_BITS = bytes(gear.getrandbits(1) for _ in range(256))
+
+# Bytes of data read at once when chunking a stream
+CHUNKING_BUFFER = 1024 * 1024
+
+# Returns the gear bit of every position of data, as a bytes of 0 and 1
+def gear_bits(data):
+    if not data:
+        return b''
+    current = int.from_bytes(data.translate(GEAR_BITS), 'big')
+    previous = int.from_bytes(b'\x00' + data[:-1].translate(PREVIOUS_GEAR_BITS), 'big')
+    return (current ^ previous).to_bytes(len(data), 'big')
+
+# Returns the end of the chunk starting at start. A chunk cut at the end of
+# data can only be trusted when at_end, otherwise more data may move the cut
+def chunk_end(data, bits, start, at_end):
+    if len(data) - start <= MIN_CHUNK_SIZE:
+        return len(data) if at_end else None
+    anchor = bits.find(ANCHOR, start + MIN_CHUNK_SIZE - ANCHOR_LENGTH,
+                       start + MAX_CHUNK_SIZE)
+    if anchor != -1:
+        return anchor + ANCHOR_LENGTH
+    if len(data) - start >= MAX_CHUNK_SIZE:
+        return start + MAX_CHUNK_SIZE
+    return len(data) if at_end else None
+
+# Yields the content defined chunks of source, bytes or a stream with
+# readinto, as bytes
+def split_chunks(source):
+    source = as_stream(source)
+    data = b''
+    at_end = False
+    while not at_end:
+        more = source.read(CHUNKING_BUFFER)
+        at_end = not more
+        data = data + more
+        bits = gear_bits(data)
+        start = 0
+        while start < len(data):
+            end = chunk_end(data, bits, start, at_end)
+            if end is None:
+                break
+            yield data[start:end]
+            start = end
+        data = data[start:]
+
+def chunk_digest(chunk):
+    return hashlib.sha256(chunk).digest()
+
+
+#
+# Chunk store
+#
+
+# First line of a manifest, followed by a "<sha256> <length>" line per chunk.
+# The first line goes on with the number of chunks, the size of the file and
+# an HMAC of the rest, keyed with the secret of the store, so no file a
+# client writes can pass for a manifest
+MANIFEST_MAGIC = b"DFS-CHUNKS 2 "
+MAX_MANIFEST_HEADER = len(MANIFEST_MAGIC) + 12 + 1 + 20 + 1 + 64 + 1
+
+# A manifest is never longer than the file it describes, see ChunkStorage
+MAX_MANIFEST_LINE = 64 + 1 + 5 + 1
+
+# File under the chunk root holding the key manifests are signed with
+KEY_NAME = "manifest.key"
+
+# Chunks no file refers to are looked for after this many files were
+# written or deleted
+COLLECT_AFTER = 1000
+
+# Message of the response to a deduplicated write that refers to chunks the
+# server doesn't have, removed since the client asked
+MISSING_CHUNKS = "chunks missing"
+
+# Layout of a deduplicated write, see ChunkStorage.write_manifest
+WRITE_HEADER = struct.Struct('!I')
+WRITE_ENTRY = struct.Struct('!32sIB')
+
+# Most chunks a deduplicated write may list, files of about 8GB
+MAX_WRITE_CHUNKS = 1024 * 1024
+
+
+class WriteGate:
+    # Lets any number of writers and readers in at a time, or the garbage
+    # collector on its own, so it never removes a chunk a write is about to
+    # refer to or a read is streaming
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.writers = 0
+        self.collecting = False
+
+    def __enter__(self):
+        with self.condition:
+            while self.collecting:
+                self.condition.wait()
+            self.writers = self.writers + 1
+
+    def __exit__(self, error_type, error, traceback):
+        with self.condition:
+            self.writers = self.writers - 1
+            if self.writers == 0:
+                self.condition.notify_all()
+
+    def start_collecting(self):
+        with self.condition:
+            while self.collecting or self.writers > 0:
+                self.condition.wait()
+            self.collecting = True
+
+    def stop_collecting(self):
+        with self.condition:
+            self.collecting = False
+            self.condition.notify_all()
+
+
+class ChunkStorage(FileStorage):
+    # Splits the contents of files into content defined chunks and stores
+    # each chunk once, named by its sha256, under chunk_root. The file at a
+    # path holds the manifest of its contents, the list of its chunks,
+    # followed by a hole up to the size of the contents. That way the file
+    # takes the room of its manifest on disk while stat, listings and du see
+    # the real size, and renaming or copying it keeps referring to the same
+    # chunks. Files smaller than MIN_CHUNK_SIZE are stored as they are, and
+    # so are files written before the storage was in use. Manifests are
+    # told apart from them by their signature (MANIFEST_MAGIC), anything
+    # else is read as it is
+    stores_chunks = True
+
+    # file_root is the directory the files are under, chunk_root must be
+    # outside of it
+    def __init__(self, file_root, chunk_root):
+        self.file_root = file_root
+        self.chunk_root = chunk_root
+        os.makedirs(chunk_root, exist_ok=True)
+        self.key = load_key(os.path.join(chunk_root, KEY_NAME))
+        self.gate = WriteGate()
+        self.lock = threading.Lock()
+        # files deleted or replaced since the last collection
+        self.released = 0
+        self.collector = None
+        self.counters = {"chunks_stored": 0, "chunks_reused": 0,
+                         "chunk_bytes_stored": 0, "chunk_bytes_reused": 0,
+                         "chunks_collected": 0}
+
+    def chunk_path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.chunk_root, name[:2], name)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self.chunk_path(digest))
+
+    # Returns the length of a stored chunk, or None if the store lacks it
+    def chunk_length(self, digest):
+        try:
+            return os.path.getsize(self.chunk_path(digest))
+        except FileNotFoundError:
+            return None
+
+    # Stores a chunk unless the store has it already
+    def put_chunk(self, digest, chunk):
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            self.count("chunks_reused", "chunk_bytes_reused", len(chunk))
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.count("chunks_stored", "chunk_bytes_stored", len(chunk))
+
+    def read_chunk(self, digest):
+        with open(self.chunk_path(digest), 'rb') as chunk_file:
+            return chunk_file.read()
+
+    def count(self, chunks, chunk_bytes, size):
+        with self.lock:
+            self.counters[chunks] = self.counters[chunks] + 1
+            self.counters[chunk_bytes] = self.counters[chunk_bytes] + size
+
+    # Returns the chunks of a file as a list of (digest, length), or None if
+    # it is stored as it is
+    def read_manifest(self, file, size):
+        if size < MIN_CHUNK_SIZE:
+            return None
+        try:
+            chunks = self.parse_manifest(file, size)
+        except ValueError:
+            chunks = None
+        if chunks is None:
+            file.seek(0)
+        return chunks
+
+    def parse_manifest(self, file, size):
+        header = file.readline(MAX_MANIFEST_HEADER)
+        if not header.startswith(MANIFEST_MAGIC) or not header.endswith(b"\n"):
+            return None
+        count, manifest_size, signature = header[len(MANIFEST_MAGIC):].split()
+        if int(manifest_size) != size:
+            return None
+        lines = [file.readline(MAX_MANIFEST_LINE) for _ in range(int(count))]
+        if not hmac.compare_digest(self.sign(lines, size), signature):
+            return None
+        chunks = []
+        for line in lines:
+            name, length = line.split()
+            chunks.append((bytes.fromhex(name.decode()), int(length)))
+        return chunks
+
+    # Returns the hex HMAC of the chunk lines of the manifest of a file of
+    # size bytes
+    def sign(self, lines, size):
+        mac = hmac.new(self.key, b"%d\n" % size, hashlib.sha256)
+        for line in lines:
+            mac.update(line)
+        return mac.hexdigest().encode()
+
+    # Writes the manifest of chunks as the new contents of file_path. Files
+    # too small to hold their manifest are stored as they are
+    def put_manifest(self, file_path, chunks):
+        size = sum(length for digest, length in chunks)
+        lines = [b"%s %d\n" % (digest.hex().encode(), length) for digest, length in chunks]
+        manifest = MANIFEST_MAGIC + b"%d %d %s\n" % (
+            len(chunks), size, self.sign(lines, size)) + b"".join(lines)
+        with self.replacing(file_path) as temp_file:
+            if size < MIN_CHUNK_SIZE or len(manifest) > size:
+                for digest, length in chunks:
+                    temp_file.write(self.read_chunk(digest))
+            else:
+                temp_file.write(manifest)
+                temp_file.truncate(size)
+        self.file_released()
+
+    # A file read from its chunks keeps the garbage collector out until it
+    # is closed
+    def open(self, file_path):
+        file = open(file_path, 'rb')
+        self.gate.__enter__()
+        try:
+            file_stat = os.fstat(file.fileno())
+            chunks = self.read_manifest(file, file_stat.st_size)
+        except BaseException:
+            file.close()
+            self.gate.__exit__(None, None, None)
+            raise
+        if chunks is None:
+            self.gate.__exit__(None, None, None)
+            return file
+        file.close()
+        return ChunkFile(self, chunks, file_stat)
+
+    def fstat(self, file):
+        if isinstance(file, ChunkFile):
+            return file.stat
+        return os.fstat(file.fileno())
+
+    def write(self, file_path, source):
+        source = as_stream(source)
+        head = source.read(MIN_CHUNK_SIZE)
+        if len(head) < MIN_CHUNK_SIZE:
+            FileStorage.write(self, file_path, head)
+            self.file_released()
+            return
+        with self.gate:
+            chunks = []
+            for chunk in split_chunks(ChainedStream(head, source)):
+                digest = chunk_digest(chunk)
+                self.put_chunk(digest, chunk)
+                chunks.append((digest, len(chunk)))
+            self.put_manifest(file_path, chunks)
+
+    # Range writes and appends rebuild the file in a temporary file and
+    # split it again. The chunks the edit didn't touch are found in the
+    # store, only those around the edit are new
+    def write_at(self, file_path, source, offset):
+        with tempfile.TemporaryFile(dir=self.chunk_root) as spool:
+            try:
+                with self.open(file_path) as file:
+                    copy_stream(file, spool)
+            except FileNotFoundError:
+                pass
+            spool.flush()
+            if offset is None:
+                offset = spool.tell()
+            write_at(spool.fileno(), source, offset)
+            spool.seek(0)
+            self.write(file_path, spool)
+
+    # Writes a file whose chunks were split by the client. source holds the
+    # number of chunks, then for each its sha256, length and whether its
+    # data follows, then the data of the chunks the client sent, in order.
+    # Clients ask which chunks are missing first and only send those. The
+    # length of a chunk that isn't sent must be the one the store has
+    # Raises ValueError if the write is malformed
+    # Returns True, or False if chunks the client didn't send are missing
+    def write_manifest(self, file_path, source):
+        count, = WRITE_HEADER.unpack(read_exact(source, WRITE_HEADER.size))
+        if count > MAX_WRITE_CHUNKS:
+            raise ValueError("too many chunks")
+        entries = []
+        for _ in range(count):
+            digest, length, included = WRITE_ENTRY.unpack(read_exact(source, WRITE_ENTRY.size))
+            if not 0 < length <= MAX_CHUNK_SIZE:
+                raise ValueError("chunk length out of range")
+            entries.append((digest, length, included))
+        with self.gate:
+            for digest, length, included in entries:
+                if included:
+                    chunk = read_exact(source, length)
+                    if chunk_digest(chunk) != digest:
+                        raise ValueError("chunk doesn't match its digest")
+                    self.put_chunk(digest, chunk)
+                    continue
+                stored = self.chunk_length(digest)
+                if stored is None:
+                    return False
+                if stored != length:
+                    raise ValueError("chunk length doesn't match the store")
+            self.put_manifest(file_path, [(digest, length)
+                                          for digest, length, included in entries])
+        return True
+
+    # Returns the digests the store doesn't have
+    def missing_chunks(self, digests):
+        return [digest for digest in digests if not self.has_chunk(digest)]
+
+    def delete(self, file_path):
+        os.remove(file_path)
+        self.file_released()
+
+    # A copy of a manifest refers to the same chunks, nothing is duplicated.
+    # The manifest is read with the collector kept out, its chunks can't go
+    # if the source is deleted meanwhile
+    def copy(self, source, destination):
+        with self.gate:
+            with open(source, 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                chunks = self.read_manifest(file, size)
+            if chunks is not None:
+                self.put_manifest(destination, chunks)
+        if chunks is None:
+            FileStorage.copy(self, source, destination)
+            return
+        shutil.copymode(source, destination)
+
+    # The write of a copy names the chunks of the manifest, none are sent
+    def copy_manifest(self, file_path):
+        with open(file_path, 'rb') as file:
+            chunks = self.read_manifest(file, os.fstat(file.fileno()).st_size)
+        if chunks is None:
+            return None
+        return WRITE_HEADER.pack(len(chunks)) + b"".join(
+            WRITE_ENTRY.pack(digest, length, False) for digest, length in chunks)
+
+    # Starts a collection in the background once enough files were deleted
+    # or replaced to have freed chunks
+    def file_released(self):
+        with self.lock:
+            self.released = self.released + 1
+            if self.released < COLLECT_AFTER or self.collector is not None:
+                return
+            self.released = 0
+            self.collector = threading.Thread(target=self.collect_in_background)
+            self.collector.daemon = True
+        self.collector.start()
+
+    def collect_in_background(self):
+        try:
+            self.collect_garbage(self.file_root)
+        finally:
+            with self.lock:
+                self.collector = None
+
+    # Removes the chunks no manifest below root refers to. Writes wait
+    # while it runs
+    # Returns the number of chunks removed
+    def collect_garbage(self, root):
+        self.gate.start_collecting()
+        try:
+            used = set()
+            for directory, directories, files in os.walk(root):
+                for name in files:
+                    try:
+                        with open(os.path.join(directory, name), 'rb') as file:
+                            size = os.fstat(file.fileno()).st_size
+                            chunks = self.read_manifest(file, size)
+                    except FileNotFoundError:
+                        continue
+                    if chunks is not None:
+                        used.update(digest.hex() for digest, length in chunks)
+            removed = 0
+            for directory, directories, files in os.walk(self.chunk_root):
+                # chunks are in subdirectories, the key is above them
+                if os.path.samefile(directory, self.chunk_root):
+                    continue
+                for name in files:
+                    if name not in used:
+                        os.remove(os.path.join(directory, name))
+                        removed = removed + 1
+        finally:
+            self.gate.stop_collecting()
+        with self.lock:
+            self.counters["chunks_collected"] = self.counters["chunks_collected"] + removed
+        return removed
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+class ChunkFile(io.RawIOBase):
+    # Reads the contents of a file from its chunks. A chunk is read when the
+    # position reaches it, so memory use is one chunk whatever the size of
+    # the file. It has no file descriptor, sockets send it with read. It
+    # holds the gate of the storage until it is closed
+    def __init__(self, storage, chunks, file_stat):
+        self.storage = storage
+        self.chunks = chunks
+        self.stat = file_stat
+        # offset of the start of each chunk
+        self.offsets = []
+        size = 0
+        for digest, length in chunks:
+            self.offsets.append(size)
+            size = size + length
+        self.size = size
+        self.position = 0
+        self.current = None
+        self.current_data = b''
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.storage.gate.__exit__(None, None, None)
+        io.RawIOBase.close(self)
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset = offset + self.position
+        elif whence == io.SEEK_END:
+            offset = offset + self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return offset
+
+    # Reads size bytes, less only at the end of the file
+    def read(self, size=-1):
+        if size < 0:
+            size = max(self.size - self.position, 0)
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        filled = 0
+        while filled < size:
+            count = self.readinto(view[filled:])
+            if not count:
+                break
+            filled = filled + count
+        return bytes(view[:filled])
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        index = self.chunk_at(self.position)
+        if index != self.current:
+            self.current_data = self.storage.read_chunk(self.chunks[index][0])
+            self.current = index
+        start = self.position - self.offsets[index]
+        count = min(len(buffer), len(self.current_data) - start)
+        buffer[:count] = self.current_data[start:start + count]
+        self.position = self.position + count
+        return count
+
+    def chunk_at(self, position):
+        low = 0
+        high = len(self.offsets) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.offsets[middle] <= position:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+
+# Returns the key in key_path, made up the first time
+def load_key(key_path):
+    try:
+        with open(key_path, 'rb') as key_file:
+            return key_file.read()
+    except FileNotFoundError:
+        pass
+    key = os.urandom(32)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(key_path), suffix=".tmp")
+    with os.fdopen(fd, 'wb') as key_file:
+        key_file.write(key)
+    try:
+        # another storage on the same root may have made one meanwhile
+        os.link(temp_path, key_path)
+    except FileExistsError:
+        with open(key_path, 'rb') as key_file:
+            key = key_file.read()
+    finally:
+        os.unlink(temp_path)
+    return key
+
+
+class ChainedStream:
+    # Reads head, then the rest of source
+    def __init__(self, head, source):
+        self.head = head
+        self.source = source
+
+    def read(self, size):
+        if self.head:
+            data, self.head = self.head[:size], self.head[size:]
+            return data
+        return self.source.read(size)
+
+
+# Reads exactly size bytes from a stream, raises ValueError if it ends first
+def read_exact(source, size):
+    data = source.read(size)
+    if len(data) != size:
+        raise ValueError("payload ended early")
+    return data
+
+
+#
+# Client side of deduplicated writes
+#
+
+# Builds the payload of a deduplicated write from (digest, chunk) pairs.
+# The data of the chunks in send goes along once, the others are only named
+def encode_manifest_write(chunks, send):
+    entries = [WRITE_HEADER.pack(len(chunks))]
+    data = []
+    for digest, chunk in chunks:
+        included = digest in send
+        if included:
+            data.append(chunk)
+            send = send - {digest}
+        entries.append(WRITE_ENTRY.pack(digest, len(chunk), included))
+    return b"".join(entries + data)
+
+# Writes source to the file name over a protocol.PipelinedConnection,
+# sending only the chunks the server doesn't have. Falls back to a plain
+# write when the server doesn't store chunks
+# Returns the response frame and the number of bytes of chunks sent
+def write_deduplicated(connection, name, source):
+    chunks = [(chunk_digest(chunk), chunk) for chunk in split_chunks(source)]
+    digests = [digest for digest, chunk in chunks]
+    response = connection.request(protocol.OP_CHUNKS, payload=b"".join(digests))
+    if response.status == protocol.STATUS_OK:
+        listed = response.payload.read()
+        missing = set(listed[start:start + 32] for start in range(0, len(listed), 32))
+        response = connection.request(protocol.OP_WRITE, (name,),
+                                      encode_manifest_write(chunks, missing),
+                                      protocol.FLAG_MANIFEST)
+        if response.message != MISSING_CHUNKS:
+            return response, sum(len(chunk) for digest, chunk in chunks
+                                 if digest in missing)
+    data = b"".join(chunk for digest, chunk in chunks)
+    return connection.request(protocol.OP_WRITE, (name,), data), len(data)
+
+
+if __name__ == '__main__':
+    # Writes successive versions of a dataset, each a few edits away from
+    # the last, with both storages and compares the room they take on disk
+    # and the bytes a client sends with plain and deduplicated writes
+    import sys
+    import time
+
+    files = 20
+    versions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    generator = random.Random(1)
+    words = [bytes(generator.choice(b"abcdefghijklmnopqrstuvwxyz")
+                   for _ in range(generator.randint(2, 10))) for _ in range(5000)]
+    dataset = [b" ".join(generator.choice(words) for _ in range(40000)) for _ in range(files)]
+
+    # Inserts, deletes and overwrites a few short runs of bytes
+    def edit(data):
+        for _ in range(generator.randint(1, 5)):
+            position = generator.randrange(len(data))
+            change = generator.choice(words) * generator.randint(1, 20)
+            kind = generator.randrange(3)
+            if kind == 0:
+                data = data[:position] + change + data[position:]
+            elif kind == 1:
+                data = data[:position] + data[position + len(change):]
+            else:
+                data = data[:position] + change + data[position + len(change):]
+        return data
+
+    def disk_usage(root):
+        used = 0
+        for directory, directories, names in os.walk(root):
+            for name in names:
+                used = used + os.stat(os.path.join(directory, name)).st_blocks * 512
+        return used
+
+    with tempfile.TemporaryDirectory() as top:
+        plain = FileStorage()
+        chunked = ChunkStorage(os.path.join(top, "chunked"), os.path.join(top, "chunks"))
+        os.makedirs(os.path.join(top, "plain"))
+        os.makedirs(os.path.join(top, "chunked"))
+        written = 0
+        sent = 0
+        plain_time = 0
+        chunked_time = 0
+        for version in range(versions):
+            for index in range(files):
+                if version > 0:
+                    dataset[index] = edit(dataset[index])
+                data = dataset[index]
+                name = "v%d-f%d" % (version, index)
+                start = time.perf_counter()
+                plain.write(os.path.join(top, "plain", name), data)
+                plain_time = plain_time + time.perf_counter() - start
+                start = time.perf_counter()
+                chunks = [(chunk_digest(chunk), chunk) for chunk in split_chunks(data)]
+                missing = set(chunked.missing_chunks([digest for digest, chunk in chunks]))
+                payload = encode_manifest_write(chunks, missing)
+                chunked.write_manifest(os.path.join(top, "chunked", name), io.BytesIO(payload))
+                chunked_time = chunked_time + time.perf_counter() - start
+                written = written + len(data)
+                sent = sent + len(payload) + 32 * len(chunks)
+        chunked_usage = disk_usage(os.path.join(top, "chunked")) + disk_usage(os.path.join(top, "chunks"))
+        print("%d versions of %d files, %.1f MB written" % (versions, files, written / 1e6))
+        print("plain:   %.1f MB on disk, %.1f MB sent, %.2fs" % (
+            disk_usage(os.path.join(top, "plain")) / 1e6, written / 1e6, plain_time))
+        print("chunked: %.1f MB on disk, %.1f MB sent, %.2fs" % (
+            chunked_usage / 1e6, sent / 1e6, chunked_time))
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# the modules of the file system sit at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import file_server  # noqa: E402
+
+
+# A file manager serving a fresh root. Paths are relative to the working
+# directory, as for ser.py, so the test runs from the root's parent
+@pytest.fixture
+def file_manager(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("files")
+    return file_server.FileSystemManager("files")
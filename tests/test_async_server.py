@@ -0,0 +1,111 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+import async_server
+import protocol
+import ser
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Runs an asyncio engine over a fresh root on a loop of its own
+@pytest.fixture
+def address(file_manager, monkeypatch):
+    monkeypatch.setattr(ser, "file_manager", file_manager)
+    engine = async_server.AsyncServer(file_manager, ser.handle_request, 4)
+    port = free_port()
+    listening = threading.Event()
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(engine.serve('127.0.0.1', port, 16, listening.set))
+
+    def run():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    assert listening.wait(5)
+    yield ('127.0.0.1', port)
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join(5)
+    engine.executor.shutdown()
+
+
+def test_framed_requests(address):
+    connection = protocol.PipelinedConnection(socket.create_connection(address))
+    try:
+        response = connection.request(protocol.OP_WRITE, ("a.txt",), b"hello", timeout=5)
+        assert response.status == protocol.STATUS_OK
+        # reads are pipelined and matched to their requests by id
+        futures = [connection.submit(protocol.OP_READ, ("a.txt",)) for _ in range(8)]
+        futures.append(connection.submit(protocol.OP_READ, ("missing.txt",)))
+        results = [future.result(5) for future in futures]
+        assert [frame.payload.read() for frame in results[:8]] == [b"hello"] * 8
+        assert results[8].status == protocol.STATUS_FAILED
+        assert connection.request(protocol.OP_UNKNOWN, timeout=5).status == \
+            protocol.STATUS_BAD_REQUEST
+    finally:
+        connection.close()
+
+
+def test_legacy_client(address):
+    with socket.create_connection(address) as sock:
+        sock.sendall(b"write////b.txt////contents")
+        assert b"successfull" in sock.recv(1024)
+        sock.sendall(b"read////b.txt")
+        deadline = time.monotonic() + 5
+        data = b''
+        while not data.endswith(b"contents") and time.monotonic() < deadline:
+            data = data + sock.recv(1024)
+        assert data == b"files/b.txt////contents"
+
+
+class Channel:
+    def __init__(self):
+        self.responses = []
+
+    async def send_response(self, request, response):
+        self.responses.append(response)
+
+
+def test_queue_depth_counts_requests_waiting(file_manager):
+    release = threading.Event()
+
+    def handle_request(request, client_id):
+        release.wait(5)
+        return ser.ok_response("done")
+
+    engine = async_server.AsyncServer(file_manager, handle_request, 1)
+    channel = Channel()
+    request = protocol.Frame(protocol.OP_READ, 0, 1, ["a.txt"], protocol.payload_from_bytes(b''))
+
+    async def run():
+        tasks = [asyncio.ensure_future(engine.run_request(channel, request, 0))
+                 for _ in range(3)]
+        deadline = time.monotonic() + 5
+        while engine.queue_depth() != 2 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        depth = engine.queue_depth()
+        release.set()
+        await asyncio.gather(*tasks)
+        return depth
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(run()) == 2
+    finally:
+        loop.close()
+        engine.executor.shutdown()
+    assert len(channel.responses) == 3
+    assert engine.queue_depth() == 0
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import callbacks
+
+
+class Clients:
+    # notify_for of the index, recording the paths each client was sent
+    def __init__(self):
+        self.received = {}
+        self.condition = threading.Condition()
+        self.notify = {}
+
+    def __call__(self, client_id):
+        return self.notify.get(client_id, lambda path: self.record(client_id, path))
+
+    def record(self, client_id, path):
+        with self.condition:
+            self.received.setdefault(client_id, []).append(path)
+            self.condition.notify_all()
+
+    def wait_for(self, client_id, count):
+        deadline = time.monotonic() + 5
+        with self.condition:
+            while len(self.received.get(client_id, [])) < count and \
+                    time.monotonic() < deadline:
+                self.condition.wait(0.05)
+            return sorted(self.received.get(client_id, []))
+
+
+def test_break_path():
+    index = callbacks.CallbackIndex()
+    clients = Clients()
+    index.subscribe(1, "d/a.txt")
+    index.subscribe(2, "d/a.txt")
+    index.subscribe(3, "d/b.txt")
+    index.break_path("d/a.txt", clients, changed_by=2)
+    assert clients.wait_for(1, 1) == ["d/a.txt"]
+    # the callbacks are broken, the next change notifies nobody
+    index.break_path("d/a.txt", clients)
+    index.break_path("d/b.txt", clients)
+    assert clients.wait_for(3, 1) == ["d/b.txt"]
+    assert clients.wait_for(1, 1) == ["d/a.txt"]
+    assert 2 not in clients.received
+    assert index.stats()["callbacks"] == 0
+    assert index.root.children == {}
+
+
+def test_break_tree():
+    index = callbacks.CallbackIndex()
+    clients = Clients()
+    index.subscribe(1, "d/a.txt")
+    index.subscribe(1, "d/e/b.txt")
+    index.subscribe(1, "other/c.txt")
+    index.subscribe(2, "d/e/b.txt")
+    index.break_tree("d", clients)
+    assert clients.wait_for(1, 2) == ["d/a.txt", "d/e/b.txt"]
+    assert clients.wait_for(2, 1) == ["d/e/b.txt"]
+    assert index.stats()["callbacks"] == 1
+    assert index.stats()["callback_clients"] == 1
+    assert list(index.root.children) == ["other"]
+
+
+def test_remove_client():
+    index = callbacks.CallbackIndex()
+    clients = Clients()
+    index.subscribe(1, "a.txt")
+    index.subscribe(2, "a.txt")
+    index.remove_client(1)
+    index.break_path("a.txt", clients)
+    assert clients.wait_for(2, 1) == ["a.txt"]
+    assert 1 not in clients.received
+
+
+def test_stuck_client_holds_up_nobody_else():
+    index = callbacks.CallbackIndex()
+    clients = Clients()
+    release = threading.Event()
+    clients.notify[1] = lambda path: release.wait(5)
+    index.subscribe(1, "a.txt")
+    index.subscribe(2, "a.txt")
+    index.subscribe(2, "b.txt")
+    index.break_path("a.txt", clients)
+    index.break_path("b.txt", clients)
+    assert clients.wait_for(2, 2) == ["a.txt", "b.txt"]
+    release.set()
+
+
+def test_failed_notification_drops_the_callbacks():
+    index = callbacks.CallbackIndex()
+    clients = Clients()
+
+    def fail(path):
+        raise OSError("connection reset")
+
+    clients.notify[1] = fail
+    index.subscribe(1, "a.txt")
+    index.subscribe(1, "b.txt")
+    index.break_path("a.txt", clients)
+    deadline = time.monotonic() + 5
+    while index.stats()["callbacks"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert index.stats()["callbacks"] == 0
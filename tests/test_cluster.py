@@ -0,0 +1,123 @@
+import socket
+import threading
+import time
+
+import pytest
+
+import cluster
+import directory_server
+import protocol
+
+NODES = ["127.0.0.1:%d" % port for port in range(9001, 9005)]
+PATHS = ["d/f%d.txt" % index for index in range(1000)]
+
+
+def request(opcode, *args):
+    return protocol.Frame(opcode, 0, 1, [str(arg) for arg in args],
+                          protocol.payload_from_bytes(b''))
+
+
+def test_ring_places_every_spelling_of_a_path_alike():
+    ring = cluster.HashRing(NODES)
+    assert ring.node_for("d/a.txt") == ring.node_for("/d//a.txt") == ring.node_for("d/./a.txt")
+    assert ring.node_for("d/a.txt") == cluster.HashRing(reversed(NODES)).node_for("d/a.txt")
+    with pytest.raises(LookupError):
+        cluster.HashRing().node_for("d/a.txt")
+
+
+def test_ring_spreads_files_and_moves_few_when_a_node_joins():
+    ring = cluster.HashRing(NODES)
+    before = dict((path, ring.node_for(path)) for path in PATHS)
+    counts = [list(before.values()).count(node) for node in NODES]
+    assert min(counts) > len(PATHS) / len(NODES) / 2
+    assert ring.add("127.0.0.1:9005") and not ring.add("127.0.0.1:9005")
+    moved = [path for path in PATHS if ring.node_for(path) != before[path]]
+    # only files taken over by the new node move
+    assert all(ring.node_for(path) == "127.0.0.1:9005" for path in moved)
+    assert len(moved) < len(PATHS) / 3
+    assert ring.remove("127.0.0.1:9005") and not ring.remove("127.0.0.1:9005")
+    assert dict((path, ring.node_for(path)) for path in PATHS) == before
+
+
+def test_copies_go_to_distinct_nodes():
+    ring = cluster.HashRing(NODES)
+    for path in PATHS[:50]:
+        nodes = ring.nodes_for(path, 3)
+        assert nodes[0] == ring.node_for(path)
+        assert len(set(nodes)) == 3
+    assert sorted(ring.nodes_for("a.txt", 10)) == sorted(NODES)
+
+
+@pytest.fixture
+def directory(monkeypatch):
+    monkeypatch.setattr(directory_server, "directory", directory_server.Directory())
+    monkeypatch.setattr(directory_server, "cluster_key", "secret")
+    return directory_server.directory
+
+
+def test_signed_join_and_leave(directory):
+    args = cluster.membership_args("secret", "join", NODES[0])
+    response = directory_server.handle_request(request(protocol.OP_JOIN, *args))
+    assert response.status == protocol.STATUS_OK
+    assert directory.nodes() == (1, [NODES[0]])
+    assert directory.locate("a.txt") == NODES[0]
+    # a join signature doesn't remove the node
+    response = directory_server.handle_request(request(protocol.OP_LEAVE, *args))
+    assert response.status == protocol.STATUS_FAILED
+    args = cluster.membership_args("secret", "leave", NODES[0])
+    response = directory_server.handle_request(request(protocol.OP_LEAVE, *args))
+    assert response.status == protocol.STATUS_OK
+    assert directory.nodes() == (2, [])
+    assert directory.locate("a.txt") is None
+
+
+def test_unsigned_join_is_refused(directory, monkeypatch):
+    for args in [cluster.membership_args("other", "join", NODES[0]),
+                 (NODES[0], "123", "0" * 64)]:
+        response = directory_server.handle_request(request(protocol.OP_JOIN, *args))
+        assert response.status == protocol.STATUS_FAILED
+    response = directory_server.handle_request(request(protocol.OP_JOIN, NODES[0]))
+    assert response.status == protocol.STATUS_BAD_REQUEST
+    # signatures made long ago are refused
+    made = str(int(time.time()) - 2 * cluster.SIGNATURE_LIFETIME)
+    args = (NODES[0], made, cluster.sign("secret", ("join", NODES[0], made)))
+    response = directory_server.handle_request(request(protocol.OP_JOIN, *args))
+    assert response.status == protocol.STATUS_FAILED
+    # a directory without a key refuses every join
+    monkeypatch.setattr(directory_server, "cluster_key", "")
+    args = cluster.membership_args("", "join", NODES[0])
+    response = directory_server.handle_request(request(protocol.OP_JOIN, *args))
+    assert response.status == protocol.STATUS_FAILED
+    assert directory.nodes() == (0, [])
+
+
+def test_nodes_join_a_directory_server(directory):
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    def accept():
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=directory_server.serve_connection, args=(connection,),
+                             daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    address = "127.0.0.1:%d" % listener.getsockname()[1]
+    try:
+        for node in NODES:
+            assert cluster.join(address, node, "secret") == protocol.STATUS_OK
+        assert cluster.join(address, "127.0.0.1:9999", "wrong") == protocol.STATUS_FAILED
+        assert cluster.leave(address, NODES[3], "secret") == protocol.STATUS_OK
+        epoch, nodes, copies = cluster.fetch_nodes(address)
+        assert (epoch, nodes, copies) == (5, NODES[:3], 1)
+        # clients place files where the directory server does
+        ring = cluster.HashRing(nodes)
+        for path in PATHS[:20]:
+            frame = cluster.call(address, protocol.OP_LOCATE, (path,))
+            assert frame.message == ring.node_for(path)
+    finally:
+        listener.close()
@@ -0,0 +1,90 @@
+import os
+import socket
+import threading
+import zlib
+
+import pytest
+
+import compression
+import protocol
+
+TEXT = b"".join(b"line %d of a file that compresses well\n" % i for i in range(20000))
+
+
+@pytest.fixture
+def codec():
+    return compression.ZlibCodec()
+
+
+def region(tmp_path, contents):
+    path = tmp_path / "region"
+    path.write_bytes(contents)
+    return protocol.FileRegion(open(str(path), 'rb'))
+
+
+def test_negotiate():
+    assert compression.negotiate(["lz4", "zlib"]).name == "zlib"
+    assert compression.negotiate(["lz4"]) is None
+    assert compression.negotiate([]) is None
+
+
+def test_hello_picks_a_codec():
+    client, server = socket.socketpair()
+    channel = protocol.FramedChannel(server)
+    connection = protocol.PipelinedConnection(client)
+    received = []
+    # the channel answers the hello itself and returns the next request
+    reader = threading.Thread(
+        target=lambda: received.append(channel.next_request().payload.read()))
+    reader.daemon = True
+    reader.start()
+    try:
+        assert connection.negotiate(["lz4", "zlib"]).name == "zlib"
+        # payloads are compressed from then on
+        connection.submit(protocol.OP_WRITE, ("a.txt",), TEXT)
+        reader.join(5)
+        assert received == [TEXT]
+    finally:
+        connection.close()
+        server.close()
+
+
+def test_small_and_incompressible_payloads_are_sent_as_they_are(codec, tmp_path):
+    assert protocol.compress_payload(codec, b"short") == (b"short", 0)
+    assert protocol.compress_payload(None, TEXT) == (TEXT, 0)
+    noise = region(tmp_path, os.urandom(500000))
+    payload, flags = protocol.compress_payload(codec, noise)
+    assert payload is noise and flags == 0
+    noise.close()
+
+
+def test_compressed_payloads(codec, tmp_path):
+    payload, flags = protocol.compress_payload(codec, TEXT[:100000])
+    assert flags == protocol.FLAG_COMPRESSED
+    assert zlib.decompress(payload) == TEXT[:100000]
+    # big regions are compressed into a temporary file
+    contents = region(tmp_path, TEXT)
+    payload, flags = protocol.compress_payload(codec, contents)
+    assert flags == protocol.FLAG_COMPRESSED
+    assert isinstance(payload, protocol.FileRegion) and payload is not contents
+    assert zlib.decompress(b"".join(payload.chunks())) == TEXT
+    protocol.close_compressed(payload, flags)
+    assert payload.file.closed
+    contents.close()
+
+
+def test_decompressed_size_is_capped(codec, monkeypatch):
+    monkeypatch.setattr(compression, "MAX_PAYLOAD", 1000)
+    assert compression.decompress(codec, zlib.compress(b"x" * 1000)) == b"x" * 1000
+    with pytest.raises(ValueError):
+        compression.decompress(codec, zlib.compress(b"x" * 1001))
+    with pytest.raises(ValueError):
+        compression.decompress(None, zlib.compress(b"x"))
+    frame = protocol.Frame(protocol.OP_WRITE, protocol.FLAG_COMPRESSED, 1, ["a"],
+                           protocol.payload_from_bytes(zlib.compress(b"x" * 2000)))
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decompress_frame(codec, frame)
+    frame = protocol.Frame(protocol.OP_WRITE, protocol.FLAG_COMPRESSED, 1, ["a"],
+                           protocol.payload_from_bytes(b"y" * 1001))
+    with pytest.raises(protocol.ProtocolError):
+        protocol.decompress_frame(codec, frame)
@@ -0,0 +1,106 @@
+import os
+import types
+
+import content_cache
+
+
+def version(ino, size, mtime_ns=1):
+    return types.SimpleNamespace(st_ino=ino, st_size=size, st_mtime_ns=mtime_ns)
+
+
+def test_cache_is_bounded_by_bytes():
+    cache = content_cache.ContentCache(max_bytes=10, max_entry_bytes=6)
+    cache.put("a", version(1, 4), b"aaaa")
+    cache.put("b", version(2, 4), b"bbbb")
+    assert cache.get("a", version(1, 4)) == b"aaaa"
+    # b was used least recently and goes to make room
+    cache.put("c", version(3, 4), b"cccc")
+    assert cache.get("b", version(2, 4)) is None
+    assert cache.get("a", version(1, 4)) == b"aaaa"
+    # files over the entry limit aren't cached
+    cache.put("d", version(4, 7), b"d" * 7)
+    assert cache.get("d", version(4, 7)) is None
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["evictions"]) == (2, 8, 1)
+
+
+def test_changed_file_misses():
+    cache = content_cache.ContentCache()
+    cache.put("a", version(1, 4, 100), b"aaaa")
+    assert cache.get("a", version(1, 4, 100)) == b"aaaa"
+    # replaced, grown or modified in place since it was cached
+    for stat in [version(2, 4, 100), version(1, 5, 100), version(1, 4, 200)]:
+        cache.put("a", version(1, 4, 100), b"aaaa")
+        assert cache.get("a", stat) is None
+        assert len(cache) == 0
+    cache.put("d/a", version(1, 1), b"a")
+    cache.put("d/e/b", version(2, 1), b"b")
+    cache.put("db", version(3, 1), b"c")
+    cache.invalidate_tree("d")
+    assert len(cache) == 1 and cache.stats()["invalidations"] == 2
+
+
+def test_file_changed_behind_the_server_is_read_again(file_manager):
+    client_id = file_manager.add_client(None)
+    with open("files/a.txt", "wb") as file:
+        file.write(b"first")
+    assert file_manager.read_item(client_id, "a.txt")[2] == b"first"
+    assert file_manager.read_item(client_id, "a.txt")[2] == b"first"
+    assert file_manager.content_cache.stats()["hits"] == 1
+    with open("files/a.txt", "ab") as file:
+        file.write(b" and second")
+    assert file_manager.read_item(client_id, "a.txt")[2] == b"first and second"
+    # a write through the server drops the entry at once
+    assert file_manager.write_item(client_id, "a.txt", b"third") == 0
+    assert len(file_manager.content_cache) == 0
+    assert file_manager.read_item(client_id, "a.txt")[2] == b"third"
+    os.remove("files/a.txt")
+    assert file_manager.read_item(client_id, "a.txt")[0] == 1
+
+
+def listing(file_manager, client_id, page_size=2):
+    res, path, pages = file_manager.list_directory(client_id, "d", page_size)
+    return [[(name, is_dir, size) for name, is_dir, size, mtime_ns in page] for page in pages]
+
+
+def names(pages):
+    return sorted(name for page in pages for name, is_dir, size in page)
+
+
+def test_listing_pages_come_from_the_cache(file_manager):
+    client_id = file_manager.add_client(None)
+    assert file_manager.make_directory(client_id, "d") == 0
+    for index in range(5):
+        assert file_manager.write_item(client_id, "d/f%d" % index, b"x") == 0
+    pages = listing(file_manager, client_id)
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert listing(file_manager, client_id) == pages
+    stats = file_manager.directory_cache.stats()
+    assert (stats["listings"], stats["listed_entries"], stats["listing_hits"]) == (1, 5, 1)
+
+
+def test_changes_invalidate_the_listing(file_manager):
+    client_id = file_manager.add_client(None)
+    assert file_manager.make_directory(client_id, "d") == 0
+    assert file_manager.write_item(client_id, "d/a", b"x") == 0
+    assert listing(file_manager, client_id) == [[("a", False, 1)]]
+    assert file_manager.make_directory(client_id, "d/e") == 0
+    assert names(listing(file_manager, client_id)) == ["a", "e"]
+    assert file_manager.write_item(client_id, "d/a", b"longer") == 0
+    assert ("a", False, 6) in listing(file_manager, client_id)[0]
+    assert file_manager.delete_file(client_id, "d/a") == 0
+    assert names(listing(file_manager, client_id)) == ["e"]
+
+
+def test_listing_read_during_a_change_is_not_cached(file_manager):
+    client_id = file_manager.add_client(None)
+    assert file_manager.make_directory(client_id, "d") == 0
+    for index in range(3):
+        assert file_manager.write_item(client_id, "d/f%d" % index, b"x") == 0
+    res, path, pages = file_manager.list_directory(client_id, "d", 1)
+    next(pages)
+    assert file_manager.write_item(client_id, "d/f0", b"changed") == 0
+    list(pages)
+    assert file_manager.directory_cache.stats()["listings"] == 0
+    assert ("f0", False, 7) in [entry for page in listing(file_manager, client_id)
+                                for entry in page]
@@ -0,0 +1,63 @@
+import io
+import random
+
+import pytest
+
+import delta
+
+
+def versions(size=200000, edits=5, seed=1):
+    generator = random.Random(seed)
+    old = generator.randbytes(size)
+    new = bytearray(old)
+    for _ in range(edits):
+        position = generator.randrange(size)
+        new[position:position + 50] = generator.randbytes(80)
+    return old, bytes(new)
+
+
+def signature_of(data):
+    return delta.signature(io.BytesIO(data), len(data))
+
+
+@pytest.mark.parametrize("old,new", [
+    versions(),
+    (b"", b"new file"),
+    (b"old contents", b""),
+    (b"a" * 5000, b"a" * 5000),
+    # shorter than a block
+    (b"0123456789", b"0123x56789"),
+])
+def test_round_trip(old, new):
+    patch = delta.make_delta(signature_of(old), new)
+    assert delta.apply_delta(old, patch) == new
+
+
+def test_small_edits_make_small_deltas():
+    old, new = versions()
+    patch = delta.make_delta(signature_of(old), new)
+    assert len(patch) < len(new) // 20
+    # the stream applies it the same
+    assert delta.patched(io.BytesIO(old), io.BytesIO(patch)).read() == new
+
+
+def test_delta_stops_at_max_literal():
+    generator = random.Random(2)
+    old = generator.randbytes(100000)
+    unrelated = generator.randbytes(100000)
+    assert delta.make_delta(signature_of(old), unrelated, 25000) is None
+    _, edited = versions(100000)
+    patch = delta.make_delta(signature_of(versions(100000)[0]), edited, 25000)
+    assert patch is not None
+
+
+def test_delta_against_other_basis_is_refused():
+    old, new = versions()
+    patch = delta.make_delta(signature_of(old), new)
+    with pytest.raises(ValueError):
+        delta.apply_delta(old[:1000], patch)
+
+
+def test_bad_signature():
+    with pytest.raises(ValueError):
+        delta.make_delta(b"\0\0\0\0\0\0\0\1", b"data")
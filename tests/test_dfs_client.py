@@ -0,0 +1,248 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+
+import dfs_client
+import protocol
+
+
+@pytest.fixture
+def server():
+    # Answers every request but drops the connection on the first request
+    # of each opcode, after reading it
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    received = []
+
+    def serve(sock):
+        with sock:
+            while True:
+                try:
+                    request = protocol.recv_frame(sock)
+                except (protocol.ConnectionClosed, OSError):
+                    return
+                received.append(request.opcode)
+                if received.count(request.opcode) == 1:
+                    return
+                protocol.send_frame(sock, request.opcode, request.request_id,
+                                    (protocol.STATUS_OK, "done"), b"contents",
+                                    protocol.FLAG_RESPONSE)
+
+    def accept():
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield listener.getsockname(), received
+    listener.close()
+
+
+def test_lost_read_is_sent_again(server):
+    address, received = server
+    client = dfs_client.Client(address, compress=False, timeout=5)
+    assert client.read("a.txt") == b"contents"
+    assert received == [protocol.OP_READ, protocol.OP_READ]
+    client.close()
+
+
+def test_lost_write_is_left_to_the_caller(server):
+    address, received = server
+    client = dfs_client.Client(address, compress=False, timeout=5)
+    with pytest.raises(protocol.ConnectionClosed):
+        client.write("a.txt", b"new")
+    assert received == [protocol.OP_WRITE]
+    client.close()
+
+
+def test_read_without_the_cache_after_a_retry(monkeypatch):
+    client = dfs_client.Client(cache=dfs_client.ClientCache())
+    attempts = []
+    monkeypatch.setattr(client, "cached_read",
+                        lambda path, offset, length: attempts.append(path))
+    monkeypatch.setattr(client, "call", lambda opcode, path, args: protocol.Frame(
+        opcode, protocol.FLAG_RESPONSE, 1, [str(protocol.STATUS_OK), "done"],
+        protocol.payload_from_bytes(b"plain")))
+    assert client.read("a.txt") == b"plain"
+    assert attempts == ["a.txt", "a.txt"]
+
+
+@pytest.fixture
+def echo_server():
+    # Answers every request with its payload
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    def serve(sock):
+        with sock:
+            while True:
+                try:
+                    request = protocol.recv_frame(sock)
+                    payload = request.payload.read()
+                    protocol.send_frame(sock, request.opcode, request.request_id,
+                                        (protocol.STATUS_OK, len(payload)), payload,
+                                        protocol.FLAG_RESPONSE)
+                except (protocol.ConnectionClosed, OSError):
+                    return
+
+    def accept():
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield listener.getsockname()
+    listener.close()
+
+
+def test_async_connection_streams_big_payloads(echo_server, tmp_path):
+    contents = bytes(range(256)) * (protocol.SPOOL_MEMORY_LIMIT // 100)
+    path = tmp_path / "big"
+    path.write_bytes(contents)
+
+    async def run():
+        connection = await dfs_client.open_async_connection(echo_server, compress=False)
+        try:
+            with open(str(path), 'rb') as file:
+                frames = await asyncio.gather(
+                    connection.request(protocol.OP_WRITE, ["big"], protocol.FileRegion(file)),
+                    connection.request(protocol.OP_WRITE, ["small"], b"small"))
+            return [(hasattr(frame.payload, "spool"), frame.payload.read()) for frame in frames]
+        finally:
+            connection.close()
+
+    assert asyncio.run(run()) == [(True, contents), (False, b"small")]
+
+
+def test_cache_evicts_the_least_recently_used():
+    cache = dfs_client.ClientCache(max_entries=2, max_bytes=10)
+    cache.put("a", b"aa", "1")
+    cache.put("b", b"bb", "1")
+    assert cache.get("a").contents == b"aa"
+    cache.put("c", b"cc", "1")
+    # b was used least recently
+    assert [path for path, entry in cache.items()] == ["a", "c"]
+    cache.put("d", b"d" * 9, "1")
+    assert [path for path, entry in cache.items()] == ["d"]
+    assert cache.size == 9
+    # files bigger than the cache aren't kept, nor their older copies
+    cache.put("d", b"x" * 11, "2")
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_cache_refresh_and_expire():
+    cache = dfs_client.ClientCache()
+    cache.put("a", b"contents", "1")
+    cache.expire("a", 4)
+    assert not cache.get("a").is_fresh(60)
+    assert cache.refresh("a", "2") is None
+    assert cache.refresh("a", "1", callback=True).is_fresh(0)
+    cache.expire("a", 100)
+    assert cache.get("a") is None
+    cache.put("d/a", b"a", "1")
+    cache.put("d/e/b", b"b", "1")
+    cache.put("db", b"c", "1")
+    cache.invalidate_tree("d")
+    assert [path for path, entry in cache.items()] == ["db"]
+
+
+def test_stale_entry_is_revalidated(monkeypatch):
+    client = dfs_client.Client(cache=dfs_client.ClientCache(), cache_time=0)
+    calls = []
+
+    def call(opcode, path, args, payload=b'', flags=0):
+        calls.append((list(args), flags & protocol.FLAG_CONDITIONAL))
+        if flags & protocol.FLAG_CONDITIONAL:
+            return protocol.Frame(opcode, protocol.FLAG_RESPONSE, 1,
+                                  [str(protocol.STATUS_NOT_MODIFIED), "unchanged", "v1"],
+                                  protocol.payload_from_bytes(b''))
+        return protocol.Frame(opcode, protocol.FLAG_RESPONSE, 1,
+                              [str(protocol.STATUS_OK), "done", "v1"],
+                              protocol.payload_from_bytes(b"contents"))
+
+    monkeypatch.setattr(client, "call", call)
+    assert client.read("a.txt") == b"contents"
+    # the copy is stale at once, the server says it is still current
+    assert client.read("a.txt") == b"contents"
+    assert client.read("a.txt", 3, 2) == b"te"
+    assert calls == [([], 0), (["v1"], protocol.FLAG_CONDITIONAL),
+                     ([3, 2, "v1"], protocol.FLAG_CONDITIONAL)]
+
+
+def test_async_read_is_sent_again_on_a_new_connection(server):
+    address, received = server
+
+    async def run():
+        async with dfs_client.AsyncClient(address, pool_size=1, compress=False,
+                                          timeout=5) as client:
+            contents = await client.read("a.txt")
+            return contents, client.stats()
+
+    contents, stats = asyncio.run(run())
+    assert contents == b"contents"
+    assert received == [protocol.OP_READ, protocol.OP_READ]
+    assert stats == {"connections": 1, "reconnects": 1}
+
+
+def test_async_write_is_left_to_the_caller(server):
+    address, received = server
+
+    async def run():
+        async with dfs_client.AsyncClient(address, pool_size=1, compress=False,
+                                          timeout=5) as client:
+            with pytest.raises(protocol.ConnectionClosed):
+                await client.write("a.txt", b"new")
+            # the next request reconnects
+            return await client.write("a.txt", b"new")
+
+    assert asyncio.run(run()) == "done"
+    assert received == [protocol.OP_WRITE, protocol.OP_WRITE]
+
+
+def test_async_requests_share_the_pool(echo_server):
+    async def run():
+        async with dfs_client.AsyncClient(echo_server, pool_size=2, compress=False,
+                                          timeout=5) as client:
+            messages = await asyncio.gather(*[client.write("f%d" % index, b"x" * index)
+                                              for index in range(10)])
+            await client.lock("a.txt")
+            # requests about a locked file go on the connection holding the lock
+            locked = client.locks["a.txt"]
+            sent = []
+            request = locked.request
+            locked.request = lambda opcode, *args: sent.append(opcode) or request(opcode, *args)
+            assert await client.write("a.txt", b"abc") == "3"
+            assert sent == [protocol.OP_WRITE]
+            await client.release("a.txt")
+            return messages, client.locks, client.stats()["connections"]
+
+    messages, locks, connections = asyncio.run(run())
+    assert messages == [str(index) for index in range(10)]
+    assert locks == {} and connections == 2
+
+
+def test_async_request_times_out():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+
+    async def run():
+        async with dfs_client.AsyncClient(listener.getsockname(), compress=False,
+                                          timeout=0.2) as client:
+            await client.read("a.txt")
+
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(run())
+    finally:
+        listener.close()
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import lock_manager
+from lock_manager import CONFLICT, EXCLUSIVE, LOCKED, SHARED, UPGRADED
+
+
+def test_exclusive_conflicts():
+    locks = lock_manager.LockManager()
+    assert locks.acquire(1, "files/a") == LOCKED
+    assert locks.acquire(2, "files/a") == CONFLICT
+    assert locks.acquire(2, "files/a", SHARED) == CONFLICT
+    assert locks.acquire(1, "files/./a") == lock_manager.ALREADY_HELD
+    assert locks.release(1, "files/a")
+    assert not locks.release(1, "files/a")
+    assert locks.acquire(2, "files/a") == LOCKED
+
+
+def test_shared_holders():
+    locks = lock_manager.LockManager()
+    assert locks.acquire(1, "files/a", SHARED) == LOCKED
+    assert locks.acquire(2, "files/a", SHARED) == LOCKED
+    assert locks.acquire(3, "files/a") == CONFLICT
+    # neither holder can upgrade while the other reads
+    assert locks.acquire(1, "files/a") == CONFLICT
+    assert locks.is_locked("files/a", 1)
+
+
+def test_upgrade_and_downgrade():
+    locks = lock_manager.LockManager()
+    assert locks.acquire(1, "files/a", SHARED, ttl=1) == LOCKED
+    assert locks.acquire(1, "files/a", EXCLUSIVE, ttl=30) == UPGRADED
+    record = locks.get("files/a")
+    assert record.mode == EXCLUSIVE
+    # the upgrade extends the lease like any other acquire
+    assert record.holders[1].expires > time.monotonic() + 20
+    assert locks.acquire(2, "files/a", SHARED) == CONFLICT
+    assert locks.downgrade(1, "files/a")
+    assert locks.get("files/a").mode == SHARED
+    assert locks.acquire(2, "files/a", SHARED) == LOCKED
+    assert not locks.downgrade(1, "files/a")
+
+
+def test_wait_for_release():
+    locks = lock_manager.LockManager()
+    locks.acquire(1, "files/a")
+    threading.Timer(0.05, locks.release, (1, "files/a")).start()
+    assert locks.acquire(2, "files/a", timeout=5) == LOCKED
+    assert locks.acquire(3, "files/a", timeout=0.05) == CONFLICT
+    assert locks.lease_stats()["wait_timeouts"] == 1
+
+
+def test_lease_expires():
+    expired = []
+    locks = lock_manager.LockManager(on_expire=lambda path, client_id: expired.append(path))
+    locks.acquire(1, "files/a", ttl=0.05)
+    locks.acquire(1, "files/b", ttl=0.05)
+    assert locks.renew(1, "files/b", 30)
+    deadline = time.monotonic() + 5
+    while not expired and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert expired == ["files/a"]
+    assert locks.get("files/a") is None
+    assert locks.get("files/b") is not None
+
+
+def test_locked_descendants():
+    locks = lock_manager.LockManager()
+    locks.acquire(1, "files/d/e/f")
+    assert locks.has_locked_descendants("files/d")
+    assert not locks.has_locked_descendants("files/e")
+    assert locks.release_client(1) == ["files/d/e/f"]
+    assert not locks.has_locked_descendants("files/d")
+
+
+def test_write_keeps_the_shared_lock(file_manager):
+    client_id = file_manager.add_client(None)
+    client = file_manager.get_active_client(client_id)
+    assert file_manager.write_item(client_id, "a.txt", b"one") == 0
+    assert file_manager.lock_item(client, "a.txt", SHARED) == 0
+    assert file_manager.write_item(client_id, "a.txt", b"two") == 0
+    assert file_manager.append_item(client_id, "a.txt", b"three") == 0
+    record = file_manager.locked_files.get("files/a.txt")
+    assert record.mode == SHARED and list(record.holders) == [client_id]
+    assert file_manager.write_item(client_id, "b.txt", b"new") == 0
+    # the lock taken for the write alone is released
+    assert file_manager.locked_files.get("files/b.txt") is None
@@ -0,0 +1,76 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics
+
+
+def test_buckets_hold_their_values():
+    for value in list(range(200)) + [1000, 4095, 4096, 123456, metrics.HIGHEST]:
+        index = metrics.bucket_index(value)
+        assert metrics.bucket_top(index) >= value
+        assert index == 0 or metrics.bucket_top(index - 1) < value
+    assert metrics.bucket_index(metrics.HIGHEST) == metrics.BUCKETS - 1
+
+
+def test_percentiles_are_within_a_bucket():
+    histogram = metrics.Histogram()
+    assert histogram.percentile(50) == 0.0 and histogram.mean() == 0.0
+    for value in range(1, 10001):
+        histogram.record(value / 1000000.0)
+    for p, exact in [(50, 5000), (99, 9900), (99.9, 9990)]:
+        value = histogram.percentile(p) * 1000000
+        assert exact <= value <= exact * (1 + 1.0 / metrics.SUB_BUCKETS)
+    assert histogram.percentile(100) == 0.01
+    assert histogram.mean() == pytest.approx(0.0050005, rel=0.001)
+    # durations out of range count as the ends of it
+    histogram = metrics.Histogram()
+    histogram.record(-1)
+    histogram.record(10 ** 6)
+    assert histogram.percentile(1) == 0.0
+    assert histogram.highest == metrics.HIGHEST
+
+
+def test_prometheus_text():
+    server_metrics = metrics.Metrics()
+    server_metrics.record("read", 0, 0.0003)
+    server_metrics.record("read", 0, 0.003)
+    server_metrics.record("write", 1, 0.1)
+    server_metrics.add_gauge("connections", "Open connections", lambda: 3)
+    server_metrics.add_gauge("broken", "Fails", lambda: 1 / 0)
+    lines = server_metrics.prometheus().split("\n")
+    assert lines[:4] == [
+        "# HELP dfs_requests_total Requests answered, by command and status",
+        "# TYPE dfs_requests_total counter",
+        'dfs_requests_total{command="read",status="0"} 2',
+        'dfs_requests_total{command="write",status="1"} 1']
+    assert 'dfs_request_duration_seconds_bucket{command="read",le="0.0002"} 0' in lines
+    assert 'dfs_request_duration_seconds_bucket{command="read",le="0.0005"} 1' in lines
+    assert 'dfs_request_duration_seconds_bucket{command="read",le="0.005"} 2' in lines
+    assert 'dfs_request_duration_seconds_bucket{command="read",le="+Inf"} 2' in lines
+    assert 'dfs_request_duration_seconds_sum{command="read"} 0.003300' in lines
+    assert 'dfs_request_duration_seconds_count{command="write"} 1' in lines
+    assert lines[-4:] == ["# HELP dfs_connections Open connections",
+                          "# TYPE dfs_connections gauge", "dfs_connections 3", ""]
+    assert not any("broken" in line for line in lines)
+    report = server_metrics.report().split("\n")
+    assert report[1].split("\t")[:3] == ["read", "2", "0"]
+    assert report[2].split("\t")[:3] == ["write", "1", "1"]
+    assert report[-1] == "connections\t3"
+
+
+def test_metrics_are_served_over_http():
+    server_metrics = metrics.Metrics()
+    server_metrics.record("read", 0, 0.001)
+    server = metrics.serve(server_metrics, 0)
+    try:
+        url = "http://127.0.0.1:%d" % server.server_address[1]
+        with urllib.request.urlopen(url + "/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            assert b'dfs_requests_total{command="read",status="0"} 1' in response.read()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other", timeout=5)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,112 @@
+import socket
+import threading
+
+import pytest
+
+import protocol
+
+
+@pytest.fixture
+def connection():
+    client, server = socket.socketpair()
+    connection = protocol.PipelinedConnection(client)
+    yield connection, server
+    connection.close()
+    server.close()
+
+
+def respond(sock, request, message, payload=b'', flags=0):
+    protocol.send_frame(sock, request.opcode, request.request_id,
+                        (protocol.STATUS_OK, message), payload,
+                        protocol.FLAG_RESPONSE | flags)
+
+
+def test_responses_out_of_order(connection):
+    connection, server = connection
+    futures = [connection.submit(protocol.OP_READ, ("f%d" % i,)) for i in range(3)]
+    requests = [protocol.recv_frame(server) for _ in range(3)]
+    assert len(set(request.request_id for request in requests)) == 3
+    for request in reversed(requests):
+        respond(server, request, request.args[0], request.args[0].encode())
+    for i, future in enumerate(futures):
+        frame = future.result(5)
+        assert frame.message == "f%d" % i
+        assert frame.payload.read() == ("f%d" % i).encode()
+
+
+def test_parts_of_a_batch(connection):
+    connection, server = connection
+    future = connection.submit_batch([(protocol.OP_READ, ("a",), b''),
+                                      (protocol.OP_READ, ("b",), b'')])
+    request = protocol.recv_frame(server)
+    request.payload.drain()
+    respond(server, request, "a", flags=protocol.FLAG_MORE)
+    respond(server, request, "b")
+    frame = future.result(5)
+    assert [part.message for part in frame.parts] == ["a"]
+    assert frame.message == "b"
+
+
+def test_closed_connection_fails_pending(connection):
+    connection, server = connection
+    future = connection.submit(protocol.OP_PWD)
+    server.close()
+    with pytest.raises(protocol.ConnectionClosed):
+        future.result(5)
+    with pytest.raises(protocol.ConnectionClosed):
+        connection.submit(protocol.OP_PWD)
+
+
+def test_failing_invalidation_callback_keeps_reading(capsys):
+    client, server = socket.socketpair()
+    paths = []
+
+    def on_invalidate(path):
+        paths.append(path)
+        raise RuntimeError("callback failed")
+
+    connection = protocol.PipelinedConnection(client, on_invalidate)
+    try:
+        future = connection.submit(protocol.OP_PWD)
+        request = protocol.recv_frame(server)
+        protocol.send_frame(server, protocol.OP_INVALIDATE, 0, ("a.txt",), b'',
+                            protocol.FLAG_RESPONSE)
+        respond(server, request, "/")
+        assert future.result(5).message == "/"
+        assert paths == ["a.txt"]
+        assert "callback failed" in capsys.readouterr().err
+    finally:
+        connection.close()
+        server.close()
+
+
+def test_malformed_frame_fails_pending(connection):
+    connection, server = connection
+    future = connection.submit(protocol.OP_READ, ("a",))
+    protocol.recv_frame(server)
+    # a hello answer whose status isn't a number
+    protocol.send_frame(server, protocol.OP_HELLO, 99, ("zlib",), b'', protocol.FLAG_RESPONSE)
+    with pytest.raises(protocol.ConnectionClosed):
+        future.result(5)
+    assert connection.error is not None
+
+
+def test_refused_connection(connection):
+    connection, server = connection
+    future = connection.submit(protocol.OP_PWD)
+    protocol.refuse_connection(server)
+    with pytest.raises(protocol.ConnectionClosed, match="server busy"):
+        future.result(5)
+
+
+def test_big_responses_are_spooled(connection):
+    connection, server = connection
+    future = connection.submit(protocol.OP_READ, ("big",))
+    request = protocol.recv_frame(server)
+    contents = bytes(range(256)) * (protocol.SPOOL_MEMORY_LIMIT // 128)
+    sender = threading.Thread(target=respond, args=(server, request, "big", contents))
+    sender.start()
+    frame = future.result(5)
+    sender.join(5)
+    assert frame.payload.spool is not None
+    assert frame.payload.read() == contents
@@ -0,0 +1,123 @@
+import io
+import socket
+import threading
+
+import pytest
+
+import protocol
+
+
+@pytest.fixture
+def pair():
+    left, right = socket.socketpair()
+    yield left, right
+    left.close()
+    right.close()
+
+
+def test_args_round_trip():
+    args = ["read", "dir/file name.txt", "", "ünïcode"]
+    assert protocol.decode_args(protocol.encode_args(args)) == args
+    assert protocol.decode_args(b'') == []
+
+
+def test_args_too_long():
+    with pytest.raises(protocol.ProtocolError):
+        protocol.encode_args(["x" * protocol.MAX_ARGS_LENGTH])
+
+
+def test_frame_round_trip(pair):
+    left, right = pair
+    protocol.send_frame(left, protocol.OP_WRITE, 7, ("a.txt",), b"hello\0world")
+    frame = protocol.recv_frame(right)
+    assert frame.opcode == protocol.OP_WRITE
+    assert frame.request_id == 7
+    assert frame.args == ["a.txt"]
+    assert frame.payload.length == 11
+    assert frame.payload.read() == b"hello\0world"
+
+
+def test_large_payload_is_streamed(pair):
+    left, right = pair
+    data = bytes(range(256)) * 4096
+    # more than the socket buffers hold, so it is sent while being read
+    sender = threading.Thread(target=protocol.send_frame,
+                              args=(left, protocol.OP_READ, 1, (), data))
+    sender.start()
+    frame = protocol.recv_frame(right)
+    out = io.BytesIO()
+    assert frame.payload.copy_to(out) == len(data)
+    sender.join()
+    assert out.getvalue() == data
+
+
+def test_file_region_sent_with_sendfile(pair, tmp_path):
+    left, right = pair
+    path = tmp_path / "f"
+    path.write_bytes(b"0123456789")
+    with open(path, "rb") as file:
+        protocol.send_frame(left, protocol.OP_READ, 3, (0, "f"), protocol.FileRegion(file, 2, 5))
+    frame = protocol.recv_frame(right)
+    assert frame.status == protocol.STATUS_OK
+    assert frame.message == "f"
+    assert frame.payload.read() == b"23456"
+
+
+def test_bad_magic(pair):
+    left, right = pair
+    left.sendall(b"XX" + bytes(protocol.HEADER.size - 2))
+    with pytest.raises(protocol.ProtocolError):
+        protocol.recv_frame(right)
+
+
+def test_closed_mid_frame(pair):
+    left, right = pair
+    left.sendall(protocol.encode_frame(protocol.OP_WRITE, 1, ("a",), b"abcdef")[:-3])
+    left.close()
+    frame = protocol.recv_frame(right)
+    with pytest.raises(protocol.ConnectionClosed):
+        frame.payload.read()
+
+
+def test_batch_round_trip():
+    requests = [(protocol.OP_READ, ("a",), b''), (protocol.OP_WRITE, ("b",), b"data"),
+                (protocol.OP_STAT, ("c",), b'')]
+    payload = protocol.payload_from_bytes(protocol.encode_batch(requests))
+    frames = []
+    for frame in protocol.read_frames(payload):
+        # payloads left unread are skipped
+        frames.append((frame.opcode, frame.args))
+    assert frames == [(opcode, list(args)) for opcode, args, _ in requests]
+
+
+def test_truncated_batch():
+    payload = protocol.payload_from_bytes(protocol.encode_batch([(protocol.OP_READ, ("a",), b'')])[:-1])
+    with pytest.raises(protocol.ProtocolError):
+        list(protocol.read_frames(payload))
+
+
+def test_legacy_request():
+    frame = protocol.parse_legacy_request("write////notes.txt////a////b")
+    assert frame.opcode == protocol.OP_WRITE
+    assert frame.args == ["notes.txt"]
+    # the separator inside the contents is kept
+    assert frame.payload.read() == b"a////b"
+    assert protocol.parse_legacy_request("bogus").opcode == protocol.OP_UNKNOWN
+
+
+def test_legacy_read_response():
+    request = protocol.parse_legacy_request("read////a.txt")
+    response = protocol.Response(protocol.STATUS_OK, "a.txt", payload=b"contents")
+    assert protocol.render_legacy_response(request, response) == b"a.txt////contents"
+    failed = protocol.Response(protocol.STATUS_FAILED, "no such file")
+    assert protocol.render_legacy_response(request, failed) == b"no such file"
+
+
+def test_open_channel_tells_clients_apart(pair):
+    left, right = pair
+    left.sendall(protocol.encode_frame(protocol.OP_PWD, 1))
+    assert isinstance(protocol.open_channel(right), protocol.FramedChannel)
+    other_left, other_right = socket.socketpair()
+    with other_left, other_right:
+        other_left.sendall(b"pwd")
+        assert isinstance(protocol.open_channel(other_right), protocol.LegacyChannel)
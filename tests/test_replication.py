@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+import cluster
+import protocol
+import replication
+import ser
+
+
+def request(opcode, *args, payload=b''):
+    return protocol.Frame(opcode, 0, 1, [str(arg) for arg in args],
+                          protocol.payload_from_bytes(payload))
+
+
+def replicate_request(key, action, path, sequence, node, payload=b''):
+    args = (action, path, sequence, node)
+    return request(protocol.OP_REPLICATE, *args, cluster.sign(key, args),
+                   payload=payload)
+
+
+@pytest.fixture
+def replicator(file_manager, monkeypatch):
+    replicator = replication.Replicator("127.0.0.1:1", "127.0.0.1:2", key="secret")
+    monkeypatch.setattr(ser, "file_manager", file_manager)
+    monkeypatch.setattr(ser, "replicator", replicator)
+    return replicator
+
+
+def test_quorum():
+    assert [replication.quorum(copies) for copies in (1, 2, 3, 4, 5)] == [1, 2, 2, 3, 3]
+
+
+def test_versions_keep_the_newest(monkeypatch):
+    monkeypatch.setattr(replication, "clock", lambda: 0)
+    versions = replication.VersionTable()
+    assert versions.next_version("a", "n1") == (1, "n1")
+    versions.set("a", (3, "n2"))
+    versions.set("a", (2, "n3"))
+    assert versions.get("a") == (3, "n2")
+    assert not versions.is_newer("a", (3, "n1"))
+    # a node numbering the same change breaks the tie
+    assert versions.is_newer("a", (3, "n3"))
+    assert versions.next_version("a", "n1") == (4, "n1")
+
+
+def test_versions_after_a_restart(monkeypatch):
+    before = replication.VersionTable().next_version("a", "n1")
+    # the versions are forgotten, the next change still comes after
+    monkeypatch.setattr(replication, "clock", lambda: before[0] + 10)
+    assert replication.VersionTable().next_version("a", "n1") > before
+
+
+def test_older_changes_are_refused(replicator, file_manager):
+    client_id = file_manager.add_client(None)
+    newer = replicate_request("secret", "write", "a.txt", 2, "n1", b"second")
+    older = replicate_request("secret", "write", "a.txt", 1, "n1", b"first")
+    assert ser.handle_request(newer, client_id).status == protocol.STATUS_OK
+    assert ser.handle_request(older, client_id).status == protocol.STATUS_FAILED
+    with open("files/a.txt", "rb") as file:
+        assert file.read() == b"second"
+    # a late delete doesn't remove the newer file either
+    delete = replicate_request("secret", "delete", "a.txt", 1, "n2")
+    assert ser.handle_request(delete, client_id).status == protocol.STATUS_FAILED
+    with open("files/a.txt", "rb") as file:
+        assert file.read() == b"second"
+    assert replicator.versions.get("a.txt") == (2, "n1")
+
+
+def test_unsigned_changes_are_refused(replicator, file_manager):
+    client_id = file_manager.add_client(None)
+    forged = replicate_request("guess", "write", "a.txt", 1, "n1", b"forged")
+    assert ser.handle_request(forged, client_id).status == protocol.STATUS_FAILED
+    unsigned = request(protocol.OP_REPLICATE, "write", "a.txt", 1, "n1", payload=b"x")
+    assert ser.handle_request(unsigned, client_id).status == protocol.STATUS_BAD_REQUEST
+    assert file_manager.item_exists(client_id, "a.txt") == -1
+
+
+def test_payload_is_read_before_the_path_lock(replicator, file_manager):
+    client_id = file_manager.add_client(None)
+    frame = replicate_request("secret", "write", "a.txt", 1, "n1", b"contents")
+    responses = []
+    with replicator.path_lock("a.txt"):
+        thread = threading.Thread(
+            target=lambda: responses.append(ser.handle_request(frame, client_id)))
+        thread.start()
+        # the sender isn't kept waiting while this node changes the path
+        deadline = time.monotonic() + 5
+        while frame.payload.remaining and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert frame.payload.remaining == 0
+        assert not responses
+    thread.join()
+    assert responses[0].status == protocol.STATUS_OK
+
+
+def test_changes_are_shipped_without_the_path_lock(replicator, file_manager, monkeypatch):
+    held = []
+
+    def replicate(action, path, version, file=None):
+        held.append(replicator.path_lock(path).locked())
+        return ([], 1)
+
+    monkeypatch.setattr(replicator, "replicate", replicate)
+    monkeypatch.setattr(replication, "clock", lambda: 0)
+    client_id = file_manager.add_client(None)
+    response = ser.handle_request(request(protocol.OP_WRITE, "a.txt", payload=b"a"), client_id)
+    assert response.status == protocol.STATUS_OK
+    assert ser.handle_request(request(protocol.OP_DELETE, "a.txt"), client_id).status == 0
+    assert held == [False, False]
+    assert replicator.versions.get("a.txt") == (2, "127.0.0.1:2")
@@ -0,0 +1,52 @@
+import threading
+import time
+
+import pytest
+
+import protocol
+import ser
+
+
+def request(opcode, *args, payload=b''):
+    return protocol.Frame(opcode, 0, 1, [str(arg) for arg in args],
+                          protocol.payload_from_bytes(payload))
+
+
+@pytest.fixture
+def server(file_manager, monkeypatch):
+    monkeypatch.setattr(ser, "file_manager", file_manager)
+    return file_manager
+
+
+def test_lock_waits_for_release(server):
+    owner = server.add_client(None)
+    waiter = server.add_client(None)
+    server.write_item(owner, "a.txt", b"a")
+    assert ser.handle_request(request(protocol.OP_LOCK, "a.txt"), owner).status == 0
+    threading.Timer(0.05, ser.handle_request,
+                    (request(protocol.OP_RELEASE, "a.txt"), owner)).start()
+    response = ser.handle_request(request(protocol.OP_LOCK, "a.txt", 60, 5), waiter)
+    assert response.status == protocol.STATUS_OK
+
+
+def test_lock_waiters_are_bounded(server, monkeypatch):
+    monkeypatch.setattr(ser, "lock_waiters", threading.BoundedSemaphore(1))
+    owner = server.add_client(None)
+    server.write_item(owner, "a.txt", b"a")
+    ser.handle_request(request(protocol.OP_LOCK, "a.txt"), owner)
+    first = threading.Thread(target=ser.handle_request,
+                             args=(request(protocol.OP_LOCK, "a.txt", 60, 0.5),
+                                   server.add_client(None)))
+    first.start()
+    time.sleep(0.1)
+    # the only waiter slot is taken, the next wait is refused at once
+    started = time.monotonic()
+    response = ser.handle_request(request(protocol.OP_LOCK, "a.txt", 60, 5),
+                                  server.add_client(None))
+    assert response.status == protocol.STATUS_FAILED
+    assert time.monotonic() - started < 0.5
+    first.join()
+    # an uncontended lock never needs a slot
+    server.write_item(owner, "b.txt", b"b")
+    assert ser.handle_request(request(protocol.OP_LOCK, "b.txt", 60, 5),
+                              server.add_client(None)).status == protocol.STATUS_OK
@@ -0,0 +1,180 @@
+import io
+import os
+import random
+import threading
+import time
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def chunked(tmp_path):
+    os.mkdir(tmp_path / "files")
+    return storage.ChunkStorage(str(tmp_path / "files"), str(tmp_path / "chunks"))
+
+
+def data(size, seed=1):
+    generator = random.Random(seed)
+    return bytes(generator.getrandbits(8) for _ in range(size))
+
+
+def read(chunked, path):
+    with chunked.open(path) as file:
+        return file.read()
+
+
+def test_chunks_are_content_defined():
+    original = data(300000)
+    edited = original[:1000] + b"inserted" + original[1000:]
+    chunks = list(storage.split_chunks(original))
+    assert b"".join(chunks) == original
+    assert all(len(chunk) <= storage.MAX_CHUNK_SIZE for chunk in chunks)
+    # only the chunks around an insertion change
+    shared = set(chunks) & set(storage.split_chunks(io.BytesIO(edited)))
+    assert len(shared) >= len(chunks) - 2
+
+
+def test_round_trip_and_deduplication(chunked, tmp_path):
+    contents = data(200000)
+    chunked.write(str(tmp_path / "files/a"), contents)
+    chunked.write(str(tmp_path / "files/b"), contents)
+    assert read(chunked, str(tmp_path / "files/a")) == contents
+    assert os.path.getsize(tmp_path / "files/a") == len(contents)
+    stats = chunked.stats()
+    assert stats["chunks_reused"] == stats["chunks_stored"]
+    with chunked.open(str(tmp_path / "files/b")) as file:
+        assert isinstance(file, storage.ChunkFile)
+        file.seek(150000)
+        assert file.read(10) == contents[150000:150010]
+
+
+def test_write_at_and_append(chunked, tmp_path):
+    path = str(tmp_path / "files/a")
+    contents = data(100000)
+    chunked.write(path, contents)
+    chunked.write_at(path, b"patch", 50000)
+    chunked.write_at(path, b"tail", None)
+    expected = contents[:50000] + b"patch" + contents[50005:] + b"tail"
+    assert read(chunked, path) == expected
+
+
+def test_small_files_are_kept_as_they_are(chunked, tmp_path):
+    path = str(tmp_path / "files/small")
+    chunked.write(path, b"tiny")
+    with open(path, 'rb') as file:
+        assert file.read() == b"tiny"
+
+
+@pytest.mark.parametrize("contents", [
+    # written before the storage was in use, like a manifest
+    storage.MANIFEST_MAGIC + b"1 5000 " + b"0" * 64 + b"\n" + b"x" * 5000,
+    # garbage after the magic
+    storage.MANIFEST_MAGIC + b"not a number\n" + b"y" * 5000,
+])
+def test_plain_files_that_look_like_manifests(chunked, tmp_path, contents):
+    path = str(tmp_path / "files/plain")
+    with open(path, 'wb') as file:
+        file.write(contents)
+    assert read(chunked, path) == contents
+    assert chunked.collect_garbage(str(tmp_path / "files")) == 0
+
+
+def test_manifests_of_another_store_are_not_trusted(chunked, tmp_path):
+    path = str(tmp_path / "files/a")
+    chunked.write(path, data(50000))
+    with open(path, 'rb') as file:
+        manifest = file.read()
+    other = storage.ChunkStorage(str(tmp_path / "files"), str(tmp_path / "other"))
+    with other.open(path) as file:
+        assert file.read() == manifest
+
+
+def test_garbage_collection(chunked, tmp_path):
+    root = str(tmp_path / "files")
+    chunked.write(os.path.join(root, "a"), data(100000, 1))
+    chunked.write(os.path.join(root, "b"), data(100000, 2))
+    chunked.copy(os.path.join(root, "b"), os.path.join(root, "c"))
+    chunked.delete(os.path.join(root, "b"))
+    assert chunked.collect_garbage(root) == 0
+    chunked.delete(os.path.join(root, "c"))
+    assert chunked.collect_garbage(root) > 0
+    assert read(chunked, os.path.join(root, "a")) == data(100000, 1)
+    # the key survives
+    assert os.path.exists(tmp_path / "chunks" / storage.KEY_NAME)
+
+
+def test_collection_waits_for_readers(chunked, tmp_path):
+    root = str(tmp_path / "files")
+    path = os.path.join(root, "a")
+    old = data(300000, 1)
+    chunked.write(path, old)
+    reader = chunked.open(path)
+    first = reader.read(1000)
+    chunked.write(path, data(300000, 2))
+    collector = threading.Thread(target=chunked.collect_garbage, args=(root,))
+    collector.start()
+    time.sleep(0.1)
+    assert collector.is_alive()
+    # the chunks of the old version are still there
+    assert first + reader.read() == old
+    reader.close()
+    collector.join(5)
+    assert not collector.is_alive()
+    assert chunked.stats()["chunks_collected"] > 0
+
+
+def manifest_write(chunks, send, lengths=None):
+    entries = [storage.WRITE_HEADER.pack(len(chunks))]
+    for index, chunk in enumerate(chunks):
+        length = len(chunk) if lengths is None else lengths[index]
+        entries.append(storage.WRITE_ENTRY.pack(storage.chunk_digest(chunk), length,
+                                                chunk in send))
+    return io.BytesIO(b"".join(entries + [chunk for chunk in chunks if chunk in send]))
+
+
+def test_manifest_writes(chunked, tmp_path):
+    path = str(tmp_path / "files/a")
+    contents = data(200000)
+    chunks = list(storage.split_chunks(contents))
+    assert chunked.write_manifest(path, manifest_write(chunks, set(chunks)))
+    # chunks the store has are only named
+    assert chunked.write_manifest(str(tmp_path / "files/b"), manifest_write(chunks, set()))
+    assert read(chunked, str(tmp_path / "files/b")) == contents
+    assert not chunked.write_manifest(path, manifest_write([data(5000, 9)], set()))
+
+
+@pytest.mark.parametrize("length", [0, storage.MAX_CHUNK_SIZE + 1, 123456, 1])
+def test_manifest_writes_with_wrong_lengths(chunked, tmp_path, length):
+    path = str(tmp_path / "files/a")
+    chunks = list(storage.split_chunks(data(200000)))
+    chunked.write(path, b"".join(chunks))
+    lengths = [len(chunk) for chunk in chunks]
+    lengths[0] = length
+    with pytest.raises(ValueError):
+        chunked.write_manifest(str(tmp_path / "files/b"), manifest_write(chunks, set(), lengths))
+    assert not os.path.exists(tmp_path / "files/b")
+
+
+def test_manifest_writes_with_too_many_chunks(chunked, tmp_path):
+    source = io.BytesIO(storage.WRITE_HEADER.pack(storage.MAX_WRITE_CHUNKS + 1))
+    with pytest.raises(ValueError):
+        chunked.write_manifest(str(tmp_path / "files/a"), source)
+
+
+def test_copy_reads_the_manifest_with_the_collector_out(chunked, tmp_path, monkeypatch):
+    root = str(tmp_path / "files")
+    chunked.write(os.path.join(root, "a"), data(100000))
+    writers = []
+    read_manifest = chunked.read_manifest
+
+    def reading(file, size):
+        writers.append(chunked.gate.writers)
+        return read_manifest(file, size)
+
+    monkeypatch.setattr(chunked, "read_manifest", reading)
+    chunked.copy(os.path.join(root, "a"), os.path.join(root, "b"))
+    assert writers == [1]
+    monkeypatch.undo()
+    assert read(chunked, os.path.join(root, "b")) == data(100000)
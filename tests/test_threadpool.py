@@ -0,0 +1,62 @@
+import threading
+import time
+
+import threadpool
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_full_pool_rejects_tasks():
+    release = threading.Event()
+    pool = threadpool.ThreadPool(1, max_queue=1)
+    assert pool.add_task(release.wait)
+    assert wait_for(lambda: pool.stats()["idle_workers"] == 0)
+    assert pool.add_task(release.wait)
+    # the worker is busy and the queue full
+    assert not pool.add_task(release.wait)
+    assert pool.stats()["tasks_rejected"] == 1
+    release.set()
+    pool.wait_completion()
+    assert pool.stats()["tasks_done"] == 2
+
+
+def test_pool_grows_for_waiting_tasks():
+    release = threading.Event()
+    pool = threadpool.ThreadPool(4, min_workers=1, max_queue=0)
+    for _ in range(4):
+        assert pool.add_task(release.wait)
+    assert wait_for(lambda: pool.stats()["workers"] == 4)
+    assert not pool.add_task(release.wait)
+    release.set()
+    pool.wait_completion()
+
+
+def test_higher_priorities_run_first():
+    release = threading.Event()
+    order = []
+    pool = threadpool.ThreadPool(1, max_queue=3)
+    pool.add_task(release.wait)
+    assert wait_for(lambda: pool.stats()["idle_workers"] == 0)
+    pool.submit(threadpool.LOW, order.append, "low")
+    pool.submit(threadpool.NORMAL, order.append, "normal")
+    pool.submit(threadpool.HIGH, order.append, "high")
+    release.set()
+    pool.wait_completion()
+    assert order == ["high", "normal", "low"]
+
+
+def test_idle_workers_exit():
+    release = threading.Event()
+    pool = threadpool.ThreadPool(3, min_workers=1, max_queue=0, idle_timeout=0.1)
+    for _ in range(3):
+        pool.add_task(release.wait)
+    assert wait_for(lambda: pool.stats()["workers"] == 3)
+    release.set()
+    pool.wait_completion()
+    assert wait_for(lambda: pool.stats()["workers"] == 1)
+    assert pool.stats()["workers_stopped"] == 2
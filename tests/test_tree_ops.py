@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+import tree_ops
+
+
+@pytest.fixture
+def tree(tmp_path):
+    # top/a (1 byte), top/d/b (2), top/d/e/c.txt (3), top/d/e/f/ empty
+    top = tmp_path / "top"
+    os.makedirs(str(top / "d" / "e" / "f"))
+    for path, size in [("a", 1), ("d/b", 2), ("d/e/c.txt", 3)]:
+        (top / path).write_bytes(b"x" * size)
+    return str(top)
+
+
+@pytest.fixture
+def walker():
+    walker = tree_ops.TreeWalker(workers=2)
+    yield walker
+    walker.executor.shutdown()
+
+
+def test_walk_reaches_every_directory(walker, tree):
+    walked = dict((relative, sorted((name, is_dir, size) for name, is_dir, size, mtime_ns
+                                    in entries)) for relative, entries in walker.walk(tree))
+    assert sorted(walked) == ["", "d", "d/e", "d/e/f"]
+    assert walked["d"] == [("b", False, 2), ("e", True, walked["d"][1][2])]
+    assert walked["d/e/f"] == []
+
+
+def test_walk_skips_directories_removed_meanwhile(walker, tree, monkeypatch):
+    scan_directory = tree_ops.scan_directory
+
+    def removing_scan(path):
+        if path.endswith("/d"):
+            raise FileNotFoundError(path)
+        return scan_directory(path)
+
+    monkeypatch.setattr(tree_ops, "scan_directory", removing_scan)
+    assert [relative for relative, entries in walker.walk(tree)] == [""]
+
+
+def test_copy_tree(walker, tree, tmp_path):
+    destination = str(tmp_path / "copy")
+    assert walker.copy_tree(tree, destination) == (3, 6)
+    with open(os.path.join(destination, "d", "e", "c.txt"), "rb") as file:
+        assert file.read() == b"xxx"
+    assert os.path.isdir(os.path.join(destination, "d", "e", "f"))
+    # the destination must not exist
+    with pytest.raises(FileExistsError):
+        walker.copy_tree(tree, destination)
+
+
+def test_find(walker, tree):
+    assert sorted(path for path, is_dir, size, mtime_ns
+                  in tree_ops.find(walker.walk(tree), "*.txt")) == ["d/e/c.txt"]
+    assert sorted(path for path, is_dir, size, mtime_ns
+                  in tree_ops.find(walker.walk(tree), "d/?")) == ["d/b", "d/e"]
+    assert sorted(path for path, is_dir, size, mtime_ns
+                  in tree_ops.find(walker.walk(tree), "[ef]")) == ["d/e", "d/e/f"]
+
+
+def test_disk_usage(walker, tree):
+    usage = tree_ops.disk_usage(walker.walk(tree))
+    assert (usage.size, usage.files, usage.directories) == (6, 3, 3)
+    assert usage.children == {"a": 1, "d": 5}
+
+
+def test_tree_destination_checks(file_manager):
+    client_id = file_manager.add_client(None)
+    for name in ["src", "src/sub", "other"]:
+        assert file_manager.make_directory(client_id, name) == 0
+    assert file_manager.write_item(client_id, "src/a", b"a") == 0
+    assert file_manager.copy_item(client_id, "missing", "x")[0] == 1
+    # a directory can't replace one that exists, nor go inside itself
+    assert file_manager.copy_item(client_id, "src", "other")[0] == 3
+    assert file_manager.copy_item(client_id, "src/a", "other")[0] == 3
+    assert file_manager.copy_item(client_id, "src", "src/sub/copy")[0] == 4
+    assert file_manager.move_item(client_id, "src", "src/sub/copy") == 4
+    assert file_manager.copy_item(client_id, "src", "nowhere/copy")[0] == 5
+    assert file_manager.move_item(client_id, "src/a", "nowhere/a") == 5
+    assert file_manager.copy_item(client_id, "src", "copy") == (0, 1, 1)
+    assert file_manager.move_item(client_id, "copy", "other/copy") == 0
+    assert os.path.isfile("files/other/copy/a")
@@ -0,0 +1,106 @@
+import os
+import shutil
+
+import pytest
+
+import file_server
+import storage
+import wal
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = wal.WriteAheadLog(str(tmp_path / "wal"), group_commit=False)
+    yield log
+    log.close()
+
+
+def replayed(log):
+    records = []
+    log.replay(lambda record: records.append(
+        (record.kind, record.path, record.offset, record.data.read())))
+    return records
+
+
+def test_replay_applies_records_in_order(log):
+    with log.change(wal.WRITE, "a", b"first") as data:
+        assert data.read() == b"first"
+    with log.change(wal.WRITE_AT, "a", b"second", 5):
+        pass
+    with log.change(wal.DELETE, "b"):
+        pass
+    assert replayed(log) == [(wal.WRITE, "a", 0, b"first"), (wal.WRITE_AT, "a", 5, b"second"),
+                             (wal.DELETE, "b", 0, b"")]
+    # the log is empty once replayed
+    assert replayed(log) == []
+
+
+def test_failed_sync_is_not_replayed(log, monkeypatch):
+    syncs = []
+
+    def sync_data(fd):
+        syncs.append(fd)
+        if len(syncs) == 1:
+            raise OSError("sync failed")
+
+    monkeypatch.setattr(wal, "sync_data", sync_data)
+    with pytest.raises(OSError):
+        with log.change(wal.WRITE, "a", b"lost"):
+            pass
+    with log.change(wal.WRITE, "b", b"kept"):
+        pass
+    assert replayed(log) == [(wal.WRITE, "b", 0, b"kept")]
+    assert log.stats()["wal_aborts"] == 1
+
+
+def test_failed_change_is_not_replayed(log):
+    with pytest.raises(ValueError):
+        with log.change(wal.WRITE, "a", b"lost"):
+            raise ValueError("applying failed")
+    assert replayed(log) == []
+
+
+def test_record_cut_short_is_removed(log, monkeypatch):
+    writes = []
+    write_all = wal.write_all
+
+    def failing_write_all(fd, data):
+        writes.append(len(data))
+        if len(writes) == 2:
+            raise OSError("disk full")
+        write_all(fd, data)
+
+    monkeypatch.setattr(wal, "write_all", failing_write_all)
+    with pytest.raises(OSError):
+        with log.change(wal.WRITE, "a", b"x" * (wal.COPY_CHUNK_SIZE + 1)):
+            pass
+    # the records after it are still found
+    with log.change(wal.WRITE, "b", b"kept"):
+        pass
+    assert replayed(log) == [(wal.WRITE, "b", 0, b"kept")]
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_copies_are_logged(tmp_path, monkeypatch, chunked):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("files/d/e")
+    file_storage = storage.ChunkStorage("files", "chunks") if chunked else None
+    log = wal.WriteAheadLog("wal", group_commit=False)
+    manager = file_server.FileSystemManager("files", file_storage=file_storage, write_log=log)
+    client_id = manager.add_client(None)
+    contents = bytes(range(256)) * 100
+    assert manager.write_item(client_id, "d/a", contents) == 0
+    assert manager.write_item(client_id, "d/e/b", b"small") == 0
+    assert manager.copy_item(client_id, "d", "copy")[:2] == (0, 2)
+    assert manager.copy_item(client_id, "d/a", "c") == (0, 1, len(contents))
+    # the copies are logged rather than synced with a checkpoint
+    assert log.stats()["wal_checkpoints"] == 0
+    shutil.rmtree("files/copy")
+    os.remove("files/c")
+    manager.recover()
+    for path in ["copy/a", "c"]:
+        with manager.storage.open("files/" + path) as file:
+            assert file.read() == contents
+    with manager.storage.open("files/copy/e/b") as file:
+        assert file.read() == b"small"
+    log.close()
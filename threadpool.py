@@ -1,55 +1,218 @@
-# Downloaded from http://code.activestate.com/recipes/577187-python-thread-pool/
+# Based on http://code.activestate.com/recipes/577187-python-thread-pool/
 
-from queue import Queue
-from threading import Thread
+import heapq
+import itertools
+import sys
+import threading
+import time
+import traceback
 
-class Worker(Thread):
-    """Thread executing tasks from a given tasks queue"""
-    def __init__(self, tasks):
-        Thread.__init__(self)
-        self.tasks = tasks
+import metrics
+
+# Priorities of tasks, lower ones run first
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+# Seconds a worker above min_workers waits for a task before it exits
+IDLE_TIMEOUT = 30.0
+
+# Seconds a task may wait for a worker before another worker is started
+GROW_AFTER = 0.005
+
+
+class Worker(threading.Thread):
+    """Thread executing tasks from the queue of a pool"""
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.pool = pool
         self.daemon = True
         self.start()
 
     def run(self):
         while True:
-            func, args, kargs = self.tasks.get()
-            try: func(*args, **kargs)
-            except Exception as e: print(e)
-            self.tasks.task_done()
+            task = self.pool.next_task()
+            if task is None:
+                return
+            priority, sequence, queued, func, args, kargs = task
+            started = time.monotonic()
+            self.pool.wait_times.record(started - queued)
+            try:
+                func(*args, **kargs)
+            except Exception:
+                self.pool.task_failed()
+            finally:
+                self.pool.task_done(time.monotonic() - started)
+
 
 class ThreadPool:
-    """Pool of threads consuming tasks from a queue"""
-    def __init__(self, num_threads):
-        self.tasks = Queue(num_threads)
-        for _ in range(num_threads): Worker(self.tasks)
+    """Pool of threads consuming tasks from a priority queue
+
+    The pool starts min_workers threads and grows up to max_workers when a
+    task waits more than grow_after seconds for one. Threads above
+    min_workers exit after idle_timeout seconds without work. Once every
+    thread is busy and max_queue tasks wait, new tasks are rejected rather
+    than waiting for room. With only max_workers given the pool has a fixed
+    size and a queue as long"""
+    def __init__(self, max_workers, min_workers=None, max_queue=None,
+                 idle_timeout=IDLE_TIMEOUT, grow_after=GROW_AFTER):
+        self.max_workers = max_workers
+        self.min_workers = max_workers if min_workers is None else min(min_workers, max_workers)
+        self.max_queue = max_workers if max_queue is None else max_queue
+        self.idle_timeout = idle_timeout
+        self.grow_after = grow_after
+        self.lock = threading.Lock()
+        # idle workers wait on has_work, the monitor and wait_completion on
+        # changed
+        self.has_work = threading.Condition(self.lock)
+        self.changed = threading.Condition(self.lock)
+        # (priority, sequence, time queued, func, args, kargs)
+        self.tasks = []
+        self.sequence = itertools.count()
+        self.workers = 0
+        self.idle = 0
+        self.running = 0
+        self.counters = {"tasks_done": 0, "tasks_failed": 0, "tasks_rejected": 0,
+                         "workers_started": 0, "workers_stopped": 0, "peak_workers": 0}
+        # seconds tasks waited for a worker and took to run
+        self.wait_times = metrics.Histogram()
+        self.run_times = metrics.Histogram()
+        with self.lock:
+            for _ in range(self.min_workers):
+                self.start_worker()
+        if self.max_workers > self.min_workers:
+            monitor = threading.Thread(target=self.monitor)
+            monitor.daemon = True
+            monitor.start()
 
     def add_task(self, func, *args, **kargs):
-        """Add a task to the queue"""
-        self.tasks.put((func, args, kargs))
+        """Add a task to the queue, return False if the pool is full"""
+        return self.submit(NORMAL, func, *args, **kargs)
 
-    def wait_completion(self):
-        """Wait for completion of all the tasks in the queue"""
-        self.tasks.join()
+    def submit(self, priority, func, *args, **kargs):
+        """Add a task to the queue with a priority, return False if the
+        pool is full"""
+        with self.lock:
+            # workers not running a task will take one of those queued
+            if len(self.tasks) >= self.max_queue + self.workers - self.running:
+                if self.workers >= self.max_workers:
+                    self.counters["tasks_rejected"] += 1
+                    return False
+                self.start_worker()
+            heapq.heappush(self.tasks, (priority, next(self.sequence), time.monotonic(),
+                                        func, args, kargs))
+            self.has_work.notify()
+            self.changed.notify_all()
+            return True
 
-if __name__ == '__main__':
-    from random import randrange
-    delays = [randrange(1, 10) for i in range(100)]
+    def next_task(self):
+        """Wait for a task, return None once the worker should exit"""
+        with self.lock:
+            self.idle = self.idle + 1
+            deadline = time.monotonic() + self.idle_timeout
+            try:
+                while not self.tasks:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 and self.workers > self.min_workers:
+                        self.workers = self.workers - 1
+                        self.counters["workers_stopped"] += 1
+                        return None
+                    self.has_work.wait(max(remaining, 0) or self.idle_timeout)
+                self.running = self.running + 1
+                return heapq.heappop(self.tasks)
+            finally:
+                self.idle = self.idle - 1
+
+    def task_done(self, seconds):
+        self.run_times.record(seconds)
+        with self.lock:
+            self.running = self.running - 1
+            self.counters["tasks_done"] += 1
+            if not self.tasks and not self.running:
+                self.changed.notify_all()
+
+    def task_failed(self):
+        with self.lock:
+            self.counters["tasks_failed"] += 1
+        print("task failed in thread pool", file=sys.stderr)
+        traceback.print_exc()
+
+    def start_worker(self):
+        """Start a worker, called with the lock held"""
+        self.workers = self.workers + 1
+        self.counters["workers_started"] += 1
+        self.counters["peak_workers"] = max(self.counters["peak_workers"], self.workers)
+        Worker(self)
+
+    def monitor(self):
+        """Start workers for the tasks that have waited grow_after seconds
+        for one"""
+        with self.lock:
+            while True:
+                while not self.tasks:
+                    self.changed.wait()
+                now = time.monotonic()
+                oldest = min(task[2] for task in self.tasks)
+                if now - oldest < self.grow_after:
+                    self.changed.wait(self.grow_after - (now - oldest))
+                    continue
+                # a worker for each task kept waiting beyond those free ones
+                # will take
+                late = sum(1 for task in self.tasks if now - task[2] >= self.grow_after)
+                for _ in range(min(late - (self.workers - self.running),
+                                   self.max_workers - self.workers)):
+                    self.start_worker()
+                self.changed.wait(self.grow_after)
 
-    from time import sleep
-    def wait_delay(d):
-        print('sleeping for (%d)sec' % d)
-        sleep(d)
+    def queued(self):
+        """Return the number of tasks waiting for a worker"""
+        with self.lock:
+            return len(self.tasks)
 
-    # 1) Init a Thread pool with the desired number of threads
-    pool = ThreadPool(20)
+    def stats(self):
+        """Return the counters of the pool, its size and the p50 and p99
+        times in milliseconds tasks waited and ran"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["workers"] = self.workers
+            stats["idle_workers"] = self.idle
+            stats["queued"] = len(self.tasks)
+        waits = self.wait_times.snapshot()
+        runs = self.run_times.snapshot()
+        for p in (50, 99):
+            stats["wait_p%d_ms" % p] = waits.percentile(p) * 1000
+            stats["run_p%d_ms" % p] = runs.percentile(p) * 1000
+        return stats
 
-    for i, d in enumerate(delays):
-        # print the percentage of tasks placed in the queue
-        print('%.2f%c' % ((float(i)/float(len(delays)))*100.0,'%'))
+    def wait_completion(self):
+        """Wait for completion of all the tasks in the queue"""
+        with self.lock:
+            while self.tasks or self.running:
+                self.changed.wait()
+
+if __name__ == '__main__':
+    # Runs bursts of short tasks on a fixed pool and on an adaptive one,
+    # then compares the threads each holds once the bursts are over
+    import random
 
-        # 2) Add the task to the queue
-        pool.add_task(wait_delay, d)
+    def burst(pool, tasks, delays):
+        started = time.monotonic()
+        accepted = sum(1 for delay in delays[:tasks] if pool.add_task(time.sleep, delay))
+        pool.wait_completion()
+        return accepted, time.monotonic() - started
 
-    # 3) Wait for completion
-    pool.wait_completion()
\ No newline at end of file
+    random.seed(1)
+    delays = [random.uniform(0.001, 0.02) for _ in range(2000)]
+    for name, pool in (("fixed 64", ThreadPool(64, max_queue=2000)),
+                       ("adaptive 4-64", ThreadPool(64, 4, max_queue=2000, idle_timeout=0.5))):
+        accepted, elapsed = burst(pool, 2000, delays)
+        busy = pool.workers
+        time.sleep(1.0)
+        stats = pool.stats()
+        print("%-13s %d tasks in %.2fs, %d threads in the burst, %d idle after, "
+              "wait p99 %.1fms" % (name, accepted, elapsed, max(busy, stats["peak_workers"]),
+                                   stats["workers"], stats["wait_p99_ms"]))
+    small = ThreadPool(4, 1, max_queue=8)
+    accepted, elapsed = burst(small, 100, [0.01] * 100)
+    print("pool of 4 with 8 queued accepted %d of 100 tasks, %d rejected" % (
+        accepted, small.stats()["tasks_rejected"]))
@@ -0,0 +1,175 @@
+import collections
+import concurrent.futures
+import fnmatch
+import os
+import posixpath
+import shutil
+import stat
+
+DEFAULT_WORKERS = 8
+
+# Most directories being scanned at the same time by one walk
+MAX_PENDING_SCANS = 64
+
+
+# Reads one directory. Entries are (name, is_dir, size, mtime_ns), symbolic
+# links are reported but never followed so a walk stays inside its tree
+def scan_directory(path):
+    entries = []
+    with os.scandir(path) as scan:
+        for entry in scan:
+            try:
+                entry_stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # removed while listing
+                continue
+            entries.append((entry.name, stat.S_ISDIR(entry_stat.st_mode),
+                            entry_stat.st_size, entry_stat.st_mtime_ns))
+    return entries
+
+
+class TreeWalker:
+    # Walks and copies directory trees on a pool of threads. Directories are
+    # scanned in parallel and their entries handed out as soon as each scan
+    # finishes, so results stream while the rest of the tree is read
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+    # Yields (relative path, entries) for top and every directory below it,
+    # in no particular order. The relative path of top is ""
+    def walk(self, top):
+        waiting = collections.deque([""])
+        running = {}
+        try:
+            while waiting or running:
+                while waiting and len(running) < MAX_PENDING_SCANS:
+                    relative = waiting.popleft()
+                    future = self.executor.submit(
+                        scan_directory, posixpath.join(top, relative))
+                    running[future] = relative
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    relative = running.pop(future)
+                    try:
+                        entries = future.result()
+                    except (FileNotFoundError, NotADirectoryError, PermissionError):
+                        # removed or unreadable since its parent was scanned
+                        continue
+                    for name, is_dir, size, mtime_ns in entries:
+                        if is_dir:
+                            waiting.append(posixpath.join(relative, name))
+                    yield relative, entries
+        finally:
+            for future in running:
+                future.cancel()
+
+    # Copies the tree at source to destination, which must not exist.
+    # Directories are created with make_directory(path) as the walk reaches
+    # them and files are copied in parallel with copy(source, destination)
+    # Returns (files, bytes) copied
+    def copy_tree(self, source, destination, copy=None, make_directory=None):
+        if copy is None:
+            copy = copy_file
+        if make_directory is None:
+            make_directory = os.makedirs
+        make_directory(destination)
+        copies = []
+        files = 0
+        copied = 0
+        try:
+            for relative, entries in self.walk(source):
+                for name, is_dir, size, mtime_ns in entries:
+                    target = posixpath.join(destination, relative, name)
+                    if is_dir:
+                        make_directory(target)
+                    else:
+                        copies.append(self.executor.submit(
+                            copy, posixpath.join(source, relative, name), target))
+                        files = files + 1
+                        copied = copied + size
+            for future in copies:
+                future.result()
+        finally:
+            for future in copies:
+                future.cancel()
+        return (files, copied)
+
+
+# Copies a file without passing its contents through Python, shutil uses
+# sendfile or copy_file_range where the platform has them
+def copy_file(source, destination):
+    shutil.copyfile(source, destination, follow_symlinks=False)
+    shutil.copymode(source, destination, follow_symlinks=False)
+
+
+# Yields the (relative path, is_dir, size, mtime_ns) entries of a walk whose
+# name matches a glob pattern. Patterns with a / are matched against the
+# path relative to the top of the walk
+def find(walk, pattern):
+    match_path = "/" in pattern
+    for relative, entries in walk:
+        for name, is_dir, size, mtime_ns in entries:
+            path = posixpath.join(relative, name)
+            if fnmatch.fnmatchcase(path if match_path else name, pattern):
+                yield (path, is_dir, size, mtime_ns)
+
+
+class DiskUsage:
+    # Totals of a walk, overall and for each entry of its top directory
+    def __init__(self):
+        self.size = 0
+        self.files = 0
+        self.directories = 0
+        # name of an entry of the top directory -> bytes at or below it
+        self.children = collections.Counter()
+
+    def add(self, relative, entries):
+        for name, is_dir, size, mtime_ns in entries:
+            child = relative.split("/", 1)[0] if relative else name
+            if is_dir:
+                self.directories = self.directories + 1
+                self.children[child] += 0
+            else:
+                self.files = self.files + 1
+                self.size = self.size + size
+                self.children[child] += size
+
+
+def disk_usage(walk):
+    usage = DiskUsage()
+    for relative, entries in walk:
+        usage.add(relative, entries)
+    return usage
+
+
+if __name__ == '__main__':
+    # Compares a serial os.walk with the parallel walk over a generated tree
+    import sys
+    import tempfile
+    import time
+
+    fanout = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    with tempfile.TemporaryDirectory() as top:
+        for first in range(fanout):
+            for second in range(fanout):
+                directory = os.path.join(top, "d%d" % first, "d%d" % second)
+                os.makedirs(directory)
+                for index in range(10):
+                    with open(os.path.join(directory, "f%d" % index), "wb") as file:
+                        file.write(b"x" * index)
+        start = time.perf_counter()
+        count = 0
+        for directory, subdirectories, files in os.walk(top):
+            for name in files:
+                os.stat(os.path.join(directory, name))
+                count = count + 1
+        print("os.walk + stat: %d files in %.3fs" % (count, time.perf_counter() - start))
+        walker = TreeWalker()
+        start = time.perf_counter()
+        usage = disk_usage(walker.walk(top))
+        print("parallel walk:  %d files in %.3fs" % (usage.files, time.perf_counter() - start))
+        start = time.perf_counter()
+        files, copied = walker.copy_tree(top, top + ".copy")
+        print("copy_tree:      %d files in %.3fs" % (files, time.perf_counter() - start))
+        shutil.rmtree(top + ".copy")
@@ -0,0 +1,389 @@
+import io
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+# Write-ahead log of the changes made to the files, so a change that was
+# acknowledged survives a crash. Each change is appended to the log with its
+# data and the log is synced before the change is applied to the files,
+# which are then written as usual without syncing them. Changes made at the
+# same time share a sync: the first writer to wait syncs everything appended
+# so far, the others find their records synced when it is done (group
+# commit). Once the log grows past CHECKPOINT_SIZE the files are synced and
+# the log starts again empty. After a crash the records in the log are
+# applied again in order. Each record holds the whole result of its change,
+# the new contents of a file or bytes at an offset, so applying it twice
+# leaves the same files as applying it once. A change that fails once its
+# record is in the log, its sync or applying it, is followed by an abort
+# record and isn't applied again: the client was told it failed
+
+# Kinds of record
+WRITE = 1
+WRITE_AT = 2
+MANIFEST = 3
+DELETE = 4
+MKDIR = 5
+RMDIR = 6
+# the offset of an abort record is where the record of the failed change
+# starts in the log
+ABORT = 7
+
+# kind, path length, offset, data length, then the path, the data and a
+# crc32 of all of it. A record cut short by a crash fails its check and ends
+# the log
+RECORD_HEADER = struct.Struct('!BHqQ')
+RECORD_CHECK = struct.Struct('!I')
+
+# Bytes the log grows to before a checkpoint
+CHECKPOINT_SIZE = 64 * 1024 * 1024
+
+# Data of a change is kept in memory up to this size, in a temporary file
+# beyond it
+SPOOL_SIZE = 1024 * 1024
+
+COPY_CHUNK_SIZE = 256 * 1024
+
+LOG_NAME = "journal"
+
+sync_data = getattr(os, "fdatasync", os.fsync)
+
+
+class Record:
+    # A change read back from the log. data is a stream of its bytes,
+    # position where the record starts in the log
+    def __init__(self, kind, path, offset, data, position=0):
+        self.kind = kind
+        self.path = path
+        self.offset = offset
+        self.data = data
+        self.position = position
+
+
+class WriteAheadLog:
+    # Log kept in directory, which should be outside the files served.
+    # Without group_commit every change syncs the log itself
+    def __init__(self, directory, group_commit=True, checkpoint_size=CHECKPOINT_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, LOG_NAME)
+        self.group_commit = group_commit
+        self.checkpoint_size = checkpoint_size
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self.condition = threading.Condition()
+        # bytes appended to the log and bytes known to be on disk
+        self.written = os.fstat(self.fd).st_size
+        self.synced = self.written
+        self.syncing = False
+        # changes between their record and the end of applying them, a
+        # checkpoint waits for them and holds new ones back
+        self.changing = 0
+        self.checkpointing = False
+        self.counters = {"wal_records": 0, "wal_syncs": 0, "wal_bytes": 0,
+                         "wal_checkpoints": 0, "wal_replayed": 0, "wal_aborts": 0}
+
+    # Returns a context manager for a change: entering it appends a record
+    # and waits until it is on disk, the block then applies the change. It
+    # gives the data of the change, source read into a stream of bytes
+    def change(self, kind, path, source=b'', offset=0):
+        return Change(self, kind, path, source, offset)
+
+    def begin(self):
+        with self.condition:
+            while self.checkpointing:
+                self.condition.wait()
+            self.changing = self.changing + 1
+
+    def end(self):
+        with self.condition:
+            self.changing = self.changing - 1
+            if self.changing == 0:
+                self.condition.notify_all()
+            full = self.written >= self.checkpoint_size and not self.checkpointing
+        if full:
+            self.checkpoint()
+
+    # Appends a record whose data is in spool, size bytes. A record that
+    # can't be written whole is cut off again, the records appended after it
+    # would be lost behind it
+    # Returns (where the record starts, size of the log once it is written)
+    def append(self, kind, path, offset, spool, size):
+        path = path.encode()
+        head = RECORD_HEADER.pack(kind, len(path), offset, size) + path
+        check = zlib.crc32(head)
+        spool.seek(0)
+        with self.condition:
+            start = self.written
+            try:
+                if size <= COPY_CHUNK_SIZE:
+                    data = spool.read()
+                    write_all(self.fd, head + data + RECORD_CHECK.pack(zlib.crc32(data, check)))
+                else:
+                    write_all(self.fd, head)
+                    while True:
+                        chunk = spool.read(COPY_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        check = zlib.crc32(chunk, check)
+                        write_all(self.fd, chunk)
+                    write_all(self.fd, RECORD_CHECK.pack(check))
+            except BaseException:
+                os.ftruncate(self.fd, start)
+                raise
+            self.written = self.written + len(head) + size + RECORD_CHECK.size
+            self.counters["wal_records"] += 1
+            self.counters["wal_bytes"] += len(head) + size + RECORD_CHECK.size
+            return (start, self.written)
+
+    # Appends and syncs an abort record for the record at position, whose
+    # change failed
+    def abort(self, position):
+        self.commit(self.append(ABORT, "", position, io.BytesIO(), 0)[1])
+        with self.condition:
+            self.counters["wal_aborts"] += 1
+
+    # Waits until the log is on disk up to end. The first writer to wait
+    # syncs the log while the others append and wait for it, they share the
+    # next sync
+    def commit(self, end):
+        if not self.group_commit:
+            sync_data(self.fd)
+            with self.condition:
+                self.counters["wal_syncs"] += 1
+                self.synced = max(self.synced, end)
+            return
+        with self.condition:
+            while self.synced < end:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+                self.syncing = True
+                target = self.written
+                self.condition.release()
+                try:
+                    sync_data(self.fd)
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    self.condition.notify_all()
+                self.synced = max(self.synced, target)
+                self.counters["wal_syncs"] += 1
+
+    # Writes every change applied so far to disk and empties the log.
+    # Changes wait meanwhile. work, if given, runs with the changes held
+    # back before the files are synced, for changes that can't be applied
+    # twice like moves
+    def checkpoint(self, work=None):
+        with self.condition:
+            while self.checkpointing:
+                self.condition.wait()
+            self.checkpointing = True
+            while self.changing > 0:
+                self.condition.wait()
+        try:
+            result = None
+            if work is not None:
+                result = work()
+            os.sync()
+            os.ftruncate(self.fd, 0)
+            os.fsync(self.fd)
+            with self.condition:
+                self.written = 0
+                self.synced = 0
+                self.counters["wal_checkpoints"] += 1
+            return result
+        finally:
+            with self.condition:
+                self.checkpointing = False
+                self.condition.notify_all()
+
+    # Yields the records in the log, up to the first one that is cut short
+    # or damaged
+    def records(self):
+        with open(self.path, 'rb') as log:
+            while True:
+                position = log.tell()
+                head = log.read(RECORD_HEADER.size)
+                if len(head) < RECORD_HEADER.size:
+                    return
+                kind, path_length, offset, size = RECORD_HEADER.unpack(head)
+                path = log.read(path_length)
+                check = zlib.crc32(path, zlib.crc32(head))
+                spool = self.spool()
+                copied = 0
+                while copied < size:
+                    chunk = log.read(min(COPY_CHUNK_SIZE, size - copied))
+                    if not chunk:
+                        break
+                    check = zlib.crc32(chunk, check)
+                    spool.write(chunk)
+                    copied = copied + len(chunk)
+                trailer = log.read(RECORD_CHECK.size)
+                if copied < size or len(trailer) < RECORD_CHECK.size or \
+                        RECORD_CHECK.unpack(trailer)[0] != check:
+                    spool.close()
+                    return
+                spool.seek(0)
+                try:
+                    yield Record(kind, path.decode(), offset, spool, position)
+                finally:
+                    spool.close()
+
+    # Applies the records left in the log by calling apply(record) for each,
+    # in order, then syncs the files and empties the log. Aborted records
+    # are skipped
+    # Returns the number of records applied
+    def replay(self, apply):
+        aborted = set(record.offset for record in self.records() if record.kind == ABORT)
+        count = 0
+        for record in self.records():
+            if record.kind == ABORT or record.position in aborted:
+                continue
+            apply(record)
+            count = count + 1
+        with self.condition:
+            self.counters["wal_replayed"] += count
+        self.checkpoint()
+        return count
+
+    def spool(self):
+        return tempfile.SpooledTemporaryFile(SPOOL_SIZE, dir=self.directory)
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats["wal_size"] = self.written
+            return stats
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Change:
+    # A change between its record and the end of applying it, see
+    # WriteAheadLog.change. The data is read from source before the change
+    # begins, a slow client doesn't hold back checkpoints
+    def __init__(self, log, kind, path, source, offset):
+        self.log = log
+        self.kind = kind
+        self.path = path
+        self.source = source
+        self.offset = offset
+        self.spool = None
+        # where the record of the change starts in the log, once appended
+        self.position = None
+
+    def __enter__(self):
+        self.spool = self.log.spool()
+        try:
+            if isinstance(self.source, (bytes, bytearray, memoryview)):
+                self.spool.write(self.source)
+            else:
+                while True:
+                    chunk = self.source.read(COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.spool.write(chunk)
+            size = self.spool.tell()
+            self.log.begin()
+        except BaseException:
+            self.spool.close()
+            raise
+        try:
+            self.position, end = self.log.append(
+                self.kind, self.path, self.offset, self.spool, size)
+            self.log.commit(end)
+        except BaseException as error:
+            self.__exit__(type(error), error, error.__traceback__)
+            raise
+        self.spool.seek(0)
+        return self.spool
+
+    # A change that failed once its record was appended is aborted, it
+    # may be applied in part but isn't applied again after a crash
+    def __exit__(self, error_type, error, traceback):
+        try:
+            if error_type is not None and self.position is not None:
+                self.log.abort(self.position)
+        finally:
+            self.spool.close()
+            self.log.end()
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+
+if __name__ == '__main__':
+    # Measures small writes made crash safe by syncing each file and its
+    # directory, by a log synced for each write and by a log whose syncs are
+    # shared, with a few numbers of writing threads. Put the files on the
+    # disk to measure, syncs cost nothing on tmpfs
+    import storage
+    import sys
+    import time
+
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    disk = sys.argv[2] if len(sys.argv) > 2 else None
+    contents = os.urandom(4096)
+    file_storage = storage.FileStorage()
+
+    def sync_each_file(root, path):
+        fd, temp_path = tempfile.mkstemp(dir=root, prefix=".", suffix=".tmp")
+        try:
+            write_all(fd, contents)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_path, path)
+        fd = os.open(root, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def run(threads, write):
+        counts = [0] * threads
+        deadline = time.monotonic() + duration
+
+        def writer(index):
+            done = 0
+            while time.monotonic() < deadline:
+                write("w%d-%d" % (index, done % 100))
+                done = done + 1
+            counts[index] = done
+
+        workers = [threading.Thread(target=writer, args=(index,)) for index in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return sum(counts) / duration
+
+    for threads in (1, 8, 32):
+        results = []
+        for method in ("fsync per write", "log, sync each", "log, group commit"):
+            with tempfile.TemporaryDirectory(dir=disk) as top:
+                root = os.path.join(top, "files")
+                os.makedirs(root)
+                log = WriteAheadLog(os.path.join(top, "wal"), method.endswith("group commit"))
+
+                def write(name):
+                    path = os.path.join(root, name)
+                    if method == "fsync per write":
+                        sync_each_file(root, path)
+                        return
+                    with log.change(WRITE, name, contents) as source:
+                        file_storage.write(path, source)
+
+                rate = run(threads, write)
+                stats = log.stats()
+                log.close()
+            line = "%s %6.0f writes/s" % (method, rate)
+            if method != "fsync per write":
+                line = line + " (%.1f per sync)" % (stats["wal_records"] / max(stats["wal_syncs"], 1))
+            results.append(line)
+        print("%2d threads: %s" % (threads, ", ".join(results)))